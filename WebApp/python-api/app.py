@@ -1,79 +1,202 @@
-import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import click
 import psycopg2
-from flask import Flask, jsonify, request
+import psycopg2.errors
+from flask import Flask, Response, g, jsonify, request
 from dotenv import load_dotenv
+from werkzeug.datastructures import MultiDict
+
+import catalog
+import datagen
+import export
+import jobs
+import metrics
+import migrate
+import passwords
+import queries
+import roles
+import serialize
+import statements
+import tree_import
+from cache import ReportCache, check_workers
+from db import DatabaseUnavailable, connect, db_connection, env_float, get_pool, get_replicas
+from pagination import PaginationError, page_headers, parse_id_list
 
 load_dotenv()
 
 app = Flask(__name__)
 
-# Helper funcion to close connections
+# Request, SQL and connection pool timings, served at /metrics
+metrics.init_app(app)
+
+# Several workers (WEB_CONCURRENCY) need a shared report cache, see check_workers
+check_workers()
+
+# Report responses are cached until a write route bumps one of the tables they read. With
+# read replicas (POSTGRES_REPLICAS), they are read from the primary for a while after such a
+# write (see ReportCache).
+report_cache = ReportCache(staleness=get_replicas().staleness if get_replicas() else 0.0)
+
+# Tables get_tree_request_status() reads, so a write to any of them can change a stored status
+STATUS_TABLES = ('tree_requests', 'permits', 'scheduled_visits', 'visit_events', 'scheduled_plantings',
+                 'planting_events')
+
+# Tables each report reads, and whether it uses CURRENT_DATE, for its cached endpoint and its jobs
+REPORT_TABLES = {
+    'tree-requests-status': (STATUS_TABLES, True),
+    'trees-planted': (('residents', 'tree_requests', 'scheduled_plantings', 'planting_events', 'trees'), False),
+    'tree-species-statistics': (('trees', 'tree_requests', 'scheduled_plantings', 'planting_events'), True),
+    'neighborhood-report': (('residents', *STATUS_TABLES), False),
+    'custom-report-1': (('residents', 'planting_events_have_volunteers', 'planting_events', 'scheduled_plantings'),
+                        False),
+    'custom-report-2': (('residents', 'organization_members', 'organization_members_lead_scheduled_plantings',
+                         'scheduled_plantings', 'planting_events', 'scheduled_visits'), False),
+    'custom-report-3': (('trees', 'tree_requests', 'residents', 'scheduled_plantings', 'planting_events'), True),
+    'custom-report-4': (('trees', 'tree_requests', 'scheduled_plantings', 'planting_events'), False),
+    'custom-report-5': (('residents', 'scheduled_plantings_have_volunteers', 'scheduled_plantings',
+                         'planting_events_have_volunteers', 'planting_events'), False),
+    'all-tree-requests': (('residents', 'trees', *STATUS_TABLES), False),
+}
+
+def cached_report(name):
+    """report_cache.cached() with the tables of report `name`."""
+    tables, daily = REPORT_TABLES[name]
+    return report_cache.cached(*tables, daily=daily)
+
+# In-memory index of the tree catalog behind /api/trees/search and custom report 4
+tree_catalog = catalog.CatalogIndex()
+
+def current_tree_catalog():
+    """The tree catalog index, rebuilt first if one of catalog.TABLES was written to since."""
+    versions = report_cache.versions(catalog.TABLES)
+    index = tree_catalog.get(versions)
+    if index is None:
+        with db_connection(replica=report_cache.settled(catalog.TABLES, versions)) as conn, conn.cursor() as cur:
+            statements.execute(cur, queries.TREE_CATALOG)
+            index = tree_catalog.set(versions, cur.fetchall())
+    return index
+
+# Membership and volunteer status of residents, for admin authorization
+role_cache = roles.RoleCache()
+
+def resident_roles(ids):
+    """roles.role() of each of `ids`, from the role cache where it can."""
+    def load(missing):
+        with db_connection() as conn, conn.cursor() as cur:
+            statements.execute(cur, queries.RESIDENT_ROLES, (missing,))
+            return cur.fetchall()
+    return roles.lookup(role_cache, report_cache.versions(roles.TABLES), ids, load)
+
+def rows_response(query, cur, rows=None, headers=None):
+    """Response of `query`'s rows on `cur` (or `rows` of it, if given): an array of objects keyed by
+    the column names, or one array per column with ?format=columnar."""
+    try:
+        fmt = serialize.parse_format(request.args)
+    except serialize.FormatError as e:
+        return jsonify({"error": str(e)}), 400
+    rows = cur.fetchall() if rows is None else rows
+    return app.json.rows(query.keys(queries.column_names(cur)), rows, fmt, headers)
+
+# Seconds a client keeps reading from the primary after it writes, so it sees its own
+# changes while the replicas catch up. Writes answer with an X-Primary-Until timestamp,
+# which the frontend sends back with its requests (see hooks.server.ts).
+READ_YOUR_WRITES = env_float("READ_YOUR_WRITES_SECONDS", 5.0)
+PRIMARY_UNTIL_HEADER = 'X-Primary-Until'
+
+def pinned_to_primary(headers):
+    """Whether the request's X-Primary-Until header is still in the future."""
+    try:
+        return float(headers.get(PRIMARY_UNTIL_HEADER) or 0) > time.time()
+    except ValueError:
+        return False
+
+def read_connection():
+    """Connection for a read-only route: a replica, unless the client is pinned to the primary
+    or the response is filling the report cache right after a write."""
+    return db_connection(replica=not (g.get('read_primary') or pinned_to_primary(request.headers)))
+
+@app.after_request
+def pin_writes_to_primary(response):
+    # Submitting a report job only writes the job itself, which is always read from the primary
+    if (get_replicas() is not None and READ_YOUR_WRITES > 0 and request.method not in ('GET', 'HEAD', 'OPTIONS')
+            and response.status_code < 400 and request.endpoint != 'submit_report_job'):
+        response.headers[PRIMARY_UNTIL_HEADER] = f'{time.time() + READ_YOUR_WRITES:.3f}'
+    return response
+
+# Helper funcion to close connections (returns the connection to the pool)
 def close_resources(conn, cur):
     if cur:
         cur.close()
     if conn:
-        conn.close()
+        get_pool().putconn(conn)
 
 def get_db_connection():
-    """Connects to the PostgreSQL database."""
+    """Checks a connection out of the PostgreSQL connection pool.
+
+    Prefer `with db_connection() as conn:`, which always returns it.
+    """
     try:
-        conn = psycopg2.connect(
-            host=os.getenv("POSTGRES_HOST"),
-            database=os.getenv("POSTGRES_DB"),
-            user=os.getenv("POSTGRES_USERNAME"),
-            password=os.getenv("POSTGRES_PASSWORD"),
-            port=os.getenv("POSTGRES_PORT")
-        )
-        return conn
-    except Exception as e:
+        return get_pool().getconn()
+    except DatabaseUnavailable as e:
         print(f"Error connecting to database: {e}")
 
+@app.errorhandler(DatabaseUnavailable)
+def database_unavailable(e):
+    print(f"Error connecting to database: {e}")
+    return jsonify({"error": "Could not connect to database"}), 500
+
+# Connection pool statistics for this worker, used to size the pool, the report job queue and the
+# health of each replica
+@app.route('/api/pool-stats')
+def pool_stats():
+    stats = get_pool().stats()
+    stats['report_jobs'] = job_runner.stats()
+    replicas = get_replicas()
+    if replicas is not None:
+        stats['replicas'] = replicas.stats()
+        for replica, pool in zip(stats['replicas']['replicas'], replicas.pools):
+            replica['pool'] = pool.stats() if pool is not None else None
+    return jsonify(stats)
+
+# Report cache hit/miss/eviction counters
+@app.route('/api/cache-stats')
+def cache_stats():
+    stats = report_cache.stats()
+    stats['roles'] = role_cache.stats()
+    return jsonify(stats)
+
 @app.route('/api/test')
 def test_connection():
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('SELECT version();')
             db_version = cur.fetchone()
-            close_resources(conn, cur)
             return jsonify({"message": "Database connection successful!", "version": db_version})
         except Exception as e:
-             if conn: conn.close()
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 ## ---TASKS.SQL---
-# Get all tree requests for a specific resident_id
+# Get a page of tree requests for a specific resident_id, newest first.
+# Pass the X-Next-Cursor response header back as ?cursor= to get the next page.
 @app.route('/api/tree-requests')
 def get_tree_requests():
     resident_id = request.args.get('resident_id')
     if not resident_id:
         return jsonify({"error": "Missing resident_id parameter"}), 500
+    try:
+        query, params, limit = queries.tree_requests_page(resident_id, request.args)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
 
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('SELECT id, submission_timestamp, approved FROM tree_requests tr WHERE tr.resident_id = %s ORDER BY tr.submission_timestamp DESC;', (resident_id,))
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-
-            tree_requests = []
-            for row in rows:
-                tree_requests.append({
-                    'id': row[0],
-                    'submission_timestamp': row[1],
-                    'approved': row[2]
-                })
-
-            return jsonify(tree_requests)
+            statements.execute(cur, query, params)
+            rows, headers = page_headers(cur.fetchall(), limit, 1, 0)
+            return rows_response(query, cur, rows, headers)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Get information on a speficic tree request
 @app.route('/api/details')
@@ -86,42 +209,25 @@ def get_tree_request_details():
         return jsonify({"error": "Missing resident_id parameter"}), 500
 
 
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-	SELECT 
-			t.common_name,
-			t.scientific_name,
-        	get_tree_request_status(tr.id)               AS status,
-        	CURRENT_DATE - submission_timestamp::DATE AS days_since_planting,
-            p.status AS permit_status
-		FROM tree_requests tr
-		INNER JOIN trees t ON tr.tree_id = t.id
-        INNER JOIN permits p ON tr.id = p.tree_request_id
-		WHERE tr.id = %s AND tr.resident_id = %s;
-''', (tree_request_id, resident_id,))
+            statements.execute(cur, queries.TREE_REQUEST_DETAILS, (tree_request_id, resident_id,))
             row = cur.fetchone()
-            close_resources(conn, cur)
 
             if not row:
                 return jsonify({"error": "Tree request not found"}), 404
-            tree_request = {
-                'common_name': row[0],
-                'scientific_name': row[1],
-                'status': row[2],
-                'days_since_planting': row[3],
-                'permit_status': row[4]
-            }
-            return jsonify(tree_request)
+            return jsonify(queries.TREE_REQUEST_DETAILS.shape(row, queries.column_names(cur)))
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
-# Logs in a resident
+# Password checks run on a process pool (passwords.py). When its queue is full, or a worker
+# died and the pool is being restarted, ask the client to retry shortly instead of making it wait.
+def passwords_busy():
+    response = jsonify({"error": "Too many sign-ins in progress, try again shortly"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Logs in a resident. The password is checked here, and the stored hash is never returned.
 @app.route('/api/login', methods=['POST'])
 def login():
     data = request.json
@@ -129,35 +235,47 @@ def login():
         return jsonify({"error": "Request body must be JSON"}), 400
 
     email = data.get('email')
+    password = data.get('password')
+    if not (email and isinstance(password, str) and password):
+        return jsonify({"error": "Missing email or password"}), 400
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('SELECT id, password, first_name, last_name, is_volunteer, street, zip_code, neighborhood FROM residents WHERE email = %s', (email,))
             row = cur.fetchone()
-            close_resources(conn, cur)
-            if not row:
-                return jsonify({"error": "Invalid credentials"}), 404
-            resident = {
-                'id': row[0],
-                'password': row[1],
-                'first_name': row[2],
-                'last_name': row[3],
-                'is_volunteer': row[4],
-                'street': row[5],
-                'zip_code': row[6],
-                'neighborhood': row[7]
-            }
-            return jsonify(resident)
         except Exception as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
-# Registers a resident
+    # Checked after the connection is back in the pool, since it can take a while
+    try:
+        valid, new_hash = passwords.verify_password(row[1] if row else None, password)
+    except (passwords.PasswordBusy, TimeoutError, BrokenProcessPool):
+        return passwords_busy()
+    # Same response for an unknown email and a wrong password
+    if not valid:
+        return jsonify({"error": "Invalid credentials"}), 401
+
+    if new_hash:
+        # Hashed with older Argon2 parameters; store it again with the current ones
+        with db_connection() as conn, conn.cursor() as cur:
+            try:
+                cur.execute('UPDATE residents SET password = %s WHERE id = %s AND password = %s', (new_hash, row[0], row[1]))
+                conn.commit()
+            except psycopg2.Error as e:
+                 print(f"Error: {e}")
+    resident = {
+        'id': row[0],
+        'first_name': row[2],
+        'last_name': row[3],
+        'is_volunteer': row[4],
+        'street': row[5],
+        'zip_code': row[6],
+        'neighborhood': row[7]
+    }
+    return jsonify(resident)
+
+# Registers a resident. Takes the plain password and stores its hash.
 @app.route('/api/register', methods=['POST'])
 def register():
     data = request.json
@@ -165,35 +283,36 @@ def register():
         return jsonify({"error": "Request body must be JSON"}), 400
 
     email = data.get('email')
-    password = data.get('password') # Hashed
+    password = data.get('password')
     first_name = data.get('first_name')
     last_name = data.get('last_name')
     street = data.get('street')
     zip_code = data.get('zip_code')
     neighborhood = data.get('neighborhood')
-    if not (email and first_name and last_name and password and street and zip_code and neighborhood):
+    if not (email and first_name and last_name and isinstance(password, str) and password and street and zip_code
+            and neighborhood):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    try:
+        password_hash = passwords.hash_password(password)
+    except (passwords.PasswordBusy, TimeoutError, BrokenProcessPool):
+        return passwords_busy()
+
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 INSERT INTO residents (email, password, first_name, last_name, street, zip_code, is_volunteer, neighborhood)
                 VALUES (%s, %s, %s, %s, %s, %s, false, %s)
                 RETURNING id
-                         ''', (email, password, first_name, last_name, street, zip_code, neighborhood,))
+                         ''', (email, password_hash, first_name, last_name, street, zip_code, neighborhood,))
             row = cur.fetchone()
             resident_id = row[0]
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('residents')
             return jsonify({"id": resident_id})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e.pgcode}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
   
 # Check if a user is an organization member
 @app.route('/api/is_organization_member', methods=['GET'])
@@ -201,184 +320,101 @@ def is_organization_member():
     user_id = request.args.get('user_id')
     if not user_id:
         return jsonify({"error": "Missing user_id parameter"}), 500
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return jsonify({"error": "user_id must be a whole number"}), 400
 
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('SELECT resident_id FROM organization_members WHERE resident_id = %s', (user_id,))
-            row = cur.fetchone()
-            close_resources(conn, cur)
-
-            if row:
-                return jsonify({"is_organization_member": True})
-            else:
-                return jsonify({"is_organization_member": False})
-        except Exception as e:
-             close_resources(conn, cur)
-             print(f"Error: {e}")
-             return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
+    try:
+        return jsonify(resident_roles([user_id])[0])
+    except psycopg2.Error as e:
+         print(f"Error: {e}")
+         return jsonify({"error": f"Database query failed: {e}"}), 500
+
+# Roles of many residents at once: /api/roles?ids=3,5,8 returns, in that order, whether each is an
+# organization member, their role and whether they are a volunteer
+@app.route('/api/roles')
+def resident_roles_batch():
+    try:
+        ids = parse_id_list(request.args, 'ids')
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
 
-# Get all tree requests (admin only).
+    try:
+        return jsonify(resident_roles(ids))
+    except psycopg2.Error as e:
+         print(f"Error: {e}")
+         return jsonify({"error": f"Database query failed: {e}"}), 500
+
+# Get a page of tree requests (admin only), newest first. Optional filters: status, neighborhood,
+# tree_id, submitted_after and submitted_before (ISO 8601). Pass the X-Next-Cursor response header
+# back as ?cursor= to get the next page.
 @app.route('/api/all-tree-requests')
 def get_all_tree_requests():
-    conn = get_db_connection()
-    if conn:
+    try:
+        query, params, limit = queries.all_tree_requests_page(request.args)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT tr.id,
-                       tr.submission_timestamp,
-                       tr.approved,
-                       get_tree_request_status(tr.id) AS status,
-                       t.common_name,
-                       t.scientific_name
-                FROM tree_requests tr
-                         INNER JOIN trees t ON tr.tree_id = t.id
-                ORDER BY tr.submission_timestamp DESC;
-            ''')
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-            tree_requests = []
-            for row in rows:
-                tree_requests.append({
-                    'id': row[0],
-                    'submission_timestamp': row[1],
-                    'approved': row[2],
-                    'status': row[3],
-                    'common_name': row[4],
-                    'scientific_name': row[5]
-                })
-            return jsonify(tree_requests)
+            statements.execute(cur, query, params)
+            rows, headers = page_headers(cur.fetchall(), limit, 1, 0)
+            return rows_response(query, cur, rows, headers)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
-  
-# Get in-depth details for tree request (admin only)
+
+# Get in-depth details for tree request (admin only). With tree_request_ids=1,2,3 instead,
+# returns a list of them in that order, so a page of requests can be loaded at once.
 @app.route('/api/tree-request-details-admin')
 def get_tree_request_details_admin():
     tree_request_id = request.args.get('tree_request_id')
-    if not tree_request_id:
+    if request.args.get('tree_request_ids'):
+        try:
+            tree_request_ids = parse_id_list(request.args, 'tree_request_ids')
+        except PaginationError as e:
+            return jsonify({"error": str(e)}), 400
+    elif tree_request_id:
+        tree_request_ids = [tree_request_id]
+    else:
         return jsonify({"error": "Missing tree_request_id parameter"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            # Get tree request details
-            cur.execute('''
-                SELECT t.common_name,
-                       t.scientific_name,
-                       t.inventory,
-                       tr.site_description,
-                       r.street,
-                       r.zip_code,
-                       r.neighborhood,
-                       get_tree_request_status(tr.id) AS status
-                FROM tree_requests tr
-                         INNER JOIN trees t ON tr.tree_id = t.id
-                         INNER JOIN residents r ON tr.resident_id = r.id
-                WHERE tr.id = %s;
-            ''', (tree_request_id,))
-            row = cur.fetchone()
-            if not row:
-                close_resources(conn, cur)
+            statements.execute(cur, queries.TREE_REQUEST_DETAILS_ADMIN, (tree_request_ids,))
+            details = [queries.tree_request_details_admin(row, queries.column_names(cur)) for row in cur.fetchall()]
+            if not tree_request_id:
+                return jsonify(details)
+            if not details:
                 return jsonify({"error": "Tree request not found"}), 404
-            tree_request_details = {
-                'tree_common_name': row[0],
-                'tree_scientific_name': row[1],
-                'tree_inventory': row[2],
-                'site_description': row[3],
-                'resident_street': row[4],
-                'resident_zip_code': row[5],
-                'resident_neighborhood': row[6],
-                'status': row[7]
-            }
-            # Get scheduled visits, check if outcome has already been recorded
-            cur.execute('''
-              SELECT sv.event_id,
-                       sv.event_timestamp,
-                       sv.cancelled,
-                       sv.notes,
-                       sv.organization_member_id,
-                       CASE WHEN ve.scheduled_visit_id IS NOT NULL THEN true ELSE false END AS outcome_recorded
-                FROM scheduled_visits sv
-                LEFT JOIN visit_events ve ON sv.event_id = ve.scheduled_visit_id
-                WHERE sv.tree_request_id = %s
-                ORDER BY sv.event_timestamp DESC
-            ''', (tree_request_id,))
-            rows = cur.fetchall()
-            scheduled_visits = []
-            for row in rows:
-                 scheduled_visits.append({
-                    'event_id': row[0],
-                    'event_timestamp': row[1],
-                    'cancelled': row[2],
-                    'notes': row[3],
-                    'organization_member_id': row[4],
-                    'outcome_recorded': row[5]
-                })
-            tree_request_details['scheduled_visits'] = scheduled_visits
-            # Get scheduled plantings, check if outcome has already been recorded
-            cur.execute('''
-                SELECT event_id,
-                       event_timestamp,
-                       cancelled,
-                       notes,
-                       CASE WHEN pe.scheduled_planting_id IS NOT NULL THEN true ELSE false END AS outcome_recorded
-                FROM scheduled_plantings sp
-                LEFT JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
-                WHERE tree_request_id = %s;
-            ''', (tree_request_id,))
-            rows = cur.fetchall()
-            scheduled_plantings = []
-            for row in rows:
-                scheduled_plantings.append({
-                    'event_id': row[0],
-                    'event_timestamp': row[1],
-                    'cancelled': row[2],
-                    'notes': row[3],
-                    'outcome_recorded': row[4]
-                })
-            tree_request_details['scheduled_plantings'] = scheduled_plantings
-            close_resources(conn, cur)
-            return jsonify(tree_request_details)
+            return jsonify(details[0])
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500     
 
 # Get all trees
 @app.route('/api/trees')
+@report_cache.snapshot('trees')
 def get_trees():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('SELECT id, common_name, scientific_name, inventory FROM trees ORDER BY common_name;')
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-
-            trees = []
-            for row in rows:
-                trees.append({
-                    'id': row[0],
-                    'common_name': row[1],
-                    'scientific_name': row[2],
-                    'inventory': row[3]
-                })
-
-            return jsonify(trees)
+            statements.execute(cur, queries.TREES)
+            return rows_response(queries.TREES, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
+
+# Search the tree catalog by height/width range and facets (drought tolerance, growth rate,
+# foliage, site flags, visual attraction), most available first, with a count for each facet
+# value. e.g. /api/trees/search?max_height=30&growth_rate=fast&native_to_ca=true&limit=5
+@app.route('/api/trees/search')
+def search_trees():
+    try:
+        filters = catalog.parse_search_args(request.args.to_dict(flat=False))
+    except catalog.SearchError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return jsonify(current_tree_catalog().search(filters))
+    except psycopg2.Error as e:
+         return jsonify({"error": f"Database query failed: {e}"}), 500
 
 # Get all tree requests for a specific resident_id
 @app.route('/api/tree-request', methods=['POST'])
@@ -393,10 +429,8 @@ def create_tree_request():
     if not (resident_id and tree_id and site_description):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 INSERT INTO tree_requests (resident_id, tree_id, site_description, submission_timestamp, approved)
                 VALUES (%s, %s, %s, NOW(), NULL)
@@ -411,36 +445,22 @@ def create_tree_request():
                          ''', (resident_id, new_tree_request_id,))
             # row = cur.fetchone()
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('tree_requests', 'permits')
             return jsonify({"id": new_tree_request_id})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Get all neighborhoods
 @app.route('/api/neighborhoods')
+@report_cache.snapshot('neighborhoods')
 def get_neighborhoods():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('SELECT name FROM neighborhoods ORDER BY name;')
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-
-            neighborhoods = []
-            for row in rows:
-                neighborhoods.append(row[0])
-
-            return jsonify(neighborhoods)
+            statements.execute(cur, queries.NEIGHBORHOODS)
+            return rows_response(queries.NEIGHBORHOODS, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Update permit status
 @app.route('/api/update-permit-status', methods=['PATCH'])
@@ -454,24 +474,19 @@ def update_permit_status():
     if not (tree_request_id and status):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 UPDATE permits
                 SET status = %s, decision_date = NOW()
                 WHERE tree_request_id = %s
                          ''', (status, tree_request_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('permits')
             return jsonify({"message": "Permit status updated successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Submit a volunteer request. body is {user_id, notes}
 @app.route('/api/volunteer-requests', methods=['POST'])
@@ -485,23 +500,18 @@ def create_volunteer_request():
     if not (user_id):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 INSERT INTO volunteer_applications (resident_id, created, approved, notes)
                 VALUES (%s, NOW(), NULL, %s)
                          ''', (user_id, notes,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('volunteer_applications')
             return jsonify({"message": "Volunteer request submitted successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Schedule a visit
 @app.route('/api/schedule-visit', methods=['POST'])
@@ -517,23 +527,20 @@ def schedule_visit():
     if not (tree_request_id and timestamp and organization_member_id):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
+            # Creates the partition for the event's year if this is the first event in it
+            cur.execute('SELECT ensure_scheduled_event_partition(%s);', (timestamp,))
             cur.execute('''
                 INSERT INTO scheduled_visits (tree_request_id, event_timestamp, cancelled, notes, organization_member_id)
                 VALUES (%s, %s, false, %s, %s)
                          ''', (tree_request_id, timestamp, notes, organization_member_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('scheduled_visits')
             return jsonify({"message": "Visit scheduled successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Approve a request for a tree
 @app.route('/api/accept-tree-request', methods=['PATCH'])
@@ -546,24 +553,19 @@ def accept_tree_request():
     if not tree_request_id:
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 UPDATE tree_requests
                 SET approved = true
                 WHERE id = %s
                          ''', (tree_request_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('tree_requests')
             return jsonify({"message": "Tree request accepted successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Deny a request for a tree
 @app.route('/api/deny-tree-request', methods=['PATCH'])
@@ -576,25 +578,20 @@ def deny_tree_request():
     if not tree_request_id:
         return jsonify({"error": "Missing tree_request_id parameter"}), 400 # Changed status code to 400
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 UPDATE tree_requests
                 SET approved = false
                 WHERE id = %s
                          ''', (tree_request_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('tree_requests')
             return jsonify({"message": "Tree request denied successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              # Use e.pgcode for specific DB errors if needed, otherwise a generic 500
              return jsonify({"error": "Database error occurred"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 @app.route('/api/cancel-visit', methods=['PATCH'])
 def cancel_visit():
@@ -606,24 +603,19 @@ def cancel_visit():
     if not event_id:
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 UPDATE scheduled_visits
                 SET cancelled = true
                 WHERE id = %s
                          ''', (event_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('scheduled_visits')
             return jsonify({"message": "Visit cancelled successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Record info gathered from a visit
 @app.route('/api/visit-events', methods=['POST'])
@@ -640,23 +632,18 @@ def create_visit_event():
     if not scheduled_visit_id:
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 INSERT INTO visit_events (scheduled_visit_id, observations, photo_library_link, additional_visit_required)
                 VALUES (%s, %s, %s, %s)
                          ''', (scheduled_visit_id, observations, photo_library_link, additional_visit_required,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('visit_events')
             return jsonify({"message": "Visit event created successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Schedule a planting (without any org members or volunteers yet)
 @app.route('/api/schedule-planting', methods=['POST'])
@@ -671,23 +658,20 @@ def schedule_planting():
     if not (tree_request_id and timestamp):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
+            # Creates the partition for the event's year if this is the first event in it
+            cur.execute('SELECT ensure_scheduled_event_partition(%s);', (timestamp,))
             cur.execute('''
                 INSERT INTO scheduled_plantings (tree_request_id, event_timestamp, cancelled, notes)
                 VALUES (%s, %s, false, %s)
                          ''', (tree_request_id, timestamp, notes,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('scheduled_plantings')
             return jsonify({"message": "Planting scheduled successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Add an org member to a scheduled planting
 @app.route('/api/add-org-member-to-planting', methods=['POST'])
@@ -701,23 +685,18 @@ def add_org_member_to_planting():
     if not (organization_member_id and scheduled_planting_id):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 INSERT INTO organization_members_lead_scheduled_plantings (organization_member_id, scheduled_planting_id)
                 VALUES (%s, %s)
                          ''', (organization_member_id, scheduled_planting_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('organization_members_lead_scheduled_plantings')
             return jsonify({"message": "Organization member added to planting successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Add a volunteer to a scheduled planting
 @app.route('/api/add-volunteer-to-planting', methods=['POST'])
@@ -731,23 +710,132 @@ def add_volunteer_to_planting():
     if not (volunteer_id and planting_event_id):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 INSERT INTO scheduled_plantings_have_volunteers (volunteer_id, planting_event_id)
                 VALUES (%s, %s)
                          ''', (volunteer_id, planting_event_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('scheduled_plantings_have_volunteers')
             return jsonify({"message": "Volunteer added to planting successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
+
+# Add and remove the crew of a scheduled planting in one transaction. Takes scheduled_planting_id and
+# any of add_org_member_ids, remove_org_member_ids, add_volunteer_ids and remove_volunteer_ids. Ids
+# that cannot be applied (already assigned, not a volunteer, ...) are listed in "conflicts" and do
+# not stop the rest from being applied.
+@app.route('/api/planting-crew', methods=['POST'])
+def update_planting_crew():
+    data = request.json
+    if not data:
+        return jsonify({"error": "Request body must be JSON"}), 400
+
+    scheduled_planting_id = data.get('scheduled_planting_id')
+    if not scheduled_planting_id:
+        return jsonify({"error": "Missing scheduled_planting_id parameter"}), 400
+    crew = {}
+    for key in ('add_org_member_ids', 'remove_org_member_ids', 'add_volunteer_ids', 'remove_volunteer_ids'):
+        ids = data.get(key) or []
+        if not (isinstance(ids, list) and all(isinstance(i, int) and not isinstance(i, bool) for i in ids)):
+            return jsonify({"error": f"{key} must be a list of ids"}), 400
+        crew[key] = sorted(set(ids))
+    for kind in ('org_member', 'volunteer'):
+        both = set(crew[f'add_{kind}_ids']) & set(crew[f'remove_{kind}_ids'])
+        if both:
+            return jsonify({"error": f"Ids both added and removed: {sorted(both)}"}), 400
+
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            cur.execute('SELECT 1 FROM scheduled_plantings WHERE event_id = %s;', (scheduled_planting_id,))
+            if cur.fetchone() is None:
+                return jsonify({"error": "Scheduled planting not found"}), 404
+
+            # Classify every requested id, then insert/delete the ones without a conflict. ON CONFLICT
+            # covers a concurrent request assigning the same person between the check and the insert.
+            cur.execute('''
+                WITH add_members AS (SELECT m.id,
+                                            CASE
+                                                WHEN om.resident_id IS NULL THEN 'not an organization member'
+                                                WHEN l.organization_member_id IS NOT NULL THEN 'already assigned'
+                                            END AS conflict
+                                     FROM unnest(%(add_org_member_ids)s::INTEGER[]) AS m(id)
+                                              LEFT JOIN organization_members om ON om.resident_id = m.id
+                                              LEFT JOIN organization_members_lead_scheduled_plantings l
+                                                        ON l.organization_member_id = m.id
+                                                            AND l.scheduled_planting_id = %(planting)s),
+                     added_members AS (
+                         INSERT INTO organization_members_lead_scheduled_plantings (organization_member_id, scheduled_planting_id)
+                             SELECT id, %(planting)s FROM add_members WHERE conflict IS NULL
+                             ON CONFLICT DO NOTHING
+                             RETURNING organization_member_id),
+                     removed_members AS (
+                         DELETE FROM organization_members_lead_scheduled_plantings
+                             WHERE scheduled_planting_id = %(planting)s
+                                 AND organization_member_id = ANY (%(remove_org_member_ids)s::INTEGER[])
+                             RETURNING organization_member_id),
+                     add_volunteers AS (SELECT v.id,
+                                               CASE
+                                                   WHEN r.is_volunteer IS NOT TRUE THEN 'not a volunteer'
+                                                   WHEN spv.volunteer_id IS NOT NULL THEN 'already assigned'
+                                               END AS conflict
+                                        FROM unnest(%(add_volunteer_ids)s::INTEGER[]) AS v(id)
+                                                 LEFT JOIN residents r ON r.id = v.id
+                                                 LEFT JOIN scheduled_plantings_have_volunteers spv
+                                                           ON spv.volunteer_id = v.id
+                                                               AND spv.planting_event_id = %(planting)s),
+                     added_volunteers AS (
+                         INSERT INTO scheduled_plantings_have_volunteers (planting_event_id, volunteer_id)
+                             SELECT %(planting)s, id FROM add_volunteers WHERE conflict IS NULL
+                             ON CONFLICT DO NOTHING
+                             RETURNING volunteer_id),
+                     removed_volunteers AS (
+                         DELETE FROM scheduled_plantings_have_volunteers
+                             WHERE planting_event_id = %(planting)s
+                                 AND volunteer_id = ANY (%(remove_volunteer_ids)s::INTEGER[])
+                             RETURNING volunteer_id)
+                SELECT 'org_member', 'add', m.id,
+                       COALESCE(m.conflict, CASE WHEN a.organization_member_id IS NULL THEN 'already assigned' END)
+                FROM add_members m
+                         LEFT JOIN added_members a ON a.organization_member_id = m.id
+                UNION ALL
+                SELECT 'org_member', 'remove', m.id, CASE WHEN d.organization_member_id IS NULL THEN 'not assigned' END
+                FROM unnest(%(remove_org_member_ids)s::INTEGER[]) AS m(id)
+                         LEFT JOIN removed_members d ON d.organization_member_id = m.id
+                UNION ALL
+                SELECT 'volunteer', 'add', v.id,
+                       COALESCE(v.conflict, CASE WHEN a.volunteer_id IS NULL THEN 'already assigned' END)
+                FROM add_volunteers v
+                         LEFT JOIN added_volunteers a ON a.volunteer_id = v.id
+                UNION ALL
+                SELECT 'volunteer', 'remove', v.id, CASE WHEN d.volunteer_id IS NULL THEN 'not assigned' END
+                FROM unnest(%(remove_volunteer_ids)s::INTEGER[]) AS v(id)
+                         LEFT JOIN removed_volunteers d ON d.volunteer_id = v.id;
+            ''', {'planting': scheduled_planting_id, **crew})
+            rows = cur.fetchall()
+            conn.commit()
+
+            result = {
+                'scheduled_planting_id': scheduled_planting_id,
+                'org_members': {'added': [], 'removed': []},
+                'volunteers': {'added': [], 'removed': []},
+                'conflicts': []
+            }
+            for kind, action, person_id, conflict in rows:
+                if conflict:
+                    result['conflicts'].append({'type': kind, 'action': action, 'id': person_id, 'reason': conflict})
+                else:
+                    result[kind + 's']['added' if action == 'add' else 'removed'].append(person_id)
+            if result['org_members']['added'] or result['org_members']['removed']:
+                report_cache.bump('organization_members_lead_scheduled_plantings')
+            if result['volunteers']['added'] or result['volunteers']['removed']:
+                report_cache.bump('scheduled_plantings_have_volunteers')
+            return jsonify(result)
+        except psycopg2.Error as e:
+             print(f"Error: {e}")
+             return jsonify({"error": e.pgcode}), 500
 
 # Record info after a scheduled planting
 @app.route('/api/new-planting-event', methods=['POST'])
@@ -764,10 +852,8 @@ def create_planting_event():
     if not (scheduled_planting_id):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
              # Insert into planting_events
             cur.execute('''
                 INSERT INTO planting_events (scheduled_planting_id, observations, successful, before_photos_library_link, after_photos_library_link)
@@ -793,14 +879,85 @@ def create_planting_event():
                 ''', (tree_id,))
 
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('planting_events', 'trees')
             return jsonify({"message": "Planting event created successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
+
+# Record the outcome of a scheduled planting, who attended, and (if it was successful) take the tree
+# out of inventory, all in one statement. Returns the tree's inventory afterwards.
+@app.route('/api/planting-outcome', methods=['POST'])
+def record_planting_outcome():
+    data = request.json
+    if not data:
+        return jsonify({"error": "Request body must be JSON"}), 400
+
+    scheduled_planting_id = data.get('scheduled_planting_id')
+    attended_volunteer_ids = data.get('attended_volunteer_ids') or []
+    if not scheduled_planting_id:
+        return jsonify({"error": "Missing scheduled_planting_id parameter"}), 400
+    if not (isinstance(attended_volunteer_ids, list)
+            and all(isinstance(i, int) and not isinstance(i, bool) for i in attended_volunteer_ids)):
+        return jsonify({"error": "attended_volunteer_ids must be a list of ids"}), 400
+
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            # The final SELECT reads trees as of the start of the statement, so the decremented
+            # inventory comes from the UPDATE's RETURNING when there was one.
+            cur.execute('''
+                WITH event AS (
+                    INSERT INTO planting_events (scheduled_planting_id, observations, successful,
+                                                 before_photos_library_link, after_photos_library_link)
+                        VALUES (%(planting)s, %(observations)s, %(successful)s, %(before)s, %(after)s)
+                        RETURNING scheduled_planting_id, successful),
+                     attendance AS (
+                         INSERT INTO planting_events_have_volunteers (planting_event_id, volunteer_id)
+                             SELECT e.scheduled_planting_id, v.id
+                             FROM event e
+                                      CROSS JOIN unnest(%(volunteers)s::INTEGER[]) AS v(id)
+                             RETURNING volunteer_id),
+                     decremented AS (
+                         UPDATE trees t
+                             SET inventory = t.inventory - 1
+                             FROM event e
+                                 INNER JOIN scheduled_plantings sp ON sp.event_id = e.scheduled_planting_id
+                                 INNER JOIN tree_requests tr ON tr.id = sp.tree_request_id
+                             WHERE e.successful
+                                 AND t.id = tr.tree_id
+                                 AND t.inventory > 0
+                             RETURNING t.inventory)
+                SELECT t.id,
+                       COALESCE((SELECT inventory FROM decremented), t.inventory),
+                       (SELECT COUNT(*) FROM attendance)
+                FROM event e
+                         INNER JOIN scheduled_plantings sp ON sp.event_id = e.scheduled_planting_id
+                         INNER JOIN tree_requests tr ON tr.id = sp.tree_request_id
+                         INNER JOIN trees t ON t.id = tr.tree_id;
+            ''', {
+                'planting': scheduled_planting_id,
+                'observations': data.get('observations'),
+                'successful': bool(data.get('successful', False)),
+                'before': data.get('before_photos_library_link'),
+                'after': data.get('after_photos_library_link'),
+                'volunteers': sorted(set(attended_volunteer_ids))
+            })
+            tree_id, inventory, attendees = cur.fetchone()
+            conn.commit()
+            report_cache.bump('planting_events', 'planting_events_have_volunteers', 'trees')
+            return jsonify({
+                "message": "Planting outcome recorded successfully",
+                "tree_id": tree_id,
+                "inventory": inventory,
+                "attendees": attendees
+            })
+        except psycopg2.errors.UniqueViolation:
+             return jsonify({"error": "An outcome has already been recorded for this planting"}), 409
+        except psycopg2.errors.ForeignKeyViolation as e:
+             return jsonify({"error": f"Unknown scheduled planting or volunteer: {e.diag.message_detail}"}), 400
+        except psycopg2.Error as e:
+             print(f"Error: {e}")
+             return jsonify({"error": e.pgcode}), 500
 
 # Add a volunteer that actually participated
 @app.route('/api/add-volunteer-to-planting-event', methods=['POST'])
@@ -814,23 +971,18 @@ def add_volunteer_to_planting_event():
     if not (volunteer_id and planting_event_id):
         return jsonify({"error": "Missing some parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 INSERT INTO planting_events_have_volunteers (planting_event_id, volunteer_id)
                 VALUES (%s, %s)
                          ''', (planting_event_id, volunteer_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('planting_events_have_volunteers')
             return jsonify({"message": "Volunteer added to planting event successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Update the inventory for a tree
 @app.route('/api/update-tree-inventory', methods=['PATCH'])
@@ -844,107 +996,71 @@ def update_tree_inventory():
     if tree_id is None or inventory is None:
         return jsonify({"error": "Missing 'tree_id' or 'inventory' parameter"}), 400
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 UPDATE trees
                 SET inventory = %s
                 WHERE id = %s
                          ''', (inventory, tree_id,))
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('trees')
             return jsonify({"message": "Tree inventory updated successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error: {e}")
              return jsonify({"error": e.pgcode}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
+
+# Add and update trees in bulk from a nursery feed (CSV with a header of trees columns, see
+# tree_import.py), sent as the request body or as a "file" upload. Invalid rows are skipped and
+# listed under "rejections". ?dry_run=true checks the feed without saving anything.
+@app.route('/api/trees/import', methods=['POST'])
+def import_trees():
+    feed = request.files.get('file')
+    stream = feed.stream if feed else request.stream
+    dry_run = request.args.get('dry_run', 'false').lower() == 'true'
+
+    with db_connection() as conn:
+        try:
+            result = tree_import.import_trees(conn, stream, dry_run=dry_run)
+        except tree_import.FeedError as e:
+            return jsonify({"error": str(e)}), 400
+        except psycopg2.Error as e:
+             print(f"Error: {e}")
+             return jsonify({"error": e.pgcode}), 500
+    if not dry_run:
+        report_cache.bump('trees')
+    return jsonify(result)
 
 # --- QUERY REPORTS ---
 # Task 1
 # For all requests to plant a tree that have not yet completed, show its status, and the number of
 # days that has transpired since it was first submitted.
 @app.route('/api/tree-requests-status')
+@cached_report('tree-requests-status')
 def get_tree_requests_status():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT id,
-                       get_tree_request_status(id)               AS status,
-                       CURRENT_DATE - submission_timestamp::DATE AS days_since_submission
-                FROM tree_requests tr
-                WHERE get_tree_request_status(id) <> 'completed';
-            ''')
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-
-            tree_requests = []
-            for row in rows:
-                tree_requests.append({
-                    'id': row[0],
-                    'status': row[1],
-                    'days_since_submission': row[2]
-                })
-
-            return jsonify(tree_requests)
+            statements.execute(cur, queries.TREE_REQUESTS_STATUS)
+            return rows_response(queries.TREE_REQUESTS_STATUS, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Task 2
 # Find all trees planted within a selection of Oakland neighborhoods specified by a
 # user in the app. Parameterized neighbor value to allow for user input.
 @app.route('/api/trees-planted')
+@cached_report('trees-planted')
 def get_trees_planted():
     neighborhood = request.args.get('neighborhood')
     if not neighborhood:
         return jsonify({"error": "Missing neighborhood parameter"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT t.common_name,
-                       COUNT(*) AS number_of_trees
-                FROM neighborhoods n
-                         INNER JOIN residents r
-                                    ON n.name = r.neighborhood
-                         INNER JOIN tree_requests tr
-                                    ON r.id = tr.resident_id
-                         INNER JOIN scheduled_plantings sp
-                                    ON tr.id = sp.tree_request_id
-                         INNER JOIN planting_events pe
-                                    ON sp.event_id = pe.scheduled_planting_id
-                                        AND pe.successful = TRUE
-                         INNER JOIN trees t
-                                    ON tr.tree_id = t.id
-                WHERE n.name = %s
-                GROUP BY t.common_name;
-            ''', (neighborhood,))
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-
-            trees_planted = []
-            for row in rows:
-                trees_planted.append({
-                    'common_name': row[0],
-                    'number_of_trees': row[1]
-                })
-
-            return jsonify(trees_planted)
+            statements.execute(cur, queries.TREES_PLANTED, (neighborhood,))
+            return rows_response(queries.TREES_PLANTED, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Task 3
 # For every species of trees, find the number of trees planted and some basic statistics on when
@@ -953,138 +1069,30 @@ def get_trees_planted():
 # year that had the most trees of the species planted and the number of trees planted.
 # https://www.scaler.com/topics/datediff-in-postgresql/
 @app.route('/api/tree-species-statistics')
+@cached_report('tree-species-statistics')
 def get_tree_species_statistics():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT t.common_name,
-                       COUNT(pe)                                                                       AS number_of_trees_planted,
-                       MIN(EXTRACT(YEAR FROM CURRENT_DATE) - EXTRACT(YEAR FROM sp.event_timestamp::TIMESTAMP)) AS years_since_planting,
-                       (SELECT
-                            EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-                        FROM
-                            trees AS t2
-                                INNER JOIN tree_requests ON t2.id = tree_requests.tree_id
-                                INNER JOIN scheduled_plantings sp2 ON tree_requests.id = sp2.tree_request_id
-                                INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
-                        WHERE
-                              t2.id = t.id
-                            AND pe2.successful = TRUE
-                        GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-                        ORDER BY COUNT(*) DESC
-                        LIMIT 1)                                                                          AS year_most_planted,
-                       (SELECT
-                            COUNT(*)
-                        FROM
-                            trees AS t2
-                                INNER JOIN tree_requests ON t2.id = tree_requests.tree_id
-                                INNER JOIN scheduled_plantings sp2 ON tree_requests.id = sp2.tree_request_id
-                                INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
-                        WHERE
-                              t2.id = t.id
-                            AND pe2.successful = TRUE
-                        GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-                        ORDER BY COUNT(*) DESC
-                        LIMIT 1)                                                                          AS num_planted_in_peak_year
-                FROM trees t
-                    INNER JOIN tree_requests tr ON t.id = tr.tree_id
-                    INNER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
-                    INNER JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
-                WHERE pe.successful = TRUE
-                GROUP BY t.common_name, t.id;
-            ''')
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-
-            tree_species_statistics = []
-            for row in rows:
-                tree_species_statistics.append({
-                    'common_name': row[0],
-                    'number_of_trees_planted': row[1],
-                    'years_since_planting': row[2],
-                    'year_most_planted':
-                        row[3],
-                    'num_planted_in_peak_year': row[4]
-                })
-            return jsonify(tree_species_statistics)
+            statements.execute(cur, queries.TREE_SPECIES_STATISTICS)
+            return rows_response(queries.TREE_SPECIES_STATISTICS, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Task 4
 # For each Oakland neighborhood, create a report that summarizes the requests, their progress
 # (pending, in-process, completed, ec), the trees planted, etc. This is an opportunity for your
 # team to demonstrate your skills, so it's expected that you'll demonstrate sophisticated database
 # querying skills
+# Served from the neighborhood_status_counts rollup, see ddl.sql
 @app.route('/api/neighborhood-report')
+@cached_report('neighborhood-report')
 def get_neighborhood_report():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-SELECT n.name AS neighborhood_name,
-       COUNT (spe) AS num_of_planted_trees,
-       COUNT(tr) AS num_of_requests,
-       COUNT(ctr) AS num_of_completed_requests,
-       COUNT(wfptr) AS num_of_requests_waiting_for_planting,
-       COUNT(wfvtr) AS num_of_requests_waiting_for_visit,
-       COUNT(nptr) AS num_of_requests_needs_permit,
-       COUNT(dtr) AS num_of_denied_requests,
-       COUNT(patr) AS num_of_requests_pending_approval
-FROM neighborhoods n
-    INNER JOIN residents r
-               ON n.name = r.neighborhood
-    INNER JOIN tree_requests tr
-               ON r.id = tr.resident_id
-    LEFT OUTER JOIN scheduled_plantings sp
-                ON tr.id = sp.tree_request_id
-    LEFT OUTER JOIN planting_events spe
-                        ON sp.event_id = spe.scheduled_planting_id
-                               AND spe.successful = TRUE
-    INNER JOIN trees t
-               ON tr.tree_id = t.id
-    LEFT OUTER JOIN tree_requests ctr ON tr.id = ctr.id
-        AND get_tree_request_status(ctr.id) = 'completed'
-    LEFT OUTER JOIN tree_requests wfptr ON tr.id = wfptr.id
-        AND get_tree_request_status(wfptr.id) = 'waiting for planting'
-    LEFT OUTER JOIN tree_requests wfvtr ON tr.id = wfvtr.id
-        AND get_tree_request_status(wfvtr.id) = 'waiting for visit'
-    LEFT OUTER JOIN tree_requests nptr ON tr.id = nptr.id
-        AND get_tree_request_status(nptr.id) = 'needs permit'
-    LEFT OUTER JOIN tree_requests dtr ON tr.id = dtr.id
-        AND get_tree_request_status(dtr.id) = 'denied'
-    LEFT OUTER JOIN tree_requests patr ON tr.id = patr.id
-        AND get_tree_request_status(patr.id) = 'pending approval'
-GROUP BY neighborhood_name
-ORDER BY neighborhood_name ASC;
-            ''')
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-
-            neighborhood_report = []
-            for row in rows:
-                neighborhood_report.append({
-                    'neighborhood_name': row[0],
-                    'num_of_planted_trees': row[1],
-                    'num_of_requests': row[2],
-                    'num_of_completed_requests': row[3],
-                    'num_of_requests_waiting_for_planting': row[4],
-                    'num_of_requests_waiting_for_visit': row[5],
-                    'num_of_requests_needs_permit': row[6],
-                    'num_of_denied_requests': row[7],
-                    'num_of_requests_pending_approval': row[8]
-                })
-            return jsonify(neighborhood_report)
+            statements.execute(cur, queries.NEIGHBORHOOD_REPORT)
+            return rows_response(queries.NEIGHBORHOOD_REPORT, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Custom report 1
 # -- The following link helped me figure out how to extract that year from a timestamp
@@ -1097,77 +1105,18 @@ ORDER BY neighborhood_name ASC;
 # -- data for whichever year they desire, this parameterization allows for the organization to track the impact and activity
 # -- of  of each volunteer more clearly.
 @app.route('/api/custom-report-1')
+@cached_report('custom-report-1')
 def get_custom_report_1():
     year = request.args.get('year')
     if not year:
         return jsonify({"error": "Missing year parameter"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-SELECT
-    r.first_name || ' ' || r.last_name AS volunteer_name,
-    MIN(sp.event_timestamp)            AS first_planting,
-    MAX(sp.event_timestamp)            AS most_recent_planting,
-    COUNT(pev)                         AS trees_planted,
-    (SELECT
-         EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     FROM
-         planting_events_have_volunteers AS pev2
-             INNER JOIN planting_events AS p2 ON pev2.planting_event_id = p2.scheduled_planting_id
-             INNER JOIN scheduled_plantings AS sp2 ON p2.scheduled_planting_id = sp2.event_id
-     WHERE
-         pev2.volunteer_id = r.id
-     GROUP BY
-         EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     ORDER BY COUNT(*) DESC
-     LIMIT 1)                          AS peak_year,
-    (SELECT
-         COUNT(*)
-     FROM
-         planting_events_have_volunteers pev2
-             INNER JOIN planting_events AS p2 ON pev2.planting_event_id = p2.scheduled_planting_id
-             INNER JOIN scheduled_plantings AS sp2 ON p2.scheduled_planting_id = sp2.event_id
-     WHERE
-         pev2.volunteer_id = r.id
-     GROUP BY
-         EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     ORDER BY COUNT(*) DESC
-     LIMIT 1)                          AS trees_planted_in_peak_year
-FROM
-    residents AS r
-        INNER JOIN planting_events_have_volunteers AS pev ON r.id = pev.volunteer_id
-        INNER JOIN planting_events AS pe ON pev.planting_event_id = pe.scheduled_planting_id
-        INNER JOIN scheduled_plantings AS sp ON pe.scheduled_planting_id = sp.event_id
-WHERE
-      r.is_volunteer = TRUE
-  AND pe.successful = TRUE
-  AND EXTRACT(YEAR FROM sp.event_timestamp::TIMESTAMP) = %s
-GROUP BY r.first_name, r.last_name, r.id
-ORDER BY trees_planted DESC, trees_planted_in_peak_year DESC;
-
-                                    ''', (year,))
-            rows = cur
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-            custom_report_1 = []
-            for row in rows:    
-                custom_report_1.append({
-                    'volunteer_name': row[0],
-                    'first_planting': row[1],
-                    'most_recent_planting': row[2],
-                    'trees_planted': row[3],
-                    'peak_year': row[4],
-                    'trees_planted_in_peak_year': row[5]
-                })
-            return jsonify(custom_report_1)
+            statements.execute(cur, queries.CUSTOM_REPORT_1, (year,))
+            return rows_response(queries.CUSTOM_REPORT_1, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 # Custom report 2
 # -- The following query gives us a report regarding the organization members that lead plantings and attend visits; it
 # -- displays the amount of plantings they've led, visits they've attended, their peak years and activity for both plantings
@@ -1176,100 +1125,18 @@ ORDER BY trees_planted DESC, trees_planted_in_peak_year DESC;
 # -- year they desire, this parameterization allows for the organization to track the activity and success of each organization
 # -- member more clearly.
 @app.route('/api/custom-report-2')
+@cached_report('custom-report-2')
 def get_custom_report_2():
     year = request.args.get('year')
     if not year:
         return jsonify({"error": "Missing year parameter"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-              SELECT
-    r.first_name || ' ' || r.last_name AS org_member_name,
-    COUNT(sp) AS plantings_led,
-    COUNT(pe) AS successful_plantings_led,
-    (SELECT
-         EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     FROM
-         organization_members_lead_scheduled_plantings AS ompe2
-             INNER JOIN scheduled_plantings sp2 ON ompe2.scheduled_planting_id = sp2.event_id
-             INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
-     WHERE
-             ompe2.organization_member_id = om.resident_id
-         AND pe2.successful = TRUE
-     GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     ORDER BY COUNT(*) DESC
-     LIMIT 1)   AS plantings_led_peak_year,
-    (SELECT
-         COUNT(*)
-     FROM
-         organization_members_lead_scheduled_plantings AS ompe2
-             INNER JOIN scheduled_plantings sp2 ON ompe2.scheduled_planting_id = sp2.event_id
-             INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
-     WHERE
-             ompe2.organization_member_id = om.resident_id
-         AND pe2.successful = TRUE
-     GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     ORDER BY COUNT(*) DESC
-     LIMIT 1)   AS plantings_led_in_peak_year,
-    COUNT(sv)   AS visits_attended,
-    (SELECT
-         EXTRACT(YEAR FROM sv2.event_timestamp::TIMESTAMP)
-     FROM
-         scheduled_visits AS sv2
-     WHERE
-             sv2.organization_member_id = om.resident_id
-         AND sv2.cancelled = FALSE
-     GROUP BY EXTRACT(YEAR FROM sv2.event_timestamp::TIMESTAMP)
-     ORDER BY COUNT(*) DESC
-     LIMIT 1)   AS visits_attended_peak_year,
-    (SELECT
-         COUNT(*)
-     FROM
-         scheduled_visits AS sv2
-     WHERE
-           sv2.organization_member_id = om.resident_id
-       AND sv2.cancelled = FALSE
-     GROUP BY EXTRACT(YEAR FROM sv2.event_timestamp::TIMESTAMP)
-     ORDER BY COUNT(*) DESC
-     LIMIT 1)   AS visits_attended_in_peak_year
-FROM
-    organization_members AS om
-        INNER JOIN residents AS r ON om.resident_id = r.id
-        LEFT OUTER JOIN organization_members_lead_scheduled_plantings AS ompe ON om.resident_id = ompe.organization_member_id
-        LEFT OUTER JOIN scheduled_visits AS sv ON om.resident_id = sv.organization_member_id
-                                                      AND sv.cancelled = FALSE
-                                                      AND EXTRACT(YEAR FROM sv.event_timestamp::TIMESTAMP) = %s
-        INNER JOIN scheduled_plantings AS sp ON ompe.scheduled_planting_id = sp.event_id
-        LEFT OUTER JOIN planting_events AS pe ON sp.event_id = pe.scheduled_planting_id AND pe.successful = TRUE
-WHERE
-        sp.cancelled = FALSE
-    AND EXTRACT(YEAR FROM sp.event_timestamp::TIMESTAMP) = %s
-GROUP BY r.first_name, r.last_name, r.id, om.resident_id
-ORDER BY plantings_led DESC, visits_attended DESC;
-            ''', (year, year))
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-            custom_report_2 = []
-            for row in rows:
-                custom_report_2.append({
-                    'org_member_name': row[0],
-                    'plantings_led': row[1],
-                    'successful_plantings_led': row[2],
-                    'plantings_led_peak_year': row[3],
-                    'plantings_led_in_peak_year': row[4],
-                    'visits_attended': row[5],
-                    'visits_attended_peak_year': row[6],
-                    'visits_attended_in_peak_year': row[7]
-                })
-            return jsonify(custom_report_2)
+            statements.execute(cur, queries.CUSTOM_REPORT_2, (year,))
+            return rows_response(queries.CUSTOM_REPORT_2, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Custom report 3
 # -- The following query gives us a report regarding the total number of trees planted in neighborhood where they have been
@@ -1278,97 +1145,18 @@ ORDER BY plantings_led DESC, visits_attended DESC;
 # -- track of where the planted trees have gone, and monitor the amount that gets planted in each neighborhood. The query
 # -- is parameterized via the common name of the tree, so that data can be accessed and looked through efficiently.
 @app.route('/api/custom-report-3')
+@cached_report('custom-report-3')
 def get_custom_report_3():
     common_name = request.args.get('common_name')
     if not common_name:
         return jsonify({"error": "Missing common name parameter"}), 500
 
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-            SELECT
-    t.common_name,
-    r.neighborhood,
-    (SELECT
-         COUNT(*)
-     FROM
-         tree_requests AS tr2
-             INNER JOIN residents AS r2 ON tr2.resident_id = r2.id
-             INNER JOIN scheduled_plantings sp2 ON tr2.id = sp2.tree_request_id
-             INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
-     WHERE
-           r2.neighborhood = r.neighborhood
-       AND tr2.tree_id = t.id
-       AND pe2.successful = TRUE) AS num_in_neighborhood,
-    (SELECT
-         COUNT(*)
-     FROM    tree_requests AS tr2
-                 INNER JOIN residents AS r2 ON tr2.resident_id = r2.id
-                 INNER JOIN scheduled_plantings AS sp2 ON tr2.id = sp2.tree_request_id
-                 INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
-     WHERE
-           r2.neighborhood = r.neighborhood
-       AND pe2.successful = TRUE
-       AND EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP) = EXTRACT(YEAR FROM CURRENT_DATE::DATE)) AS num_planted_this_year,
-    (SELECT
-         EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     FROM
-         tree_requests AS tr2
-             INNER JOIN residents AS r2 ON tr2.resident_id = r2.id
-             INNER JOIN scheduled_plantings AS sp2 ON tr2.id = sp2.tree_request_id
-             INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
-     WHERE
-           r2.neighborhood = r.neighborhood
-       AND pe2.successful = TRUE
-     GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     ORDER BY COUNT(*) DESC
-     LIMIT 1)                   AS plantings_peak_year,
-    (SELECT
-         COUNT(*)
-     FROM
-         tree_requests AS tr2
-             INNER JOIN residents AS r2 ON tr2.resident_id = r2.id
-             INNER JOIN scheduled_plantings AS sp2 ON tr2.id = sp2.tree_request_id
-             INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
-     WHERE
-           r2.neighborhood = r.neighborhood
-       AND pe2.successful = TRUE
-     GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
-     ORDER BY COUNT(*) DESC
-     LIMIT 1)                   AS plantings_in_peak_year
-FROM
-    trees AS t
-        INNER JOIN public.tree_requests tr ON t.id = tr.tree_id
-        INNER JOIN residents r ON tr.resident_id = r.id
-        INNER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
-        INNER JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
-WHERE
-        pe.successful = TRUE
-    AND t.common_name = %s
-GROUP BY t.common_name, r.neighborhood, t.id
-ORDER BY t.common_name ASC;
-            ''', (common_name,))
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-            custom_report_3 = []
-            for row in rows:
-                custom_report_3.append(
-                    {
-                        'neighborhood_name': row[0],
-                        'total_trees_planted': row[1],
-                        'trees_planted_this_year': row[2],
-                        'peak_year': row[3],
-                        'trees_planted_in_peak_year': row[4]
-                    }
-                )
-            return jsonify(custom_report_3)
+            statements.execute(cur, queries.CUSTOM_REPORT_3, (common_name,))
+            return rows_response(queries.CUSTOM_REPORT_3, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Custom report 4
 # -- The following query is to help users figure out which tree that they would like to order, the user provides minimum
@@ -1377,6 +1165,7 @@ ORDER BY t.common_name ASC;
 # -- inventory so that rarer trees can be left for those who are more passionate about trees. This data is important
 # -- because it increases the user experience for many users.
 @app.route('/api/custom-report-4')
+@cached_report('custom-report-4')
 def get_custom_report_4():
     min_height = request.args.get('min_height')
     max_height = request.args.get('max_height')
@@ -1386,49 +1175,14 @@ def get_custom_report_4():
     if not (min_height and max_height and min_width and max_width):
         return jsonify({"error": "Missing height or width parameters"}), 500
 
-    conn = get_db_connection()
-    if conn:
-        try:
-            cur = conn.cursor()
-            cur.execute('''
-  WITH valid_trees AS (SELECT
-                            t.id,
-                            t.common_name,
-                            t.inventory
-                        FROM trees t
-                            INNER JOIN tree_requests tr
-                                        ON t.id = tr.tree_id
-                        WHERE
-                                LOWER(t.height_range) >= %s
-                            AND UPPER(t.height_range) <= %s
-                            AND LOWER(t.height_range) >= %s
-                            AND UPPER(t.height_range) <= %s
-                        GROUP BY t.id, t.common_name, t.inventory
-                        HAVING t.inventory - COUNT(tr) > 0)
-SELECT t.common_name, COUNT(pe) AS num_planted
-FROM valid_trees t
-    INNER JOIN tree_requests tr ON t.id = tr.tree_id
-    LEFT OUTER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
-    LEFT OUTER JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id AND pe.successful = TRUE
-GROUP BY t.common_name, t.inventory
-HAVING (SELECT COUNT(*)
-        FROM valid_trees t2
-        WHERE t2.inventory >= t.inventory) <= 4;
-            ''', (min_height, max_height, min_width, max_width))
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-            custom_report_4 = []
-            for row in rows:
-                custom_report_4.append({
-                    'common_name': row[0],
-                    'num_planted': row[1]
-                })
-            return jsonify(custom_report_4)
-        except Exception as e:
-             close_resources(conn, cur)
-             return jsonify({"error": f"Database query failed: {e}"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
+    try:
+        bounds = catalog.parse_bounds(request.args)
+    except catalog.SearchError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return jsonify(current_tree_catalog().top_by_inventory(*bounds))
+    except psycopg2.Error as e:
+         return jsonify({"error": f"Database query failed: {e}"}), 500
 
 # Custom report 5
 # 
@@ -1437,64 +1191,197 @@ HAVING (SELECT COUNT(*)
 # the success rate of the plantings that they have attended
 #
 @app.route('/api/custom-report-5')
+@cached_report('custom-report-5')
 def get_custom_report_5():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-
-WITH scheduled_volunters AS (SELECT
-    r.first_name || ' ' || r.last_name AS volunteer_name,
-    COUNT(sp) AS num_plantings_scheduled_for
-FROM residents r
-     INNER JOIN scheduled_plantings_have_volunteers sphv ON r.id = sphv.volunteer_id
-     LEFT OUTER JOIN scheduled_plantings sp ON sphv.planting_event_id = sp.event_id AND sp.cancelled = FALSE
-WHERE is_volunteer = TRUE
-GROUP BY r.first_name, r.last_name),
-attended_volunteers AS (SELECT
-    r.first_name || ' ' || r.last_name AS volunteer_name,
-    COUNT(pehv) AS num_plantings_attended,
-    COUNT(spe) AS num_successful_plantings_attended
-FROM residents r
-         INNER JOIN planting_events_have_volunteers pehv ON r.id = pehv.volunteer_id
-         LEFT OUTER JOIN planting_events spe ON pehv.planting_event_id = spe.scheduled_planting_id AND spe.successful = TRUE
-WHERE is_volunteer = TRUE
-GROUP BY r.first_name, r.last_name)
-SELECT sv.volunteer_name,
-       av.num_plantings_attended,
-       (sv.num_plantings_scheduled_for - av.num_plantings_attended) AS num_plantings_missed,
-       (av.num_successful_plantings_attended::FLOAT / av.num_plantings_attended::FLOAT) AS success_rate_of_attended_plantings
-FROM scheduled_volunters sv
-    LEFT OUTER JOIN attended_volunteers av ON sv.volunteer_name = av.volunteer_name
-GROUP BY sv.volunteer_name, sv.num_plantings_scheduled_for, av.num_plantings_attended, av.num_successful_plantings_attended
-ORDER BY success_rate_of_attended_plantings ASC, num_plantings_missed DESC;
-                        ''', )
-            rows = cur.fetchall()
-            close_resources(conn, cur)
-            custom_report_5 = []
-            for row in rows:
-                custom_report_5.append({
-                    'volunteer_name': row[0],
-                    'num_plantings_attended': row[1],
-                    'num_plantings_missed': row[2],
-                    'success_rate_of_attended_plantings': row[3]
-                })
-            return jsonify(custom_report_5)
+            statements.execute(cur, queries.CUSTOM_REPORT_5)
+            return rows_response(queries.CUSTOM_REPORT_5, cur)
         except Exception as e:
-             close_resources(conn, cur)
              return jsonify({"error": f"Database query failed: {e}"}), 500
+
+
+def _export_arg(args, name, message):
+    value = args.get(name)
+    if not value:
+        raise export.ExportError(message)
+    return value
+
+# Exports of each report and of the admin tree request listing: name -> function of the query
+# string returning (query, params). Columns are named like the report's JSON keys.
+EXPORTS = {
+    'tree-requests-status': lambda args: (queries.TREE_REQUESTS_STATUS, ()),
+    'trees-planted': lambda args: (queries.TREES_PLANTED,
+                                   (_export_arg(args, 'neighborhood', "Missing neighborhood parameter"),)),
+    'tree-species-statistics': lambda args: (queries.TREE_SPECIES_STATISTICS, ()),
+    'neighborhood-report': lambda args: (queries.NEIGHBORHOOD_REPORT, ()),
+    'custom-report-1': lambda args: (queries.CUSTOM_REPORT_1, (_export_arg(args, 'year', "Missing year parameter"),)),
+    'custom-report-2': lambda args: (queries.CUSTOM_REPORT_2, (_export_arg(args, 'year', "Missing year parameter"),)),
+    'custom-report-3': lambda args: (queries.CUSTOM_REPORT_3,
+                                     (_export_arg(args, 'common_name', "Missing common name parameter"),)),
+    'custom-report-5': lambda args: (queries.CUSTOM_REPORT_5, ()),
+    'all-tree-requests': queries.all_tree_requests_export,
+}
+
+# Stream a report, or every tree request matching the admin listing's filters, as CSV or
+# NDJSON (?format=ndjson) straight out of Postgres with COPY, so memory use stays flat however
+# many rows there are. Takes the report's own parameters, e.g. /api/export/custom-report-1?year=2024.
+# Gzipped when the client sends Accept-Encoding: gzip.
+@app.route('/api/export/<name>')
+def export_report(name):
+    fmt = request.args.get('format', 'csv')
+    compress = request.accept_encodings['gzip'] > 0
+    try:
+        if fmt not in export.FORMATS:
+            raise export.ExportError(f"format must be one of {', '.join(export.FORMATS)}")
+        if name == 'custom-report-4':
+            # Answered from the tree catalog index rather than a query, and only ever a few rows
+            if not all(request.args.get(arg) for arg in ('min_height', 'max_height', 'min_width', 'max_width')):
+                raise export.ExportError("Missing height or width parameters")
+            rows = current_tree_catalog().top_by_inventory(*catalog.parse_bounds(request.args))
+            columns = ('common_name', 'num_planted')
+            body = export.rows_chunks(columns, [[row[column] for column in columns] for row in rows], fmt)
+            body = export.gzipped(body) if compress else body
+        elif name in EXPORTS:
+            query, params = EXPORTS[name](request.args)
+            body = export.CopyStream(query, params, fmt, compress, replica=not pinned_to_primary(request.headers))
+        else:
+            return jsonify({"error": f"Unknown export {name}"}), 404
+    except (export.ExportError, catalog.SearchError, PaginationError) as e:
+        return jsonify({"error": str(e)}), 400
+    except psycopg2.Error as e:
+        return jsonify({"error": f"Database query failed: {e}"}), 500
+
+    response = Response(body, mimetype=export.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}.{fmt}"'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# Reports that can be run as background jobs: every export, and custom report 4
+REPORT_JOBS = (*EXPORTS, 'custom-report-4')
+# Longest a request to /api/report-jobs/<id>?wait= is held open, well within client timeouts
+REPORT_JOB_MAX_WAIT = 30.0
+
+def check_report_job(report, args):
+    """Raises the error the report's endpoint would answer `args` with, if any."""
+    serialize.parse_format(args)
+    if report == 'custom-report-4':
+        if not all(args.get(arg) for arg in ('min_height', 'max_height', 'min_width', 'max_width')):
+            raise export.ExportError("Missing height or width parameters")
+        catalog.parse_bounds(args)
     else:
-        return jsonify({"error": "Could not connect to database"}), 500
+        EXPORTS[report](args)
+
+def run_report_job(report, params):
+    """(body, row count) of `report` with query string `params`: what its endpoint returns."""
+    args = MultiDict(params)
+    fmt = serialize.parse_format(args)
+    if report == 'custom-report-4':
+        rows = current_tree_catalog().top_by_inventory(*catalog.parse_bounds(args))
+        return serialize.dumps(rows) + b'\n', len(rows)
+    query, query_params = EXPORTS[report](args)
+    with db_connection(replica=True) as conn, conn.cursor() as cur:
+        # Set for the session, which the pool resets, so the query still starts its own transaction
+        cur.execute('SET statement_timeout = %s', (int(job_runner.timeout * 1000),))
+        conn.commit()
+        statements.execute(cur, query, query_params)
+        rows = cur.fetchall()
+        columns = query.keys(queries.column_names(cur))
+    return serialize.dumps_rows(columns, rows, fmt == 'columnar') + b'\n', len(rows)
+
+job_runner = jobs.JobRunner(run_report_job)
+
+def jobs_busy():
+    response = jsonify({"error": "Too many report jobs queued, try again shortly"})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+# Queue a report to run in the background (see jobs.py), with the report's own parameters,
+# e.g. POST /api/report-jobs/custom-report-1?year=2024. Answers 202 with the job and its URL in
+# Location, or 200 with a stored job that already ran with the same parameters (?refresh=1 to rerun).
+@app.route('/api/report-jobs/<report>', methods=['POST'])
+def submit_report_job(report):
+    if report not in REPORT_JOBS:
+        return jsonify({"error": f"Unknown report {report}"}), 404
+    try:
+        check_report_job(report, request.args)
+    except (export.ExportError, catalog.SearchError, PaginationError, serialize.FormatError) as e:
+        return jsonify({"error": str(e)}), 400
+    params = jobs.params_of(request.args)
+    key = jobs.job_key(report, params, report_cache.stamp(*REPORT_TABLES[report]))
+
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            jobs.delete_expired(cur)
+            job = None if request.args.get('refresh') else jobs.find(cur, key, job_runner.timeout)
+            if job is None:
+                job_runner.reserve()
+                try:
+                    job = jobs.create(cur, key, report, params)
+                    conn.commit()
+                except Exception:
+                    job_runner.release()
+                    raise
+                job_runner.start(job['id'], report, params)
+            else:
+                conn.commit()
+        except jobs.JobsBusy:
+            return jobs_busy()
+        except Exception as e:
+             return jsonify({"error": f"Database query failed: {e}"}), 500
 
+    response = jsonify(job)
+    response.headers['Location'] = f"/api/report-jobs/{job['id']}"
+    return response, 200 if job['status'] == 'done' else 202
+
+# Status of a report job. With ?wait=N, waits up to N seconds (at most 30) for it to finish.
+@app.route('/api/report-jobs/<int:job_id>')
+def get_report_job(job_id):
+    try:
+        wait = float(request.args.get('wait') or 0)
+    except ValueError:
+        wait = -1
+    if not 0 <= wait:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+    deadline = time.monotonic() + min(wait, REPORT_JOB_MAX_WAIT)
+
+    while True:
+        with db_connection() as conn, conn.cursor() as cur:
+            try:
+                job = jobs.get(cur, job_id)
+            except Exception as e:
+                 return jsonify({"error": f"Database query failed: {e}"}), 500
+        if job is None:
+            return jsonify({"error": "Report job not found"}), 404
+        remaining = deadline - time.monotonic()
+        if job['status'] in jobs.FINISHED or remaining <= 0:
+            return jsonify(job)
+        # Woken as soon as a job of this worker finishes; ones run by other workers are polled
+        job_runner.wait(min(remaining, 1.0))
+
+# Result of a finished report job: the body the report's endpoint would have returned
+@app.route('/api/report-jobs/<int:job_id>/result')
+def get_report_job_result(job_id):
+    with db_connection() as conn, conn.cursor() as cur:
+        try:
+            job, body = jobs.result(cur, job_id)
+        except Exception as e:
+             return jsonify({"error": f"Database query failed: {e}"}), 500
+    if job is None:
+        return jsonify({"error": "Report job not found"}), 404
+    if job['status'] == 'failed':
+        return jsonify({"error": f"Database query failed: {job['error']}"}), 500
+    if body is None:
+        return jsonify({"error": f"Report job is {job['status']}"}), 409
+    return app.response_class(body, mimetype='application/json')
 
 # Get pending volunteer applications (admin only)
 @app.route('/api/pending-volunteer-applications', methods=['GET'])
 def get_pending_volunteer_applications():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 SELECT va.resident_id, va.created, va.notes, r.first_name, r.last_name, r.email
                 FROM volunteer_applications va
@@ -1503,7 +1390,6 @@ def get_pending_volunteer_applications():
                 ORDER BY va.created ASC;
             ''')
             rows = cur.fetchall()
-            close_resources(conn, cur)
             applications = []
             for row in rows:
                 applications.append({
@@ -1516,11 +1402,8 @@ def get_pending_volunteer_applications():
                 })
             return jsonify(applications)
         except Exception as e:
-             close_resources(conn, cur)
              print(f"Error fetching pending volunteer applications: {e}")
              return jsonify({"error": "Database query failed"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Approve a volunteer application (admin only)
 @app.route('/api/approve-volunteer', methods=['PATCH'])
@@ -1534,10 +1417,8 @@ def approve_volunteer():
     if not resident_id:
         return jsonify({"error": "Missing resident_id"}), 400
 
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             # Update volunteer_applications table
             cur.execute('''
                 UPDATE volunteer_applications
@@ -1545,7 +1426,6 @@ def approve_volunteer():
                 WHERE resident_id = %s AND approved IS NULL;
             ''', (resident_id,))
             if cur.rowcount == 0:
-                 close_resources(conn, cur)
                  return jsonify({"error": "Volunteer application not found or already approved"}), 404
 
             # Update residents table
@@ -1556,133 +1436,50 @@ def approve_volunteer():
             ''', (resident_id,))
 
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('volunteer_applications', 'residents')
+            role_cache.invalidate(int(resident_id))
             return jsonify({"message": "Volunteer approved successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error approving volunteer: {e}")
              return jsonify({"error": "Database error occurred"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Get details for a specific scheduled planting, including assigned people
 @app.route('/api/scheduled-planting-details/<int:planting_event_id>', methods=['GET'])
 def get_scheduled_planting_details(planting_event_id):
-    conn = get_db_connection()
-    details = {}
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
-            cur.execute('''
-                SELECT 
-                        sp.event_id,
-                        sp.tree_request_id,
-                        sp.event_timestamp,
-                        sp.cancelled,
-                        sp.notes,
-                        tr.site_description,
-                        CASE WHEN pe.scheduled_planting_id IS NOT NULL THEN true ELSE false END AS outcome_recorded
-                FROM scheduled_plantings sp
-                LEFT JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
-                INNER JOIN tree_requests tr ON sp.tree_request_id = tr.id
-                WHERE sp.event_id = %s;
-            ''', (planting_event_id,))
-            planting_info_row = cur.fetchone()
-
-            if not planting_info_row:
-                close_resources(conn, cur)
+            statements.execute(cur, queries.SCHEDULED_PLANTING_DETAILS, ([planting_event_id],))
+            row = cur.fetchone()
+            if not row:
                 return jsonify({"error": "Scheduled planting not found"}), 404
-            details = {
-                'event_id': planting_info_row[0],
-                'tree_request_id': planting_info_row[1],
-                'event_timestamp': planting_info_row[2],
-                'cancelled': planting_info_row[3],
-                'notes': planting_info_row[4],
-                'site_description': planting_info_row[5],
-                'outcome_recorded': planting_info_row[6]
-            }
-
-            # Get outcome details
-            if details['outcome_recorded']:
-                cur.execute('''
-                    SELECT successful, observations
-                    FROM planting_events
-                    WHERE scheduled_planting_id = %s;
-                ''', (planting_event_id,))
-                outcome_row = cur.fetchone()
-                if outcome_row:
-                    details['outcome_successful'] = outcome_row[0]
-                    details['outcome_observations'] = outcome_row[1]
-
-                # Fetch attended volunteers for the recorded event
-                cur.execute('''
-                    SELECT r.id, r.first_name, r.last_name
-                    FROM planting_events_have_volunteers pehv
-                    JOIN residents r ON pehv.volunteer_id = r.id
-                    WHERE pehv.planting_event_id = %s;
-                ''', (planting_event_id,))
-                attended_rows = cur.fetchall()
-                attended_volunteers = []
-                for row in attended_rows:
-                    attended_volunteers.append({
-                        'id': row[0],
-                        'first_name': row[1],
-                        'last_name': row[2]
-                    })
-                details['attended_volunteers'] = attended_volunteers
-
-            # Get assigned volunteers
-            cur.execute('''
-                SELECT r.id, r.first_name, r.last_name
-                FROM scheduled_plantings_have_volunteers spv
-                JOIN residents r ON spv.volunteer_id = r.id
-                WHERE spv.planting_event_id = %s;
-            ''', (planting_event_id,))
-            assigned_volunteers_rows = cur.fetchall()
-            assigned_volunteers = []
-            for row in assigned_volunteers_rows:
-                assigned_volunteers.append({
-                    'id': row[0],
-                    'first_name': row[1],
-                    'last_name': row[2]
-                })
-            details['assigned_volunteers'] = assigned_volunteers
+            return jsonify(queries.planting_details(row, queries.column_names(cur)))
 
-            # Get assigned (leading) org members
-            cur.execute('''
-                SELECT r.id, r.first_name, r.last_name
-                FROM organization_members_lead_scheduled_plantings omsp
-                JOIN residents r ON omsp.organization_member_id = r.id
-                WHERE omsp.scheduled_planting_id = %s;
-            ''', (planting_event_id,))
-            assigned_org_members_rows = cur.fetchall()
-            assigned_org_members = []
-            for row in assigned_org_members_rows:
-                 assigned_org_members.append({
-                    'id': row[0],
-                    'first_name': row[1],
-                    'last_name': row[2]
-                })
-            details['assigned_org_members'] = assigned_org_members
+        except Exception as e:
+             print(f"Error fetching planting details: {e}")
+             return jsonify({"error": "Database query failed"}), 500
 
-            close_resources(conn, cur)
-            return jsonify(details)
+# Get details for many scheduled plantings at once (?ids=1,2,3), e.g. a day's schedule.
+# Returned in event_timestamp order; ids that don't exist are left out.
+@app.route('/api/scheduled-planting-details', methods=['GET'])
+def get_scheduled_planting_details_batch():
+    try:
+        planting_event_ids = parse_id_list(request.args, 'ids')
+    except PaginationError as e:
+        return jsonify({"error": str(e)}), 400
 
+    with read_connection() as conn, conn.cursor() as cur:
+        try:
+            statements.execute(cur, queries.SCHEDULED_PLANTING_DETAILS, (planting_event_ids,))
+            return jsonify([queries.planting_details(row, queries.column_names(cur)) for row in cur.fetchall()])
         except Exception as e:
-             if cur: cur.close()
-             if conn: conn.close()
              print(f"Error fetching planting details: {e}")
              return jsonify({"error": "Database query failed"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Get list of available (approved) volunteers
 @app.route('/api/available-volunteers', methods=['GET'])
 def get_available_volunteers():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 SELECT id, first_name, last_name
                 FROM residents
@@ -1690,7 +1487,6 @@ def get_available_volunteers():
                 ORDER BY last_name, first_name;
             ''')
             rows = cur.fetchall()
-            close_resources(conn, cur)
             volunteers = []
             for row in rows:
                 volunteers.append({
@@ -1700,20 +1496,14 @@ def get_available_volunteers():
                 })
             return jsonify(volunteers)
         except Exception as e:
-             if cur: cur.close()
-             if conn: conn.close()
              print(f"Error fetching available volunteers: {e}")
              return jsonify({"error": "Database query failed"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Get list of available org members
 @app.route('/api/available-org-members', methods=['GET'])
 def get_available_org_members():
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 SELECT r.id, r.first_name, r.last_name
                 FROM organization_members om
@@ -1721,7 +1511,6 @@ def get_available_org_members():
                 ORDER BY r.last_name, r.first_name;
             ''')
             rows = cur.fetchall()
-            close_resources(conn, cur)
             members = []
             for row in rows:
                 members.append({
@@ -1731,61 +1520,181 @@ def get_available_org_members():
                 })
             return jsonify(members)
         except Exception as e:
-             close_resources(conn, cur)
              print(f"Error fetching available org members: {e}")
              return jsonify({"error": "Database query failed"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Cancel a scheduled planting
 @app.route('/api/cancel-planting/<int:planting_event_id>', methods=['PATCH'])
 def cancel_planting(planting_event_id):
-    conn = get_db_connection()
-    if conn:
+    with db_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
-                UPDATE scheduled_events
+                UPDATE scheduled_plantings
                 SET cancelled = true
                 WHERE event_id = %s;
             ''', (planting_event_id,))
             if cur.rowcount == 0:
-                 close_resources(conn, cur)
                  return jsonify({"error": "Planting event not found or already cancelled"}), 404
             conn.commit()
-            close_resources(conn, cur)
+            report_cache.bump('scheduled_plantings')
             return jsonify({"message": "Planting cancelled successfully"})
         except psycopg2.Error as e:
-             close_resources(conn, cur)
              print(f"Error cancelling planting: {e}")
              return jsonify({"error": "Database error occurred"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
 
 # Get basic details for a visit, including the tree_request_id
 @app.route('/api/visit-details/<int:visit_event_id>', methods=['GET'])
 def get_visit_details(visit_event_id):
-    conn = get_db_connection()
-    if conn:
+    with read_connection() as conn, conn.cursor() as cur:
         try:
-            cur = conn.cursor()
             cur.execute('''
                 SELECT tree_request_id
                 FROM scheduled_events
                 WHERE event_id = %s;
             ''', (visit_event_id,))
             row = cur.fetchone()
-            close_resources(conn, cur)
             if not row:
                 return jsonify({"error": "Visit event not found"}), 404
             return jsonify({"tree_request_id": row[0]})
         except Exception as e:
-             if cur: cur.close()
-             if conn: conn.close()
              print(f"Error fetching visit details: {e}")
              return jsonify({"error": "Database query failed"}), 500
-    else:
-        return jsonify({"error": "Could not connect to database"}), 500
+
+## ---CLI COMMANDS---
+# Backfill/rebuild the stored tree request statuses: flask --app app rebuild-statuses
+@app.cli.command('rebuild-statuses')
+def rebuild_statuses():
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT rebuild_tree_request_statuses();')
+        updated = cur.fetchone()[0]
+        conn.commit()
+    report_cache.bump(*STATUS_TABLES)
+    print(f"Rebuilt tree request statuses, {updated} were out of date")
+
+# Compare the stored statuses with get_tree_request_status(): flask --app app check-statuses
+@app.cli.command('check-statuses')
+def check_statuses():
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT tree_request_id, stored_status, computed_status FROM check_tree_request_statuses();')
+        rows = cur.fetchall()
+    for row in rows:
+        print(f"Tree request {row[0]}: stored {row[1]!r}, computed {row[2]!r}")
+    if rows:
+        print(f"{len(rows)} tree request statuses are out of date, run rebuild-statuses")
+        raise SystemExit(1)
+    print("All tree request statuses are up to date")
+
+# Recompute the neighborhood report rollup from scratch: flask --app app rebuild-neighborhood-report
+@app.cli.command('rebuild-neighborhood-report')
+def rebuild_neighborhood_report():
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT rebuild_neighborhood_rollup();')
+        conn.commit()
+    report_cache.bump(*STATUS_TABLES)
+    print("Rebuilt the neighborhood report rollup")
+
+# Compare the rollup with the original neighborhood report query: flask --app app check-neighborhood-report
+@app.cli.command('check-neighborhood-report')
+def check_neighborhood_report():
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT neighborhood_name, rollup, computed FROM check_neighborhood_rollup();')
+        rows = cur.fetchall()
+    for row in rows:
+        print(f"{row[0]}:\n  rollup   {row[1]}\n  computed {row[2]}")
+    if rows:
+        print(f"{len(rows)} neighborhoods disagree, run rebuild-neighborhood-report")
+        raise SystemExit(1)
+    print("The neighborhood report rollup matches the report query")
+
+# Recompute the yearly planting rollups behind the peak-year reports: flask --app app rebuild-yearly-rollups
+@app.cli.command('rebuild-yearly-rollups')
+def rebuild_yearly_rollups():
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT rebuild_yearly_planting_rollups();')
+        conn.commit()
+    # Every report served from the rollups is cached against planting_events
+    report_cache.bump('planting_events')
+    print("Rebuilt the yearly planting rollups")
+
+# Compare the yearly planting rollups with the tables they count: flask --app app check-yearly-rollups
+@app.cli.command('check-yearly-rollups')
+def check_yearly_rollups():
+    with db_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT rollup, source, row_value FROM check_yearly_planting_rollups();')
+        rows = cur.fetchall()
+    for row in rows:
+        print(f"{row[0]} {row[1]}: {row[2]}")
+    if rows:
+        print(f"{len(rows)} yearly rollup rows disagree, run rebuild-yearly-rollups")
+        raise SystemExit(1)
+    print("The yearly planting rollups match the tables they count")
+
+# Add a generated dataset on top of dml.sql: flask --app app generate-data --scale 5
+@app.cli.command('generate-data')
+@click.option('--scale', default=1, help='Multiples of 200 residents and 1000 tree requests.')
+@click.option('--seed', default=42, help='Random seed.')
+def generate_data(scale, seed):
+    with db_connection() as conn:
+        counts = datagen.generate(conn, scale=scale, seed=seed)
+    report_cache.bump(*datagen.TABLES)
+    for table, count in counts.items():
+        print(f"{table}: {count}")
+
+# Add and update trees from a nursery feed: flask --app app import-trees feed.csv
+@app.cli.command('import-trees')
+@click.argument('feed', type=click.File('rb'))
+@click.option('--dry-run', is_flag=True, help='Check the feed and report what would change, without saving.')
+def import_trees_command(feed, dry_run):
+    try:
+        with db_connection() as conn:
+            result = tree_import.import_trees(conn, feed, dry_run=dry_run)
+    except tree_import.FeedError as e:
+        print(e)
+        raise SystemExit(1)
+    if not dry_run:
+        report_cache.bump('trees')
+    for rejection in result['rejections']:
+        print(f"Line {rejection['line']} ({rejection['scientific_name']}): {'; '.join(rejection['errors'])}")
+    print(f"{'Would insert' if dry_run else 'Inserted'} {result['inserted']}, "
+          f"{'would update' if dry_run else 'updated'} {result['updated']}, "
+          f"{result['unchanged']} unchanged, {result['rejected']} rejected")
+
+# Apply pending schema migrations from /migrations: flask --app app migrate
+@app.cli.command('migrate')
+@click.option('--list', 'list_only', is_flag=True, help='Only show which migrations are applied and pending.')
+@click.option('--target', type=int, help='Stop after this migration version.')
+def migrate_schema(list_only, target):
+    conn = connect()
+    try:
+        migrations = migrate.discover()
+        if list_only:
+            done = migrate.applied(conn)
+            conn.commit()
+            for migration in migrations:
+                if migration.version in done:
+                    _, applied_at, duration_ms = done[migration.version]
+                    state = f"applied {applied_at:%Y-%m-%d %H:%M} in {duration_ms} ms"
+                else:
+                    state = "pending"
+                print(f"{migration.version:04d}_{migration.name}: {state}")
+            return
+        ran = migrate.migrate(conn, migrations, target=target)
+    except migrate.MigrationError as e:
+        print(e)
+        raise SystemExit(1)
+    finally:
+        conn.close()
+    if ran:
+        report_cache.clear()
+    print(f"Applied {len(ran)} migration(s)" if ran else "The schema is up to date")
+
+# Drop every cached report, e.g. after editing data by hand: flask --app app clear-report-cache
+@app.cli.command('clear-report-cache')
+def clear_report_cache():
+    report_cache.clear()
+    tree_catalog.clear()
+    role_cache.clear()
+    print("Cleared the report cache")
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
\ No newline at end of file
@@ -0,0 +1,498 @@
+"""Asyncio serving mode for the API.
+
+Run with "uvicorn asgi:app --port 5001". The read endpoints below are served
+natively with asyncpg, so a worker keeps answering requests while Postgres works
+on others. Every other route falls through to the Flask app in app.py, mounted
+in the same process, so URLs and JSON shapes are the same in both modes and write
+routes keep invalidating the same report cache.
+"""
+import asyncio
+import contextvars
+import json
+import os
+from contextlib import asynccontextmanager
+from decimal import Decimal
+from functools import wraps
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.middleware import Middleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_etags
+
+import catalog
+import queries
+import serialize
+from app import REPORT_TABLES, app as flask_app, pinned_to_primary, report_cache, tree_catalog
+from cache import MemoryBackend, snapshot_name
+from db import REPLICA_LAG_SQL, DatabaseUnavailable, PoolTimeout, ReplicaSet, env_float, env_int, replica_dsns
+from pagination import PaginationError, page_headers, parse_id_list
+
+
+class QueryFailed(Exception):
+    """Raised when a read query fails after a connection was checked out."""
+
+
+_pool = None
+_pool_lock = asyncio.Lock()
+# Health of the read replicas, with an asyncpg pool each; asyncpg only takes URLs
+_replicas = ReplicaSet(replica_dsns()) if replica_dsns() else None
+# Whether this request reads from the primary: set by PinToPrimary and the cache decorators
+read_primary = contextvars.ContextVar('read_primary', default=False)
+
+
+async def _init_connection(conn):
+    # Send integers and numerics as text, like psycopg2 does, so query string values
+    # such as ?year=2024 are parsed by Postgres instead of being rejected by asyncpg.
+    for name, decoder in (('int2', int), ('int4', int), ('int8', int), ('numeric', Decimal)):
+        await conn.set_type_codec(name, schema='pg_catalog', encoder=str, decoder=decoder, format='text')
+    # Nested documents built with json_agg come back as Python lists, as with psycopg2
+    await conn.set_type_codec('json', schema='pg_catalog', encoder=json.dumps, decoder=json.loads, format='text')
+
+
+async def get_pool():
+    """Returns the asyncpg pool for this worker, creating it on first use."""
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                try:
+                    _pool = await asyncpg.create_pool(
+                        host=os.getenv("POSTGRES_HOST"),
+                        database=os.getenv("POSTGRES_DB"),
+                        user=os.getenv("POSTGRES_USERNAME"),
+                        password=os.getenv("POSTGRES_PASSWORD"),
+                        port=os.getenv("POSTGRES_PORT"),
+                        min_size=env_int("POSTGRES_POOL_MIN", 1),
+                        max_size=env_int("POSTGRES_POOL_MAX", 10),
+                        max_inactive_connection_lifetime=env_float("POSTGRES_POOL_MAX_IDLE", 30.0),
+                        init=_init_connection
+                    )
+                except (OSError, asyncpg.PostgresError, asyncio.TimeoutError) as e:
+                    raise DatabaseUnavailable(str(e)) from e
+    return _pool
+
+
+async def _replica_pool(i):
+    if _replicas.pools[i] is None:
+        async with _pool_lock:
+            if _replicas.pools[i] is None:
+                try:
+                    # min_size=0 opens no connection yet, so a replica that is down doesn't fail here
+                    _replicas.pools[i] = await asyncpg.create_pool(
+                        _replicas.dsns[i],
+                        min_size=0,
+                        max_size=env_int("POSTGRES_POOL_MAX", 10),
+                        max_inactive_connection_lifetime=env_float("POSTGRES_POOL_MAX_IDLE", 30.0),
+                        init=_init_connection
+                    )
+                except (OSError, ValueError, asyncpg.PostgresError, asyncio.TimeoutError) as e:
+                    raise DatabaseUnavailable(str(e)) from e
+    return _replicas.pools[i]
+
+
+async def _acquire(pool):
+    try:
+        return await pool.acquire(timeout=env_float("POSTGRES_POOL_TIMEOUT", 5.0))
+    except asyncio.TimeoutError as e:
+        raise PoolTimeout("Timed out waiting for a database connection") from e
+    except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+        raise DatabaseUnavailable(str(e)) from e
+
+
+async def _acquire_replica():
+    """Async counterpart of db._checkout_replica: (pool, connection), or None if no replica is healthy."""
+    timed_out = None
+    for i in _replicas.candidates():
+        try:
+            pool = await _replica_pool(i)
+            conn = await _acquire(pool)
+        except PoolTimeout as e:
+            timed_out = e
+            continue
+        except DatabaseUnavailable as e:
+            _replicas.failed(i, e)
+            continue
+        if _replicas.check_due(i):
+            try:
+                healthy = _replicas.record_lag(i, await conn.fetchval(REPLICA_LAG_SQL))
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                _replicas.failed(i, e)
+                healthy = False
+            if not healthy:
+                await pool.release(conn)
+                continue
+        _replicas.used(i)
+        return pool, conn
+    if timed_out is not None:
+        raise timed_out
+    return None
+
+
+@asynccontextmanager
+async def connection(replica=False):
+    """Checks out a pooled asyncpg connection, waiting up to POSTGRES_POOL_TIMEOUT seconds.
+
+    With `replica`, from a healthy read replica when POSTGRES_REPLICAS is set, like db.checkout.
+    """
+    checked_out = await _acquire_replica() if replica and _replicas is not None else None
+    if checked_out is None:
+        if replica and _replicas is not None:
+            _replicas.fell_back()
+        pool = await get_pool()
+        checked_out = pool, await _acquire(pool)
+    pool, conn = checked_out
+    try:
+        yield conn
+    finally:
+        if conn.is_closed() and _replicas is not None and pool in _replicas.pools:
+            _replicas.failed(_replicas.pools.index(pool), "Connection to the replica was lost")
+        await pool.release(conn)
+
+
+async def fetch(conn, query, *params):
+    try:
+        return await conn.fetch(query.async_sql, *params)
+    except Exception as e:
+        raise QueryFailed(str(e)) from e
+
+
+async def fetch_all(query, *params, replica=None):
+    """Rows of `query`, read from a replica unless the request reads from the primary
+    (see read_primary). `replica` overrides that."""
+    async with connection(not read_primary.get() if replica is None else replica) as conn:
+        return await fetch(conn, query, *params)
+
+
+async def fetch_keyed(query, *params, replica=None):
+    """(column names, rows) of `query`, read like fetch_all. The names come from the rows, or
+    for an empty result from the prepared statement, as psycopg2's cursor.description has them."""
+    async with connection(not read_primary.get() if replica is None else replica) as conn:
+        rows = await fetch(conn, query, *params)
+        if rows:
+            return queries.column_names(rows[0]), rows
+        try:
+            statement = await conn.prepare(query.async_sql)
+        except Exception as e:
+            raise QueryFailed(str(e)) from e
+        return [attribute.name for attribute in statement.get_attributes()], rows
+
+
+# Encoded like the Flask app's responses, so both modes return identical bodies
+def jsonify(data, status_code=200, headers=None):
+    return Response(serialize.dumps(data) + b'\n', status_code=status_code, headers=headers,
+                    media_type='application/json')
+
+
+def rows_response(request, query, names, rows, headers=None):
+    """Async counterpart of app.rows_response, for `rows` with column `names` (see fetch_keyed)."""
+    try:
+        fmt = serialize.parse_format(query_args(request))
+    except serialize.FormatError as e:
+        return jsonify({"error": str(e)}, 400)
+    body = serialize.dumps_rows(query.keys(names), rows, fmt == 'columnar') + b'\n'
+    return Response(body, headers=headers, media_type='application/json')
+
+
+def query_args(request):
+    """Query string as a dict of first values, like Flask's request.args.get."""
+    return {key: request.query_params.getlist(key)[0] for key in request.query_params.keys()}
+
+
+async def _cache_call(fn, *args):
+    # The Redis backend does blocking network I/O, so keep it off the event loop
+    if isinstance(report_cache.backend, MemoryBackend):
+        return fn(*args)
+    return await run_in_threadpool(fn, *args)
+
+
+def cached(*tables, daily=False):
+    """Async counterpart of ReportCache.cached, sharing its entries and table versions."""
+    def decorator(endpoint):
+        @wraps(endpoint)
+        async def wrapper(request):
+            versions = await _cache_call(report_cache.versions, tables)
+            key = report_cache.key(request.url.path, query_args(request), tables, daily, versions)
+            body = await _cache_call(report_cache.get, key)
+            if body is not None:
+                return Response(body, media_type='application/json')
+            if not report_cache.settled(tables, versions):
+                read_primary.set(True)
+            response = await endpoint(request)
+            if response.status_code == 200:
+                await _cache_call(report_cache.set, key, response.body)
+            return response
+        return wrapper
+    return decorator
+
+
+def cached_report(name):
+    """cached() with the tables of report `name` (app.REPORT_TABLES)."""
+    tables, daily = REPORT_TABLES[name]
+    return cached(*tables, daily=daily)
+
+
+def snapshot(*tables):
+    """Async counterpart of ReportCache.snapshot, sharing its snapshots and table versions."""
+    def decorator(endpoint):
+        @wraps(endpoint)
+        async def wrapper(request):
+            versions = await _cache_call(report_cache.versions, tables)
+            name = snapshot_name(request.url.path, request.query_params.get('format'))
+            # Unlike entries, snapshots always live in this process (a dict lookup and a hash of
+            # the body), so only the versions need _cache_call
+            entry = report_cache.get_snapshot(name, versions)
+            if entry is None:
+                if not report_cache.settled(tables, versions):
+                    read_primary.set(True)
+                response = await endpoint(request)
+                if response.status_code != 200:
+                    return response
+                entry = report_cache.set_snapshot(name, versions, response.body)
+            body, etag = entry
+            headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+            if parse_etags(request.headers.get('if-none-match')).contains(etag):
+                return Response(status_code=304, headers=headers)
+            return Response(body, headers=headers, media_type='application/json')
+        return wrapper
+    return decorator
+
+
+async def current_tree_catalog():
+    """Async counterpart of app.current_tree_catalog, sharing its index."""
+    versions = await _cache_call(report_cache.versions, catalog.TABLES)
+    index = tree_catalog.get(versions)
+    if index is None:
+        rows = await fetch_all(queries.TREE_CATALOG, replica=report_cache.settled(catalog.TABLES, versions))
+        index = tree_catalog.set(versions, rows)
+    return index
+
+
+## ---TASKS.SQL---
+async def get_tree_requests(request):
+    args = query_args(request)
+    resident_id = args.get('resident_id')
+    if not resident_id:
+        return jsonify({"error": "Missing resident_id parameter"}, 500)
+    try:
+        query, params, limit = queries.tree_requests_page(resident_id, args)
+    except PaginationError as e:
+        return jsonify({"error": str(e)}, 400)
+    names, rows = await fetch_keyed(query, *params)
+    rows, headers = page_headers(rows, limit, 1, 0)
+    return rows_response(request, query, names, rows, headers)
+
+
+async def get_tree_request_details(request):
+    args = query_args(request)
+    resident_id = args.get('resident_id')
+    tree_request_id = args.get('tree_request_id')
+    if not tree_request_id:
+        return jsonify({"error": "Missing tree_request_id parameter"}, 500)
+    if not resident_id:
+        return jsonify({"error": "Missing resident_id parameter"}, 500)
+    rows = await fetch_all(queries.TREE_REQUEST_DETAILS, tree_request_id, resident_id)
+    if not rows:
+        return jsonify({"error": "Tree request not found"}, 404)
+    return jsonify(queries.TREE_REQUEST_DETAILS.shape(rows[0], queries.column_names(rows[0])))
+
+
+async def get_all_tree_requests(request):
+    try:
+        query, params, limit = queries.all_tree_requests_page(query_args(request))
+    except PaginationError as e:
+        return jsonify({"error": str(e)}, 400)
+    names, rows = await fetch_keyed(query, *params)
+    rows, headers = page_headers(rows, limit, 1, 0)
+    return rows_response(request, query, names, rows, headers)
+
+
+async def get_tree_request_details_admin(request):
+    args = query_args(request)
+    tree_request_id = args.get('tree_request_id')
+    if args.get('tree_request_ids'):
+        try:
+            tree_request_ids = parse_id_list(args, 'tree_request_ids')
+        except PaginationError as e:
+            return jsonify({"error": str(e)}, 400)
+    elif tree_request_id:
+        tree_request_ids = [tree_request_id]
+    else:
+        return jsonify({"error": "Missing tree_request_id parameter"}, 500)
+    rows = await fetch_all(queries.TREE_REQUEST_DETAILS_ADMIN, tree_request_ids)
+    details = [queries.tree_request_details_admin(row, queries.column_names(row)) for row in rows]
+    if not tree_request_id:
+        return jsonify(details)
+    if not details:
+        return jsonify({"error": "Tree request not found"}, 404)
+    return jsonify(details[0])
+
+
+async def get_scheduled_planting_details(request):
+    planting_event_id = request.path_params['planting_event_id']
+    rows = await fetch_all(queries.SCHEDULED_PLANTING_DETAILS, [planting_event_id])
+    if not rows:
+        return jsonify({"error": "Scheduled planting not found"}, 404)
+    return jsonify(queries.planting_details(rows[0], queries.column_names(rows[0])))
+
+
+async def get_scheduled_planting_details_batch(request):
+    try:
+        planting_event_ids = parse_id_list(query_args(request), 'ids')
+    except PaginationError as e:
+        return jsonify({"error": str(e)}, 400)
+    rows = await fetch_all(queries.SCHEDULED_PLANTING_DETAILS, planting_event_ids)
+    return jsonify([queries.planting_details(row, queries.column_names(row)) for row in rows])
+
+
+@snapshot('trees')
+async def get_trees(request):
+    return rows_response(request, queries.TREES, *await fetch_keyed(queries.TREES))
+
+
+async def search_trees(request):
+    args = {key: request.query_params.getlist(key) for key in request.query_params.keys()}
+    try:
+        filters = catalog.parse_search_args(args)
+    except catalog.SearchError as e:
+        return jsonify({"error": str(e)}, 400)
+    return jsonify((await current_tree_catalog()).search(filters))
+
+
+@snapshot('neighborhoods')
+async def get_neighborhoods(request):
+    return rows_response(request, queries.NEIGHBORHOODS, *await fetch_keyed(queries.NEIGHBORHOODS))
+
+
+## ---REPORTS.SQL---
+@cached_report('tree-requests-status')
+async def get_tree_requests_status(request):
+    return rows_response(request, queries.TREE_REQUESTS_STATUS, *await fetch_keyed(queries.TREE_REQUESTS_STATUS))
+
+
+@cached_report('trees-planted')
+async def get_trees_planted(request):
+    neighborhood = query_args(request).get('neighborhood')
+    if not neighborhood:
+        return jsonify({"error": "Missing neighborhood parameter"}, 500)
+    return rows_response(request, queries.TREES_PLANTED, *await fetch_keyed(queries.TREES_PLANTED, neighborhood))
+
+
+@cached_report('tree-species-statistics')
+async def get_tree_species_statistics(request):
+    names, rows = await fetch_keyed(queries.TREE_SPECIES_STATISTICS)
+    return rows_response(request, queries.TREE_SPECIES_STATISTICS, names, rows)
+
+
+@cached_report('neighborhood-report')
+async def get_neighborhood_report(request):
+    return rows_response(request, queries.NEIGHBORHOOD_REPORT, *await fetch_keyed(queries.NEIGHBORHOOD_REPORT))
+
+
+@cached_report('custom-report-1')
+async def get_custom_report_1(request):
+    year = query_args(request).get('year')
+    if not year:
+        return jsonify({"error": "Missing year parameter"}, 500)
+    return rows_response(request, queries.CUSTOM_REPORT_1, *await fetch_keyed(queries.CUSTOM_REPORT_1, year))
+
+
+@cached_report('custom-report-2')
+async def get_custom_report_2(request):
+    year = query_args(request).get('year')
+    if not year:
+        return jsonify({"error": "Missing year parameter"}, 500)
+    return rows_response(request, queries.CUSTOM_REPORT_2, *await fetch_keyed(queries.CUSTOM_REPORT_2, year))
+
+
+@cached_report('custom-report-3')
+async def get_custom_report_3(request):
+    common_name = query_args(request).get('common_name')
+    if not common_name:
+        return jsonify({"error": "Missing common name parameter"}, 500)
+    return rows_response(request, queries.CUSTOM_REPORT_3, *await fetch_keyed(queries.CUSTOM_REPORT_3, common_name))
+
+
+@cached_report('custom-report-4')
+async def get_custom_report_4(request):
+    args = query_args(request)
+    min_height = args.get('min_height')
+    max_height = args.get('max_height')
+    min_width = args.get('min_width')
+    max_width = args.get('max_width')
+    if not (min_height and max_height and min_width and max_width):
+        return jsonify({"error": "Missing height or width parameters"}, 500)
+    try:
+        bounds = catalog.parse_bounds(args)
+    except catalog.SearchError as e:
+        return jsonify({"error": str(e)}, 400)
+    return jsonify((await current_tree_catalog()).top_by_inventory(*bounds))
+
+
+@cached_report('custom-report-5')
+async def get_custom_report_5(request):
+    return rows_response(request, queries.CUSTOM_REPORT_5, *await fetch_keyed(queries.CUSTOM_REPORT_5))
+
+
+async def database_unavailable(request, e):
+    print(f"Error connecting to database: {e}")
+    return jsonify({"error": "Could not connect to database"}, 500)
+
+
+async def query_failed(request, e):
+    return jsonify({"error": f"Database query failed: {e}"}, 500)
+
+
+class PinToPrimary:
+    """Sets read_primary for requests whose X-Primary-Until header is in the future (see app.py)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            read_primary.set(pinned_to_primary(Headers(scope=scope)))
+        await self.app(scope, receive, send)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    if _pool is not None:
+        await _pool.close()
+    for pool in _replicas.pools if _replicas is not None else ():
+        if pool is not None:
+            await pool.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/tree-requests', get_tree_requests),
+        Route('/api/details', get_tree_request_details),
+        Route('/api/all-tree-requests', get_all_tree_requests),
+        Route('/api/tree-request-details-admin', get_tree_request_details_admin),
+        Route('/api/scheduled-planting-details/{planting_event_id:int}', get_scheduled_planting_details),
+        Route('/api/scheduled-planting-details', get_scheduled_planting_details_batch),
+        Route('/api/trees', get_trees),
+        Route('/api/trees/search', search_trees),
+        Route('/api/neighborhoods', get_neighborhoods),
+        Route('/api/tree-requests-status', get_tree_requests_status),
+        Route('/api/trees-planted', get_trees_planted),
+        Route('/api/tree-species-statistics', get_tree_species_statistics),
+        Route('/api/neighborhood-report', get_neighborhood_report),
+        Route('/api/custom-report-1', get_custom_report_1),
+        Route('/api/custom-report-2', get_custom_report_2),
+        Route('/api/custom-report-3', get_custom_report_3),
+        Route('/api/custom-report-4', get_custom_report_4),
+        Route('/api/custom-report-5', get_custom_report_5),
+        # Everything else, including all writes, is served by the Flask app
+        Mount('/', WSGIMiddleware(flask_app))
+    ],
+    middleware=[Middleware(PinToPrimary)],
+    exception_handlers={DatabaseUnavailable: database_unavailable, QueryFailed: query_failed},
+    lifespan=lifespan
+)
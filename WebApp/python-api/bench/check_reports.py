@@ -0,0 +1,392 @@
+"""Checks the peak-year reports against the SQL they had before the yearly rollups.
+
+/api/tree-species-statistics and custom reports 1-3 are served from the yearly rollup
+tables of migrations/0004. This runs each report's earlier SQL, which regrouped the
+planting history per output row, and its current SQL from queries.py on a throwaway
+local Postgres (see bench/endpoints.py), for every year and species, on a generated
+dataset and again after --writes random writes (bench/check_rollups.py). Exits with
+status 1, listing the differences, if any report disagrees.
+
+Ties for a peak year used to go to whichever year the plan returned first, and now go
+to the most recent one, so a peak year may differ where the earlier year has the same
+count as the later one. Each such difference is checked against the *_computed views.
+
+    python bench/check_reports.py --scale 1 --writes 1000
+"""
+import argparse
+import random
+import sys
+import time
+from collections import Counter
+
+import psycopg2
+
+from check_rollups import random_writes
+from endpoints import Cluster, find_pg_bin, load
+
+# endpoints puts the API directory on sys.path
+import queries
+
+# The reports' SQL before migrations/0004, unchanged
+OLD_TREE_SPECIES_STATISTICS = '''
+    SELECT t.common_name,
+           COUNT(pe)                                                                       AS number_of_trees_planted,
+           MIN(EXTRACT(YEAR FROM CURRENT_DATE) - EXTRACT(YEAR FROM sp.event_timestamp::TIMESTAMP)) AS years_since_planting,
+           (SELECT
+                EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+            FROM
+                trees AS t2
+                    INNER JOIN tree_requests ON t2.id = tree_requests.tree_id
+                    INNER JOIN scheduled_plantings sp2 ON tree_requests.id = sp2.tree_request_id
+                    INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
+            WHERE
+                  t2.id = t.id
+                AND pe2.successful = TRUE
+            GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+            ORDER BY COUNT(*) DESC
+            LIMIT 1)                                                                          AS year_most_planted,
+           (SELECT
+                COUNT(*)
+            FROM
+                trees AS t2
+                    INNER JOIN tree_requests ON t2.id = tree_requests.tree_id
+                    INNER JOIN scheduled_plantings sp2 ON tree_requests.id = sp2.tree_request_id
+                    INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
+            WHERE
+                  t2.id = t.id
+                AND pe2.successful = TRUE
+            GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+            ORDER BY COUNT(*) DESC
+            LIMIT 1)                                                                          AS num_planted_in_peak_year
+    FROM trees t
+        INNER JOIN tree_requests tr ON t.id = tr.tree_id
+        INNER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
+        INNER JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+    WHERE pe.successful = TRUE
+    GROUP BY t.common_name, t.id;
+'''
+
+OLD_CUSTOM_REPORT_1 = '''
+    SELECT
+        r.first_name || ' ' || r.last_name AS volunteer_name,
+        MIN(sp.event_timestamp)            AS first_planting,
+        MAX(sp.event_timestamp)            AS most_recent_planting,
+        COUNT(pev)                         AS trees_planted,
+        (SELECT
+             EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         FROM
+             planting_events_have_volunteers AS pev2
+                 INNER JOIN planting_events AS p2 ON pev2.planting_event_id = p2.scheduled_planting_id
+                 INNER JOIN scheduled_plantings AS sp2 ON p2.scheduled_planting_id = sp2.event_id
+         WHERE
+             pev2.volunteer_id = r.id
+         GROUP BY
+             EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         ORDER BY COUNT(*) DESC
+         LIMIT 1)                          AS peak_year,
+        (SELECT
+             COUNT(*)
+         FROM
+             planting_events_have_volunteers pev2
+                 INNER JOIN planting_events AS p2 ON pev2.planting_event_id = p2.scheduled_planting_id
+                 INNER JOIN scheduled_plantings AS sp2 ON p2.scheduled_planting_id = sp2.event_id
+         WHERE
+             pev2.volunteer_id = r.id
+         GROUP BY
+             EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         ORDER BY COUNT(*) DESC
+         LIMIT 1)                          AS trees_planted_in_peak_year
+    FROM
+        residents AS r
+            INNER JOIN planting_events_have_volunteers AS pev ON r.id = pev.volunteer_id
+            INNER JOIN planting_events AS pe ON pev.planting_event_id = pe.scheduled_planting_id
+            INNER JOIN scheduled_plantings AS sp ON pe.scheduled_planting_id = sp.event_id
+    WHERE
+          r.is_volunteer = TRUE
+      AND pe.successful = TRUE
+      AND sp.event_timestamp >= make_timestamp(%s::TEXT::INTEGER, 1, 1, 0, 0, 0)
+      AND sp.event_timestamp < make_timestamp(%s::TEXT::INTEGER + 1, 1, 1, 0, 0, 0)
+    GROUP BY r.first_name, r.last_name, r.id
+    ORDER BY trees_planted DESC, trees_planted_in_peak_year DESC;
+'''
+
+OLD_CUSTOM_REPORT_2 = '''
+                  SELECT
+        r.first_name || ' ' || r.last_name AS org_member_name,
+        COUNT(sp) AS plantings_led,
+        COUNT(pe) AS successful_plantings_led,
+        (SELECT
+             EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         FROM
+             organization_members_lead_scheduled_plantings AS ompe2
+                 INNER JOIN scheduled_plantings sp2 ON ompe2.scheduled_planting_id = sp2.event_id
+                 INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
+         WHERE
+                 ompe2.organization_member_id = om.resident_id
+             AND pe2.successful = TRUE
+         GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         ORDER BY COUNT(*) DESC
+         LIMIT 1)   AS plantings_led_peak_year,
+        (SELECT
+             COUNT(*)
+         FROM
+             organization_members_lead_scheduled_plantings AS ompe2
+                 INNER JOIN scheduled_plantings sp2 ON ompe2.scheduled_planting_id = sp2.event_id
+                 INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
+         WHERE
+                 ompe2.organization_member_id = om.resident_id
+             AND pe2.successful = TRUE
+         GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         ORDER BY COUNT(*) DESC
+         LIMIT 1)   AS plantings_led_in_peak_year,
+        COUNT(sv)   AS visits_attended,
+        (SELECT
+             EXTRACT(YEAR FROM sv2.event_timestamp::TIMESTAMP)
+         FROM
+             scheduled_visits AS sv2
+         WHERE
+                 sv2.organization_member_id = om.resident_id
+             AND sv2.cancelled = FALSE
+         GROUP BY EXTRACT(YEAR FROM sv2.event_timestamp::TIMESTAMP)
+         ORDER BY COUNT(*) DESC
+         LIMIT 1)   AS visits_attended_peak_year,
+        (SELECT
+             COUNT(*)
+         FROM
+             scheduled_visits AS sv2
+         WHERE
+               sv2.organization_member_id = om.resident_id
+           AND sv2.cancelled = FALSE
+         GROUP BY EXTRACT(YEAR FROM sv2.event_timestamp::TIMESTAMP)
+         ORDER BY COUNT(*) DESC
+         LIMIT 1)   AS visits_attended_in_peak_year
+    FROM
+        organization_members AS om
+            INNER JOIN residents AS r ON om.resident_id = r.id
+            LEFT OUTER JOIN organization_members_lead_scheduled_plantings AS ompe ON om.resident_id = ompe.organization_member_id
+            LEFT OUTER JOIN scheduled_visits AS sv ON om.resident_id = sv.organization_member_id
+                                                          AND sv.cancelled = FALSE
+                                                          AND sv.event_timestamp >= make_timestamp(%s::TEXT::INTEGER, 1, 1, 0, 0, 0)
+                                                          AND sv.event_timestamp < make_timestamp(%s::TEXT::INTEGER + 1, 1, 1, 0, 0, 0)
+            INNER JOIN scheduled_plantings AS sp ON ompe.scheduled_planting_id = sp.event_id
+            LEFT OUTER JOIN planting_events AS pe ON sp.event_id = pe.scheduled_planting_id AND pe.successful = TRUE
+    WHERE
+            sp.cancelled = FALSE
+        AND sp.event_timestamp >= make_timestamp(%s::TEXT::INTEGER, 1, 1, 0, 0, 0)
+        AND sp.event_timestamp < make_timestamp(%s::TEXT::INTEGER + 1, 1, 1, 0, 0, 0)
+    GROUP BY r.first_name, r.last_name, r.id, om.resident_id
+    ORDER BY plantings_led DESC, visits_attended DESC;
+'''
+
+OLD_CUSTOM_REPORT_3 = '''
+                SELECT
+        t.common_name,
+        r.neighborhood,
+        (SELECT
+             COUNT(*)
+         FROM
+             tree_requests AS tr2
+                 INNER JOIN residents AS r2 ON tr2.resident_id = r2.id
+                 INNER JOIN scheduled_plantings sp2 ON tr2.id = sp2.tree_request_id
+                 INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
+         WHERE
+               r2.neighborhood = r.neighborhood
+           AND tr2.tree_id = t.id
+           AND pe2.successful = TRUE) AS num_in_neighborhood,
+        (SELECT
+             COUNT(*)
+         FROM    tree_requests AS tr2
+                     INNER JOIN residents AS r2 ON tr2.resident_id = r2.id
+                     INNER JOIN scheduled_plantings AS sp2 ON tr2.id = sp2.tree_request_id
+                     INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
+         WHERE
+               r2.neighborhood = r.neighborhood
+           AND pe2.successful = TRUE
+           AND EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP) = EXTRACT(YEAR FROM CURRENT_DATE::DATE)) AS num_planted_this_year,
+        (SELECT
+             EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         FROM
+             tree_requests AS tr2
+                 INNER JOIN residents AS r2 ON tr2.resident_id = r2.id
+                 INNER JOIN scheduled_plantings AS sp2 ON tr2.id = sp2.tree_request_id
+                 INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
+         WHERE
+               r2.neighborhood = r.neighborhood
+           AND pe2.successful = TRUE
+         GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         ORDER BY COUNT(*) DESC
+         LIMIT 1)                   AS plantings_peak_year,
+        (SELECT
+             COUNT(*)
+         FROM
+             tree_requests AS tr2
+                 INNER JOIN residents AS r2 ON tr2.resident_id = r2.id
+                 INNER JOIN scheduled_plantings AS sp2 ON tr2.id = sp2.tree_request_id
+                 INNER JOIN planting_events pe2 ON sp2.event_id = pe2.scheduled_planting_id
+         WHERE
+               r2.neighborhood = r.neighborhood
+           AND pe2.successful = TRUE
+         GROUP BY EXTRACT(YEAR FROM sp2.event_timestamp::TIMESTAMP)
+         ORDER BY COUNT(*) DESC
+         LIMIT 1)                   AS plantings_in_peak_year
+    FROM
+        trees AS t
+            INNER JOIN public.tree_requests tr ON t.id = tr.tree_id
+            INNER JOIN residents r ON tr.resident_id = r.id
+            INNER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
+            INNER JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+    WHERE
+            pe.successful = TRUE
+        AND t.common_name = %s
+    GROUP BY t.common_name, r.neighborhood, t.id
+    ORDER BY t.common_name ASC;
+'''
+
+# Whether an entity named %s had its peak count %s in year %s, from the views that define
+# the rollups. Names aren't unique, so this asks whether any entity of that name did.
+SPECIES_TIE = '''
+    SELECT EXISTS (SELECT 1
+                   FROM species_yearly_plantings_computed s
+                            INNER JOIN trees t ON s.tree_id = t.id
+                   WHERE t.common_name = %s AND s.year = %s AND s.num_planted = %s);
+'''
+VOLUNTEER_TIE = '''
+    SELECT EXISTS (SELECT 1
+                   FROM volunteer_yearly_plantings_computed v
+                            INNER JOIN residents r ON v.volunteer_id = r.id
+                   WHERE r.first_name || ' ' || r.last_name = %s AND v.year = %s AND v.plantings_attended = %s);
+'''
+LED_TIE = '''
+    SELECT EXISTS (SELECT 1
+                   FROM org_member_yearly_activity_computed o
+                            INNER JOIN residents r ON o.organization_member_id = r.id
+                   WHERE r.first_name || ' ' || r.last_name = %s AND o.year = %s AND o.all_successful_plantings_led = %s);
+'''
+VISITS_TIE = '''
+    SELECT EXISTS (SELECT 1
+                   FROM org_member_yearly_activity_computed o
+                            INNER JOIN residents r ON o.organization_member_id = r.id
+                   WHERE r.first_name || ' ' || r.last_name = %s AND o.year = %s AND o.visits_attended = %s);
+'''
+NEIGHBORHOOD_TIE = '''
+    SELECT EXISTS (SELECT 1
+                   FROM neighborhood_species_yearly_plantings_computed
+                   WHERE neighborhood = %s AND year = %s
+                   GROUP BY year
+                   HAVING SUM(num_planted) = %s);
+'''
+
+# Each report: its earlier SQL, its current query, the query listing the arguments to run
+# it with, and its peak years as (name column, year column, count column, tie query)
+REPORTS = [
+    ('tree-species-statistics', OLD_TREE_SPECIES_STATISTICS, queries.TREE_SPECIES_STATISTICS, None,
+     [(0, 3, 4, SPECIES_TIE)]),
+    ('custom-report-1', OLD_CUSTOM_REPORT_1, queries.CUSTOM_REPORT_1, 'years',
+     [(0, 4, 5, VOLUNTEER_TIE)]),
+    ('custom-report-2', OLD_CUSTOM_REPORT_2, queries.CUSTOM_REPORT_2, 'years',
+     [(0, 3, 4, LED_TIE), (0, 6, 7, VISITS_TIE)]),
+    ('custom-report-3', OLD_CUSTOM_REPORT_3, queries.CUSTOM_REPORT_3, 'species',
+     [(1, 4, 5, NEIGHBORHOOD_TIE)]),
+]
+
+ARGUMENTS = {
+    # Every year with events, and the year before the first, which has none
+    'years': '''
+        SELECT year::TEXT
+        FROM (SELECT DISTINCT EXTRACT(YEAR FROM event_timestamp)::INTEGER AS year FROM scheduled_events
+              UNION
+              SELECT MIN(EXTRACT(YEAR FROM event_timestamp))::INTEGER - 1 FROM scheduled_events) years
+        ORDER BY year;
+    ''',
+    'species': 'SELECT common_name FROM trees ORDER BY common_name;',
+}
+
+
+def compare(cur, old_rows, new_rows, peaks):
+    """Lists how `new_rows` differ from `old_rows`, in any order, apart from tied peak years."""
+    years = {year for _, year, _, _ in peaks}
+
+    def masked(row):
+        return tuple(None if i in years else value for i, value in enumerate(row))
+    old_masked, new_masked = Counter(map(masked, old_rows)), Counter(map(masked, new_rows))
+    if old_masked != new_masked:
+        return ([f"only before: {row}" for row in (old_masked - new_masked).elements()]
+                + [f"only after: {row}" for row in (new_masked - old_masked).elements()])
+
+    problems = []
+    def order(row):
+        # Rows that only differ in their peak years end up side by side
+        return repr(masked(row)), repr(row)
+    for old, new in zip(sorted(old_rows, key=order), sorted(new_rows, key=order)):
+        for name, year, count, tie in peaks:
+            if old[year] == new[year]:
+                continue
+            tied = new[year] > old[year]
+            for candidate in (old[year], new[year]):
+                cur.execute(tie, (old[name], candidate, new[count]))
+                tied = tied and cur.fetchone()[0]
+            if not tied:
+                problems.append(f"{old[name]}: peak year {old[year]} before, {new[year]} after, "
+                                f"with {new[count]} in the peak year")
+    return problems
+
+
+def check(conn):
+    """Runs every report both ways for every argument. Returns (calls made, problems)."""
+    calls = 0
+    problems = []
+    with conn.cursor() as cur:
+        for report, old_sql, query, arguments, peaks in REPORTS:
+            if arguments:
+                cur.execute(ARGUMENTS[arguments])
+                runs = [(row[0],) for row in cur.fetchall()]
+            else:
+                runs = [()]
+            for args in runs:
+                cur.execute(old_sql, args * old_sql.count('%s'))
+                old_rows = cur.fetchall()
+                cur.execute(query.sql, args)
+                new_rows = cur.fetchall()
+                calls += 1
+                problems += [f"{report} {args}: {problem}" for problem in compare(cur, old_rows, new_rows, peaks)]
+    conn.rollback()
+    return calls, problems
+
+
+def main(args):
+    cluster = Cluster(find_pg_bin(args.pg_bin))
+    cluster.start()
+    try:
+        conn = psycopg2.connect(host=cluster.dir, port=cluster.port, user='postgres', database='postgres')
+        started = time.perf_counter()
+        counts = load(conn, args.scale, args.seed)
+        conn.autocommit = False
+        print(f"scale {args.scale}: loaded {sum(counts.values())} generated rows in "
+              f"{time.perf_counter() - started:.1f}s", flush=True)
+
+        calls, problems = check(conn)
+        print(f"  generated data: {calls} report calls, {len(problems)} differences", flush=True)
+        if not problems and args.writes:
+            random_writes(conn, random.Random(args.seed), args.writes)
+            calls, problems = check(conn)
+            print(f"  after {args.writes} random writes: {calls} report calls, {len(problems)} differences",
+                  flush=True)
+        conn.close()
+    finally:
+        cluster.stop()
+
+    if problems:
+        print(f"\n{len(problems)} differences:")
+        for problem in problems:
+            print(f"  {problem}")
+        sys.exit(1)
+    print("\nThe peak-year reports match their earlier SQL")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', type=int, default=1, help='datagen scale factor')
+    parser.add_argument('--writes', type=int, default=1000, help='random writes to make before checking again')
+    parser.add_argument('--seed', type=int, default=42, help='seed for datagen and the writes')
+    parser.add_argument('--pg-bin', help='directory with initdb and pg_ctl')
+    main(parser.parse_args())
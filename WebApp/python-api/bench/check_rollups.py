@@ -0,0 +1,289 @@
+"""Checks the trigger-maintained rollups against a throwaway local Postgres.
+
+Creates a temporary cluster the way bench/endpoints.py does, loads ddl.sql, dml.sql and
+datagen.generate(scale), applies the migrations, then makes --writes random inserts,
+updates and deletes of tree requests, permits, visits, plantings, planting crews and
+residents, with the triggers on. Afterwards check_neighborhood_rollup(),
+check_tree_request_statuses() and check_yearly_planting_rollups() must all return no
+rows. Exits with status 1, listing the differences, if they don't.
+
+    python bench/check_rollups.py --scale 1 --writes 2000
+"""
+import argparse
+import random
+import sys
+import time
+
+import psycopg2
+
+from endpoints import Cluster, find_pg_bin, load
+
+# How many random writes to make between checks, so a failure points at a short stretch
+CHECK_EVERY = 500
+
+
+def pick(cur, rng, query, args=None):
+    """A random row of `query`, or None if it returns none."""
+    cur.execute(query, args)
+    rows = cur.fetchall()
+    return rng.choice(rows) if rows else None
+
+
+def random_timestamp(cur, rng):
+    """A time within the last two years or the next month, with a partition to go to."""
+    cur.execute("SELECT (now() - make_interval(secs => %s))::TIMESTAMP(0);",
+                (rng.randint(-30 * 86400, 730 * 86400),))
+    timestamp = cur.fetchone()[0]
+    cur.execute('SELECT ensure_scheduled_event_partition(%s);', (timestamp,))
+    return timestamp
+
+
+def add_request(cur, rng):
+    resident = pick(cur, rng, 'SELECT id FROM residents ORDER BY id;')
+    tree = pick(cur, rng, 'SELECT id FROM trees ORDER BY id;')
+    cur.execute('''
+        INSERT INTO tree_requests (resident_id, submission_timestamp, tree_id, site_description, approved)
+        VALUES (%s, now() - make_interval(secs => %s), %s, 'random write', %s)
+        ON CONFLICT DO NOTHING;
+    ''', (resident[0], rng.randint(0, 730 * 86400), tree[0], rng.choice([None, True, False])))
+
+
+def approve_request(cur, rng):
+    request = pick(cur, rng, 'SELECT id FROM tree_requests ORDER BY id;')
+    cur.execute('UPDATE tree_requests SET approved = %s WHERE id = %s;', (rng.choice([None, True, False]), request[0]))
+
+
+def move_request(cur, rng):
+    request = pick(cur, rng, 'SELECT id FROM tree_requests ORDER BY id;')
+    resident = pick(cur, rng, 'SELECT id FROM residents ORDER BY id;')
+    cur.execute('''
+        UPDATE tree_requests tr SET resident_id = %s
+        WHERE id = %s
+          AND NOT EXISTS (SELECT 1 FROM tree_requests o
+                          WHERE o.resident_id = %s AND o.submission_timestamp = tr.submission_timestamp);
+    ''', (resident[0], request[0], resident[0]))
+
+
+def delete_request(cur, rng):
+    request = pick(cur, rng, 'SELECT id FROM tree_requests ORDER BY id;')
+    # Permits don't cascade; the visits and plantings do
+    cur.execute('DELETE FROM permits WHERE tree_request_id = %s;', request)
+    cur.execute('DELETE FROM tree_requests WHERE id = %s;', request)
+
+
+def set_permit(cur, rng):
+    request = pick(cur, rng, 'SELECT id FROM tree_requests ORDER BY id;')
+    cur.execute('''
+        INSERT INTO permits (resident_id, tree_request_id, status, decision_date)
+        SELECT resident_id, id, %s, CURRENT_DATE FROM tree_requests WHERE id = %s
+        ON CONFLICT (resident_id, tree_request_id) DO UPDATE SET status = EXCLUDED.status;
+    ''', (rng.choice(['pending', 'approved', 'denied']), request[0]))
+
+
+def delete_permit(cur, rng):
+    permit = pick(cur, rng, 'SELECT resident_id, tree_request_id FROM permits ORDER BY 1, 2;')
+    if permit:
+        cur.execute('DELETE FROM permits WHERE resident_id = %s AND tree_request_id = %s;', permit)
+
+
+def schedule_visit(cur, rng):
+    request = pick(cur, rng, 'SELECT id FROM tree_requests ORDER BY id;')
+    member = pick(cur, rng, 'SELECT resident_id FROM organization_members ORDER BY resident_id;')
+    cur.execute('''
+        INSERT INTO scheduled_visits (tree_request_id, event_timestamp, cancelled, organization_member_id)
+        VALUES (%s, %s, %s, %s);
+    ''', (request[0], random_timestamp(cur, rng), rng.random() < 0.1, member[0]))
+
+
+def record_visit(cur, rng):
+    visit = pick(cur, rng, '''
+        SELECT event_id FROM scheduled_visits sv
+        WHERE NOT EXISTS (SELECT 1 FROM visit_events ve WHERE ve.scheduled_visit_id = sv.event_id)
+        ORDER BY event_id;
+    ''')
+    if visit:
+        cur.execute('''
+            INSERT INTO visit_events (scheduled_visit_id, observations, additional_visit_required)
+            VALUES (%s, 'random write', %s);
+        ''', (visit[0], rng.choice([None, True, False])))
+
+
+def update_visit(cur, rng):
+    visit = pick(cur, rng, 'SELECT scheduled_visit_id FROM visit_events ORDER BY 1;')
+    if visit:
+        cur.execute('UPDATE visit_events SET additional_visit_required = %s WHERE scheduled_visit_id = %s;',
+                    (rng.choice([None, True, False]), visit[0]))
+
+
+def delete_visit(cur, rng):
+    visit = pick(cur, rng, 'SELECT event_id FROM scheduled_visits ORDER BY event_id;')
+    if visit:
+        table = rng.choice(['visit_events', 'scheduled_visits'])
+        column = 'scheduled_visit_id' if table == 'visit_events' else 'event_id'
+        cur.execute(f'DELETE FROM {table} WHERE {column} = %s;', visit)
+
+
+def schedule_planting(cur, rng):
+    request = pick(cur, rng, 'SELECT id FROM tree_requests ORDER BY id;')
+    cur.execute('''
+        INSERT INTO scheduled_plantings (tree_request_id, event_timestamp, cancelled)
+        VALUES (%s, %s, %s);
+    ''', (request[0], random_timestamp(cur, rng), rng.random() < 0.1))
+
+
+def change_planting(cur, rng):
+    planting = pick(cur, rng, 'SELECT event_id FROM scheduled_plantings ORDER BY event_id;')
+    if not planting:
+        return
+    change = rng.choice(['reschedule', 'move', 'cancel'])
+    if change == 'reschedule':
+        # Moves it to another year's partition, and the rows that reference it with it
+        cur.execute('UPDATE scheduled_plantings SET event_timestamp = %s WHERE event_id = %s;',
+                    (random_timestamp(cur, rng), planting[0]))
+    elif change == 'move':
+        request = pick(cur, rng, 'SELECT id FROM tree_requests ORDER BY id;')
+        cur.execute('UPDATE scheduled_plantings SET tree_request_id = %s WHERE event_id = %s;',
+                    (request[0], planting[0]))
+    else:
+        cur.execute('UPDATE scheduled_plantings SET cancelled = NOT COALESCE(cancelled, FALSE) WHERE event_id = %s;',
+                    planting)
+
+
+def record_planting(cur, rng):
+    planting = pick(cur, rng, '''
+        SELECT event_id FROM scheduled_plantings sp
+        WHERE NOT EXISTS (SELECT 1 FROM planting_events pe WHERE pe.scheduled_planting_id = sp.event_id)
+        ORDER BY event_id;
+    ''')
+    if planting:
+        cur.execute('''
+            INSERT INTO planting_events (scheduled_planting_id, observations, successful)
+            VALUES (%s, 'random write', %s);
+        ''', (planting[0], rng.random() < 0.8))
+
+
+def update_planting(cur, rng):
+    planting = pick(cur, rng, 'SELECT scheduled_planting_id FROM planting_events ORDER BY 1;')
+    if planting:
+        cur.execute('UPDATE planting_events SET successful = NOT successful WHERE scheduled_planting_id = %s;',
+                    planting)
+
+
+def delete_planting(cur, rng):
+    planting = pick(cur, rng, 'SELECT event_id FROM scheduled_plantings ORDER BY event_id;')
+    if planting:
+        table = rng.choice(['planting_events', 'scheduled_plantings'])
+        column = 'scheduled_planting_id' if table == 'planting_events' else 'event_id'
+        cur.execute(f'DELETE FROM {table} WHERE {column} = %s;', planting)
+
+
+def change_crew(cur, rng):
+    planting = pick(cur, rng, 'SELECT scheduled_planting_id FROM planting_events ORDER BY 1;')
+    if not planting:
+        return
+    if rng.random() < 0.5:
+        volunteer = pick(cur, rng, 'SELECT id FROM residents WHERE is_volunteer = TRUE ORDER BY id;')
+        cur.execute('''
+            INSERT INTO planting_events_have_volunteers (planting_event_id, volunteer_id) VALUES (%s, %s)
+            ON CONFLICT DO NOTHING;
+        ''', (planting[0], volunteer[0]))
+    else:
+        member = pick(cur, rng, 'SELECT resident_id FROM organization_members ORDER BY resident_id;')
+        cur.execute('''
+            INSERT INTO organization_members_lead_scheduled_plantings (organization_member_id, scheduled_planting_id)
+            VALUES (%s, %s)
+            ON CONFLICT DO NOTHING;
+        ''', (member[0], planting[0]))
+
+
+def remove_crew(cur, rng):
+    table, column = rng.choice([('planting_events_have_volunteers', 'planting_event_id'),
+                                ('organization_members_lead_scheduled_plantings', 'scheduled_planting_id')])
+    planting = pick(cur, rng, f'SELECT DISTINCT {column} FROM {table} ORDER BY 1;')
+    if planting:
+        cur.execute(f'DELETE FROM {table} WHERE {column} = %s;', planting)
+
+
+def move_resident(cur, rng):
+    resident = pick(cur, rng, 'SELECT id FROM residents ORDER BY id;')
+    neighborhood = pick(cur, rng, 'SELECT name FROM neighborhoods ORDER BY name;')
+    cur.execute('UPDATE residents SET neighborhood = %s WHERE id = %s;', (neighborhood[0], resident[0]))
+
+
+# Each write with how often it is picked, roughly how the API's traffic is mixed
+WRITES = [
+    (add_request, 6), (approve_request, 4), (move_request, 1), (delete_request, 2),
+    (set_permit, 4), (delete_permit, 1),
+    (schedule_visit, 4), (record_visit, 4), (update_visit, 2), (delete_visit, 2),
+    (schedule_planting, 4), (change_planting, 3), (record_planting, 4), (update_planting, 2), (delete_planting, 2),
+    (change_crew, 4), (remove_crew, 1), (move_resident, 1),
+]
+
+
+def random_writes(conn, rng, count):
+    """Makes `count` random writes, each in its own transaction. Returns how many of each were made."""
+    writes, weights = zip(*WRITES)
+    made = {}
+    with conn.cursor() as cur:
+        for write in rng.choices(writes, weights, k=count):
+            write(cur, rng)
+            conn.commit()
+            made[write.__name__] = made.get(write.__name__, 0) + 1
+    return made
+
+
+def check(conn):
+    """Lists what disagrees with the query it replaced, as printable lines."""
+    with conn.cursor() as cur:
+        cur.execute('SELECT neighborhood_name, rollup, computed FROM check_neighborhood_rollup();')
+        problems = [f"neighborhood report, {name}: rollup {rollup}, computed {computed}"
+                    for name, rollup, computed in cur.fetchall()]
+        cur.execute('SELECT tree_request_id, stored_status, computed_status FROM check_tree_request_statuses();')
+        problems += [f"tree request {tree_request_id}: stored {stored!r}, computed {computed!r}"
+                     for tree_request_id, stored, computed in cur.fetchall()]
+        cur.execute('SELECT rollup, source, row_value FROM check_yearly_planting_rollups();')
+        problems += [f"{rollup} {source}: {row_value}" for rollup, source, row_value in cur.fetchall()]
+    conn.rollback()
+    return problems
+
+
+def main(args):
+    cluster = Cluster(find_pg_bin(args.pg_bin))
+    cluster.start()
+    try:
+        conn = psycopg2.connect(host=cluster.dir, port=cluster.port, user='postgres', database='postgres')
+        started = time.perf_counter()
+        counts = load(conn, args.scale, args.seed)
+        conn.autocommit = False
+        print(f"scale {args.scale}: loaded {sum(counts.values())} generated rows in "
+              f"{time.perf_counter() - started:.1f}s", flush=True)
+
+        problems = check(conn)
+        rng = random.Random(args.seed)
+        done = 0
+        while not problems and done < args.writes:
+            batch = min(CHECK_EVERY, args.writes - done)
+            made = random_writes(conn, rng, batch)
+            done += batch
+            problems = check(conn)
+            print(f"  {done} writes ({', '.join(f'{name} {n}' for name, n in sorted(made.items()))}): "
+                  f"{len(problems)} differences", flush=True)
+        conn.close()
+    finally:
+        cluster.stop()
+
+    if problems:
+        print(f"\n{len(problems)} differences after {done} writes:")
+        for problem in problems:
+            print(f"  {problem}")
+        sys.exit(1)
+    print(f"\nThe rollups match after {done} random writes")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', type=int, default=1, help='datagen scale factor')
+    parser.add_argument('--writes', type=int, default=2000, help='random writes to make')
+    parser.add_argument('--seed', type=int, default=42, help='seed for datagen and the writes')
+    parser.add_argument('--pg-bin', help='directory with initdb and pg_ctl')
+    main(parser.parse_args())
@@ -0,0 +1,341 @@
+"""Per-endpoint latency benchmark against a throwaway local Postgres.
+
+Creates a temporary cluster with initdb, and for each scale factor loads ddl.sql,
+dml.sql and datagen.generate(scale) into it (scale 0 is dml.sql alone) and applies
+the migrations in /migrations (unless --skip-migrations). It then
+calls every GET endpoint of the Flask app in-process and records p50/p95/p99
+latency, the number of rows returned, and the time spent in Postgres (measured
+around every cursor.execute). The report cache is off so each call hits the
+database. Runs offline; only needs the PostgreSQL server binaries.
+
+    python bench/endpoints.py --scales 0,1,10 --iterations 30
+    python bench/endpoints.py --compare bench/results/<earlier run>.json
+
+Results are written to bench/results/<commit>-<time>.json. With --compare, the
+p50 and DB time of each endpoint are shown next to the earlier run's.
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+import psycopg2.extensions
+
+PYTHON_API = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO = os.path.dirname(os.path.dirname(PYTHON_API))
+sys.path.insert(0, PYTHON_API)
+
+# Every GET route, with the query string used to call it. {name} placeholders are filled
+# in per scale from pick_arguments(), so they always point at rows that exist.
+ENDPOINTS = [
+    '/api/test',
+    '/api/tree-requests?resident_id={resident_id}',
+    '/api/details?resident_id={resident_id}&tree_request_id={tree_request_id}',
+    '/api/is_organization_member?user_id={member_id}',
+    '/api/all-tree-requests',
+    '/api/all-tree-requests?status=completed',
+    '/api/tree-request-details-admin?tree_request_id={tree_request_id}',
+    '/api/tree-request-details-admin?tree_request_ids={tree_request_ids}',
+    '/api/trees',
+    '/api/neighborhoods',
+    '/api/tree-requests-status',
+    '/api/trees-planted?neighborhood={neighborhood}',
+    '/api/tree-species-statistics',
+    '/api/neighborhood-report',
+    '/api/custom-report-1?year={year}',
+    '/api/custom-report-2?year={year}',
+    '/api/custom-report-3?common_name={common_name}',
+    '/api/custom-report-4?min_height=0&max_height=200&min_width=0&max_width=200',
+    '/api/custom-report-5',
+    '/api/trees/search?max_height=40&growth_rate=fast&growth_rate=moderate&limit=5',
+    '/api/pending-volunteer-applications',
+    '/api/scheduled-planting-details/{planting_id}',
+    '/api/scheduled-planting-details?ids={planting_ids}',
+    '/api/available-volunteers',
+    '/api/available-org-members',
+    '/api/visit-details/{visit_id}',
+]
+
+# Routes that are not worth timing (they only report in-process counters)
+SKIPPED = {'/api/pool-stats', '/api/cache-stats'}
+
+
+class TimingCursor(psycopg2.extensions.cursor):
+    """Adds the wall time of every execute() to TimingCursor.elapsed."""
+    elapsed = 0.0
+    queries = 0
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            TimingCursor.elapsed += time.perf_counter() - started
+            TimingCursor.queries += 1
+
+
+def find_pg_bin(pg_bin):
+    candidates = [pg_bin, os.getenv('PG_BIN')]
+    if shutil.which('pg_config'):
+        candidates.append(subprocess.run(['pg_config', '--bindir'], capture_output=True, text=True).stdout.strip())
+    if shutil.which('initdb'):
+        candidates.append(os.path.dirname(shutil.which('initdb')))
+    candidates.extend(sorted(
+        (os.path.join('/usr/lib/postgresql', version, 'bin') for version in
+         (os.listdir('/usr/lib/postgresql') if os.path.isdir('/usr/lib/postgresql') else [])),
+        reverse=True))
+    for candidate in candidates:
+        if candidate and os.path.exists(os.path.join(candidate, 'initdb')):
+            return candidate
+    raise SystemExit("Could not find initdb. Pass --pg-bin or set PG_BIN to the PostgreSQL bin directory.")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Cluster:
+    """A temporary Postgres cluster listening only on a Unix socket in its own directory."""
+
+    def __init__(self, pg_bin):
+        self.pg_bin = pg_bin
+        self.dir = tempfile.mkdtemp(prefix='oakhoury-bench-')
+        self.data = os.path.join(self.dir, 'data')
+        self.port = free_port()
+
+    def run(self, tool, *args):
+        subprocess.run([os.path.join(self.pg_bin, tool), *args], check=True, stdout=subprocess.DEVNULL)
+
+    def start(self):
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            raise SystemExit("initdb refuses to run as root. Run the benchmark as an unprivileged user.")
+        self.run('initdb', '-D', self.data, '-U', 'postgres', '--auth=trust', '--no-sync', '-E', 'UTF8')
+        options = f"-p {self.port} -k {self.dir} -c listen_addresses='' -c fsync=off"
+        self.run('pg_ctl', '-D', self.data, '-o', options, '-l', os.path.join(self.dir, 'log'), '-w', 'start')
+
+    def stop(self):
+        if os.path.exists(os.path.join(self.data, 'postmaster.pid')):
+            self.run('pg_ctl', '-D', self.data, '-m', 'fast', '-w', 'stop')
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def environment(self, database):
+        return {'POSTGRES_HOST': self.dir, 'POSTGRES_PORT': str(self.port), 'POSTGRES_DB': database,
+                'POSTGRES_USERNAME': 'postgres', 'POSTGRES_PASSWORD': ''}
+
+
+def load(conn, scale, seed, migrations=True):
+    """Recreates the schema, loads dml.sql plus `scale` units of generated data, then migrates it."""
+    import datagen
+    import migrate
+
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+        for script in ('ddl.sql', 'dml.sql'):
+            with open(os.path.join(REPO, script)) as f:
+                cur.execute(f.read())
+        conn.commit()
+        counts = datagen.generate(conn, scale=scale, seed=seed) if scale else {}
+    if migrations:
+        # Applied to the loaded data, the way they would reach an existing database
+        migrate.migrate(conn)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('ANALYZE;')
+    return counts
+
+
+def pick_arguments(conn):
+    """Chooses ids and names that the endpoints' parameters should point at for this dataset."""
+    with conn.cursor() as cur:
+        cur.execute('''
+            SELECT tr.resident_id, tr.id
+            FROM tree_requests tr
+                     INNER JOIN permits p ON tr.id = p.tree_request_id
+                     INNER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
+            ORDER BY (SELECT COUNT(*) FROM tree_requests tr2 WHERE tr2.resident_id = tr.resident_id) DESC, tr.id
+            LIMIT 1;
+        ''')
+        resident_id, tree_request_id = cur.fetchone()
+        cur.execute('SELECT MIN(resident_id) FROM organization_members;')
+        member_id = cur.fetchone()[0]
+        # The most recent successful planting gives a neighborhood, year and species with data
+        cur.execute('''
+            SELECT r.neighborhood, EXTRACT(YEAR FROM sp.event_timestamp)::INT, t.common_name, sp.event_id
+            FROM planting_events pe
+                     INNER JOIN scheduled_plantings sp ON pe.scheduled_planting_id = sp.event_id
+                     INNER JOIN tree_requests tr ON sp.tree_request_id = tr.id
+                     INNER JOIN residents r ON tr.resident_id = r.id
+                     INNER JOIN trees t ON tr.tree_id = t.id
+            WHERE pe.successful = TRUE
+            ORDER BY sp.event_timestamp DESC
+            LIMIT 1;
+        ''')
+        neighborhood, year, common_name, planting_id = cur.fetchone()
+        cur.execute('SELECT MIN(scheduled_visit_id) FROM visit_events;')
+        visit_id = cur.fetchone()[0]
+        # The first admin listing page and a schedule's worth of plantings, for the batch endpoints
+        cur.execute('SELECT id FROM tree_requests ORDER BY submission_timestamp DESC, id DESC LIMIT 50;')
+        tree_request_ids = ','.join(str(row[0]) for row in cur.fetchall())
+        cur.execute('SELECT event_id FROM scheduled_plantings ORDER BY event_timestamp DESC, event_id LIMIT 20;')
+        planting_ids = ','.join(str(row[0]) for row in cur.fetchall())
+    conn.rollback()
+    return {'resident_id': resident_id, 'tree_request_id': tree_request_id, 'tree_request_ids': tree_request_ids,
+            'member_id': member_id, 'neighborhood': neighborhood, 'year': year, 'common_name': common_name,
+            'planting_id': planting_id, 'planting_ids': planting_ids, 'visit_id': visit_id}
+
+
+def count_rows(body):
+    if isinstance(body, list):
+        return len(body)
+    return 0 if body is None else 1
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def measure(client, url, iterations, warmup):
+    for _ in range(warmup):
+        client.get(url)
+    latencies = []
+    db_times = []
+    queries = 0
+    status = rows = None
+    for _ in range(iterations):
+        TimingCursor.elapsed = 0.0
+        TimingCursor.queries = 0
+        started = time.perf_counter()
+        response = client.get(url)
+        latencies.append(time.perf_counter() - started)
+        db_times.append(TimingCursor.elapsed)
+        queries = TimingCursor.queries
+        status = response.status_code
+        rows = count_rows(response.get_json(silent=True))
+    latencies.sort()
+    return {
+        'status': status,
+        'rows': rows,
+        'queries': queries,
+        'iterations': iterations,
+        'mean_ms': statistics.fmean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'db_ms': statistics.fmean(db_times) * 1000,
+    }
+
+
+def git_commit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True, text=True)
+    return result.stdout.strip() or 'unknown'
+
+
+def print_comparison(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['scale'], r['endpoint']): r for r in json.load(f)['results']}
+    print(f"\n{'scale':>5}  {'endpoint':75} {'p50 ms':>16} {'db ms':>16}")
+    for r in results:
+        old = baseline.get((r['scale'], r['endpoint']))
+        if old is None:
+            continue
+
+        def change(key):
+            if not old[key]:
+                return f"{r[key]:7.2f}"
+            return f"{r[key]:7.2f} {(r[key] - old[key]) / old[key]:+7.0%}"
+        print(f"{r['scale']:>5}  {r['endpoint']:75} {change('p50_ms'):>16} {change('db_ms'):>16}")
+
+
+def main(args):
+    scales = [int(scale) for scale in args.scales.split(',')]
+    cluster = Cluster(find_pg_bin(args.pg_bin))
+    cluster.start()
+    try:
+        admin = psycopg2.connect(host=cluster.dir, port=cluster.port, user='postgres', database='postgres')
+        admin.autocommit = True
+        with admin.cursor() as cur:
+            cur.execute('CREATE DATABASE oak_bench;')
+            cur.execute('SHOW server_version;')
+            server_version = cur.fetchone()[0]
+        admin.close()
+
+        # Point the app at the cluster before it is imported and loads .env
+        os.environ.update(cluster.environment('oak_bench'))
+        os.environ['REPORT_CACHE_MAX_ENTRIES'] = '0'
+        from app import app
+        from db import configure_pool, connect, get_pool
+
+        covered = {re.sub(r'\{\w+\}', '*', endpoint.split('?')[0]) for endpoint in ENDPOINTS}
+        for rule in app.url_map.iter_rules():
+            path = re.sub(r'<[^>]+>', '*', rule.rule)
+            if 'GET' in rule.methods and path.startswith('/api/') and path not in covered | SKIPPED:
+                print(f"warning: {rule.rule} is not in ENDPOINTS and will not be measured")
+
+        client = app.test_client()
+        results = []
+        for scale in scales:
+            conn = connect()
+            started = time.perf_counter()
+            counts = load(conn, scale, args.seed, migrations=not args.skip_migrations)
+            arguments = pick_arguments(conn)
+            conn.close()
+            print(f"scale {scale}: loaded {sum(counts.values())} generated rows in "
+                  f"{time.perf_counter() - started:.1f}s", flush=True)
+            configure_pool(min_size=1, max_size=2, connect=lambda: connect(cursor_factory=TimingCursor))
+            for endpoint in ENDPOINTS:
+                url = endpoint.format(**arguments)
+                result = measure(client, url, args.iterations, args.warmup)
+                result.update({'scale': scale, 'endpoint': endpoint, 'url': url})
+                results.append(result)
+                print(f"  {endpoint:75} {result['status']} rows {result['rows']:>6}  "
+                      f"p50 {result['p50_ms']:8.2f}  p95 {result['p95_ms']:8.2f}  p99 {result['p99_ms']:8.2f}  "
+                      f"db {result['db_ms']:8.2f} ms", flush=True)
+        get_pool().closeall()
+    finally:
+        cluster.stop()
+
+    commit = git_commit()
+    output = args.output or os.path.join(
+        PYTHON_API, 'bench', 'results', f"{commit}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'postgres': server_version,
+            'python': sys.version.split()[0],
+            'scales': scales,
+            'iterations': args.iterations,
+            'seed': args.seed,
+            'migrations': not args.skip_migrations,
+            'results': results,
+        }, f, indent=2)
+    print(f"\nWrote {output}")
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', default='0,1,10', help='comma separated datagen scale factors')
+    parser.add_argument('--iterations', type=int, default=30, help='timed calls per endpoint and scale')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed calls before measuring')
+    parser.add_argument('--seed', type=int, default=42, help='datagen seed, keep it fixed to compare runs')
+    parser.add_argument('--pg-bin', help='directory with initdb and pg_ctl')
+    parser.add_argument('--output', help='where to write the JSON results')
+    parser.add_argument('--compare', help='an earlier results file to compare against')
+    parser.add_argument('--skip-migrations', action='store_true',
+                        help='benchmark the ddl.sql schema alone, e.g. for before/after numbers of a migration '
+                             '(endpoints that read tables a migration adds will fail)')
+    main(parser.parse_args())
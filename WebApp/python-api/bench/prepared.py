@@ -0,0 +1,128 @@
+"""Planning time saved by running the hot queries as prepared statements.
+
+For each query, against the database in .env, prints the planning time Postgres reports
+for it (EXPLAIN ANALYZE), then the mean time per call when sending the SQL text each
+time and when executing it through statements.execute(), on one connection. Run from
+/python-api, ideally after "flask --app app generate-data --scale N":
+
+    python bench/prepared.py --iterations 200
+
+The two are timed in alternating rounds and the best round of each is kept, to damp
+noise. Prepared statements use custom plans, planned for their parameters on every
+call, for their first five executions and then switch to a generic plan only if it
+isn't estimated to cost more; the "plan" column shows which one each query settled
+on. Queries left on custom plans only save parsing.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import queries  # noqa: E402
+import statements  # noqa: E402
+from db import connect  # noqa: E402
+
+
+def pick_arguments(cur):
+    cur.execute('''
+        SELECT (SELECT EXTRACT(YEAR FROM MAX(event_timestamp))::INTEGER FROM scheduled_plantings),
+               (SELECT common_name FROM trees t WHERE EXISTS (SELECT FROM tree_requests WHERE tree_id = t.id)
+                ORDER BY id LIMIT 1),
+               (SELECT neighborhood FROM residents GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1),
+               (SELECT resident_id FROM tree_requests GROUP BY 1 ORDER BY COUNT(*) DESC LIMIT 1),
+               (SELECT ARRAY_AGG(id) FROM (SELECT id FROM tree_requests ORDER BY id DESC LIMIT 25) latest),
+               (SELECT ARRAY_AGG(event_id) FROM (SELECT event_id FROM scheduled_plantings LIMIT 25) latest);
+    ''')
+    return dict(zip(('year', 'common_name', 'neighborhood', 'resident_id', 'tree_request_ids', 'planting_ids'),
+                    cur.fetchone()))
+
+
+def cases(args):
+    tree_requests, tree_requests_params, _ = queries.tree_requests_page(args['resident_id'], {})
+    all_tree_requests, all_tree_requests_params, _ = queries.all_tree_requests_page({})
+    return {
+        'tree-requests': (tree_requests, tree_requests_params),
+        'all-tree-requests': (all_tree_requests, all_tree_requests_params),
+        'tree-request-details-admin': (queries.TREE_REQUEST_DETAILS_ADMIN, (args['tree_request_ids'],)),
+        'scheduled-planting-details': (queries.SCHEDULED_PLANTING_DETAILS, (args['planting_ids'],)),
+        'trees': (queries.TREES, None),
+        'tree-requests-status': (queries.TREE_REQUESTS_STATUS, None),
+        'trees-planted': (queries.TREES_PLANTED, (args['neighborhood'],)),
+        'tree-species-statistics': (queries.TREE_SPECIES_STATISTICS, None),
+        'neighborhood-report': (queries.NEIGHBORHOOD_REPORT, None),
+        'custom-report-1': (queries.CUSTOM_REPORT_1, (args['year'],)),
+        'custom-report-2': (queries.CUSTOM_REPORT_2, (args['year'],)),
+        'custom-report-3': (queries.CUSTOM_REPORT_3, (args['common_name'],)),
+        'custom-report-5': (queries.CUSTOM_REPORT_5, None),
+        'tree-catalog': (queries.TREE_CATALOG, None),
+    }
+
+
+def planning_ms(cur, query, params):
+    cur.execute('EXPLAIN (ANALYZE, TIMING OFF, FORMAT JSON) ' + query.sql, params)
+    return cur.fetchone()[0][0]['Planning Time']
+
+
+def mean_ms(conn, run, iterations):
+    with conn.cursor() as cur:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            run(cur)
+            cur.fetchall()
+            conn.rollback()
+    return (time.perf_counter() - started) / iterations * 1000
+
+
+def plan_kind(conn, query):
+    with conn.cursor() as cur:
+        cur.execute('SELECT generic_plans, custom_plans FROM pg_prepared_statements WHERE name = %s',
+                    (statements.statement_name(query.sql),))
+        generic, custom = cur.fetchone()
+    conn.rollback()
+    return 'generic' if generic > custom else 'custom'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help="print the results as JSON")
+    args = parser.parse_args()
+
+    conn = connect()
+    with conn.cursor() as cur:
+        arguments = pick_arguments(cur)
+    conn.rollback()
+    results = {}
+    for name, (query, params) in cases(arguments).items():
+        with conn.cursor() as cur:
+            planning = planning_ms(cur, query, params)
+        conn.rollback()
+        runs = {'text': lambda cur: cur.execute(query.sql, params),
+                'prepared': lambda cur: statements.execute(cur, query, params)}
+        for run in runs.values():
+            mean_ms(conn, run, args.warmup)
+        best = {mode: float('inf') for mode in runs}
+        for _ in range(args.rounds):
+            for mode, run in runs.items():
+                best[mode] = min(best[mode], mean_ms(conn, run, max(args.iterations // args.rounds, 1)))
+        results[name] = {'planning_ms': planning, 'text_ms': best['text'], 'prepared_ms': best['prepared'],
+                         'plan': plan_kind(conn, query)}
+    conn.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'query':28} {'planning':>10} {'text':>10} {'prepared':>10} {'saved':>6}  plan")
+    for name, result in results.items():
+        saved = 1 - result['prepared_ms'] / result['text_ms']
+        print(f"{name:28} {result['planning_ms']:8.3f}ms {result['text_ms']:8.3f}ms "
+              f"{result['prepared_ms']:8.3f}ms {saved:6.0%}  {result['plan']}")
+
+
+if __name__ == '__main__':
+    main()
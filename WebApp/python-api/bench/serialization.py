@@ -0,0 +1,73 @@
+"""CPU and memory per row of turning query rows into a JSON response body.
+
+Compares what the routes did before serialize.py (a dict per row, then Flask's default
+JSON provider) with serialize.dumps_rows() as an array of objects and as ?format=columnar,
+on generated rows shaped like the admin tree request listing. Needs no database. Run
+from /python-api:
+
+    python bench/serialization.py --rows 100000
+
+Time is the best of --repeat runs; memory is the peak traced by tracemalloc while
+encoding, on top of the rows themselves.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serialize  # noqa: E402
+
+COLUMNS = ('id', 'submission_timestamp', 'approved', 'status', 'common_name', 'scientific_name')
+STATUSES = ('pending approval', 'waiting for visit', 'needs permit', 'waiting for planting', 'completed')
+
+
+def make_rows(count):
+    start = datetime(2023, 1, 1)
+    return [(i, start + timedelta(minutes=17 * i), i % 3 != 0, STATUSES[i % len(STATUSES)], f'Tree {i % 64}',
+             f'Quercus species {i % 64}') for i in range(count)]
+
+
+def measure(encode, rows, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = encode(rows)
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    encode(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    flask_json = DefaultJSONProvider(app)
+    encoders = {
+        'dict per row + Flask': lambda rows: flask_json.response([dict(zip(COLUMNS, row)) for row in rows]).get_data(),
+        'dumps_rows': lambda rows: serialize.dumps_rows(COLUMNS, rows),
+        'dumps_rows columnar': lambda rows: serialize.dumps_rows(COLUMNS, rows, columnar=True),
+    }
+    rows = make_rows(args.rows)
+    print(f"{args.rows} rows, encoder: {'orjson' if serialize.orjson else 'json (standard library)'}")
+    print(f"{'':24} {'us/row':>8} {'peak bytes/row':>15} {'body bytes/row':>15}")
+    with app.app_context():
+        for name, encode in encoders.items():
+            seconds, peak, size = measure(encode, rows, args.repeat)
+            print(f"{name:24} {seconds / args.rows * 1e6:8.2f} {peak / args.rows:15.0f} {size / args.rows:15.0f}")
+
+
+if __name__ == '__main__':
+    main()
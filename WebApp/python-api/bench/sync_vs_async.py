@@ -0,0 +1,130 @@
+"""Requests/second of the Flask (sync) and ASGI (async) serving modes, side by side.
+
+Starts both servers against the database in .env, keeps a fixed number of requests
+in flight against each read endpoint for a few seconds, and prints throughput and
+latency for each mode. Run from /python-api:
+
+    python bench/sync_vs_async.py --concurrency 32 --duration 10
+
+Both servers get the same pool size. The report cache is turned off (unless --cache)
+so every request reaches Postgres. Needs the packages in requirements-async.txt.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+ENDPOINTS = [
+    '/api/trees',
+    '/api/neighborhoods',
+    '/api/tree-requests?resident_id=1',
+    '/api/details?resident_id=1&tree_request_id=1',
+    '/api/all-tree-requests',
+    '/api/tree-request-details-admin?tree_request_id=1',
+    '/api/neighborhood-report',
+    '/api/tree-species-statistics',
+]
+
+SERVERS = {
+    'sync': [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--with-threads', '--port', '{port}'],
+    'async': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--log-level', 'warning', '--port', '{port}'],
+}
+
+
+def start_server(mode, port, env):
+    command = [part.format(port=port) for part in SERVERS[mode]]
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_until_up(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get('/api/neighborhoods')
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start")
+
+
+async def load(base_url, path, concurrency, duration):
+    """Keeps `concurrency` requests in flight for `duration` seconds."""
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        deadline = time.monotonic() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.monotonic() - started
+
+    result = {'requests': len(latencies), 'errors': errors, 'rps': len(latencies) / elapsed}
+    if latencies:
+        latencies.sort()
+        result['p50_ms'] = statistics.median(latencies) * 1000
+        result['p99_ms'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    return result
+
+
+async def main(args):
+    env = dict(os.environ, POSTGRES_POOL_MAX=str(args.pool_size))
+    if not args.cache:
+        env['REPORT_CACHE_MAX_ENTRIES'] = '0'
+    ports = {'sync': args.port, 'async': args.port + 1}
+    servers = {mode: start_server(mode, port, env) for mode, port in ports.items()}
+    results = []
+    try:
+        for mode, port in ports.items():
+            await wait_until_up(f'http://127.0.0.1:{port}')
+        for path in args.endpoints or ENDPOINTS:
+            for mode, port in ports.items():
+                # Warm up the pool and the plan cache before measuring
+                await load(f'http://127.0.0.1:{port}', path, args.concurrency, 1)
+                result = await load(f'http://127.0.0.1:{port}', path, args.concurrency, args.duration)
+                result.update({'endpoint': path, 'mode': mode, 'concurrency': args.concurrency})
+                results.append(result)
+                print(f"{path:55} {mode:5} {result['rps']:8.1f} req/s  "
+                      f"p50 {result.get('p50_ms', 0):7.1f} ms  p99 {result.get('p99_ms', 0):7.1f} ms  "
+                      f"errors {result['errors']}", flush=True)
+    finally:
+        for server in servers.values():
+            server.terminate()
+            server.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--concurrency', type=int, default=32, help='requests kept in flight')
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured per endpoint and mode')
+    parser.add_argument('--pool-size', type=int, default=10, help='POSTGRES_POOL_MAX for both servers')
+    parser.add_argument('--port', type=int, default=5101, help='sync server port, async uses the next one')
+    parser.add_argument('--cache', action='store_true', help='leave the report cache on')
+    parser.add_argument('--output', help='also write the results to this JSON file')
+    parser.add_argument('endpoints', nargs='*', help='paths to benchmark instead of the defaults')
+    asyncio.run(main(parser.parse_args()))
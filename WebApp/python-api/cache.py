@@ -0,0 +1,291 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, g, request
+
+
+class MemoryBackend:
+    """Process-local LRU store. Only correct when the API runs as a single process."""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def versions(self, tables):
+        with self._lock:
+            return [self._versions.get(table, 0) for table in tables]
+
+    def bump(self, tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'backend': 'memory', 'entries': len(self._entries), 'max_entries': self.max_entries,
+                          'versions': dict(self._versions)})
+        return stats
+
+
+class RedisBackend:
+    """LRU store in Redis, shared by every API worker pointed at the same server."""
+
+    def __init__(self, url, max_entries=256, prefix='oakhoury:report-cache:'):
+        import redis  # Optional dependency, only needed for a shared cache
+
+        self.max_entries = max_entries
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._lru = prefix + 'lru'
+        self._versions = prefix + 'versions'
+        self._stats = prefix + 'stats'
+
+    def get(self, key):
+        value = self._redis.get(self._prefix + key)
+        pipe = self._redis.pipeline()
+        if value is None:
+            pipe.hincrby(self._stats, 'misses', 1)
+        else:
+            pipe.zadd(self._lru, {key: time.time()})
+            pipe.hincrby(self._stats, 'hits', 1)
+        pipe.execute()
+        return value
+
+    def set(self, key, value):
+        pipe = self._redis.pipeline()
+        pipe.set(self._prefix + key, value)
+        pipe.zadd(self._lru, {key: time.time()})
+        pipe.zcard(self._lru)
+        size = pipe.execute()[-1]
+        if size > self.max_entries:
+            evicted = [member for member, _ in self._redis.zpopmin(self._lru, size - self.max_entries)]
+            if evicted:
+                pipe = self._redis.pipeline()
+                pipe.delete(*[self._prefix + member.decode() for member in evicted])
+                pipe.hincrby(self._stats, 'evictions', len(evicted))
+                pipe.execute()
+
+    def versions(self, tables):
+        return [int(version or 0) for version in self._redis.hmget(self._versions, tables)]
+
+    def bump(self, tables):
+        pipe = self._redis.pipeline()
+        for table in tables:
+            pipe.hincrby(self._versions, table, 1)
+        pipe.execute()
+
+    def clear(self):
+        keys = [self._prefix + member.decode() for member in self._redis.zrange(self._lru, 0, -1)]
+        pipe = self._redis.pipeline()
+        if keys:
+            pipe.delete(*keys)
+        pipe.delete(self._lru)
+        pipe.execute()
+
+    def stats(self):
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        stats.update({name.decode(): int(value) for name, value in self._redis.hgetall(self._stats).items()})
+        stats.update({'backend': 'redis', 'entries': self._redis.zcard(self._lru), 'max_entries': self.max_entries,
+                      'versions': {name.decode(): int(value)
+                                   for name, value in self._redis.hgetall(self._versions).items()}})
+        return stats
+
+
+def create_backend():
+    """Picks the backend from REPORT_CACHE_URL (redis://...), defaulting to in-process memory."""
+    max_entries = int(os.getenv("REPORT_CACHE_MAX_ENTRIES") or 256)
+    url = os.getenv("REPORT_CACHE_URL")
+    if url:
+        return RedisBackend(url, max_entries=max_entries)
+    return MemoryBackend(max_entries=max_entries)
+
+
+def check_workers():
+    """Refuses to start several workers on the in-process backend: each would keep its own
+    entries and versions, and serve reports cached before another worker's writes. Workers
+    are counted from WEB_CONCURRENCY, which gunicorn and uvicorn take as their --workers."""
+    workers = int(os.getenv("WEB_CONCURRENCY") or 1)
+    if workers > 1 and not os.getenv("REPORT_CACHE_URL"):
+        raise RuntimeError(f"WEB_CONCURRENCY is {workers}, but the report cache is in-process; "
+                           "set REPORT_CACHE_URL to a Redis URL so the workers share it")
+
+
+def snapshot_name(path, fmt):
+    """Snapshots are kept per response format; only valid formats get a 200 and are stored."""
+    return path if fmt in (None, '', 'json') else f'{path}?format={fmt}'
+
+
+class ReportCache:
+    """Caches report responses until one of the tables they read from is written to.
+
+    Each table has a version counter that write routes bump after committing. A cached
+    entry is keyed by the endpoint, its query parameters and the current versions of its
+    tables, so a write makes the old entries unreachable and they age out of the LRU.
+
+    With read replicas, `staleness` is how far behind the primary one may be. Until the
+    versions have been unchanged that long, responses are read from the primary (the
+    decorators set g.read_primary), since an entry a replica filled before replaying
+    the write would be served until the next one.
+    """
+
+    def __init__(self, backend=None, staleness=0.0):
+        self._backend = backend
+        self.staleness = staleness
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        # tables -> (versions, when this process first saw them)
+        self._seen = {}
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = create_backend()
+        return self._backend
+
+    def stamp(self, tables, daily=False, versions=None):
+        """What a report reading `tables` depends on besides its parameters, as strings."""
+        if versions is None:
+            versions = self.backend.versions(tables)
+        parts = [f'{table}={version}' for table, version in zip(tables, versions)]
+        if daily:
+            # Reports that use CURRENT_DATE change at midnight even without writes
+            parts.append(date.today().isoformat())
+        return parts
+
+    def key(self, endpoint, params, tables, daily=False, versions=None):
+        parts = [endpoint, urlencode(sorted(params.items())), *self.stamp(tables, daily, versions)]
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def bump(self, *tables):
+        """Invalidates every cached report that reads from any of `tables`."""
+        self.backend.bump(tables)
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self._snapshots.clear()
+
+    def stats(self):
+        stats = self.backend.stats()
+        with self._lock:
+            stats['snapshots'] = sorted(self._snapshots)
+        return stats
+
+    def versions(self, tables):
+        return tuple(self.backend.versions(tables))
+
+    def settled(self, tables, versions):
+        """Whether `versions` of `tables` have been current for `staleness` seconds, as far as
+        this process has seen, so a replica has caught up with the writes behind them."""
+        if self.staleness <= 0:
+            return True
+        now = time.monotonic()
+        tables = tuple(tables)
+        with self._lock:
+            seen = self._seen.get(tables)
+            if seen is None or seen[0] != versions:
+                self._seen[tables] = seen = (versions, now)
+        return now - seen[1] >= self.staleness
+
+    def get_snapshot(self, name, versions):
+        """Returns (body, etag) of the snapshot of `name` taken at `versions`, or None."""
+        entry = self._snapshots.get(name)
+        if entry is None or entry[0] != versions:
+            return None
+        return entry[1], entry[2]
+
+    def set_snapshot(self, name, versions, body):
+        """Stores `body` as the snapshot of `name` at `versions` and returns (body, etag)."""
+        etag = hashlib.sha1(body).hexdigest()
+        # A cache size of 0 turns caching off, but the ETag still saves resending the body
+        if self.backend.max_entries > 0:
+            with self._lock:
+                self._snapshots[name] = (versions, body, etag)
+        return body, etag
+
+    def cached(self, *tables, daily=False):
+        """Decorates a Flask view so successful responses are served from the cache."""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                versions = self.versions(tables)
+                key = self.key(request.path, request.args.to_dict(), tables, daily=daily, versions=versions)
+                body = self.get(key)
+                if body is not None:
+                    return current_app.response_class(body, mimetype='application/json')
+                if not self.settled(tables, versions):
+                    g.read_primary = True
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    self.set(key, response.get_data())
+                return response
+            return wrapper
+        return decorator
+
+    def snapshot(self, *tables):
+        """Decorates a Flask view of reference data (the tree catalog, neighborhoods).
+
+        The response is kept in this process and served, with an ETag, until one of
+        `tables` is written to. Only the version counters are checked per request, so
+        steady traffic doesn't reach Postgres, and clients sending If-None-Match get a 304.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                versions = self.versions(tables)
+                name = snapshot_name(request.path, request.args.get('format'))
+                entry = self.get_snapshot(name, versions)
+                if entry is None:
+                    if not self.settled(tables, versions):
+                        g.read_primary = True
+                    response = current_app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    entry = self.set_snapshot(name, versions, response.get_data())
+                body, etag = entry
+                response = current_app.response_class(body, mimetype='application/json')
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'no-cache'
+                return response.make_conditional(request)
+            return wrapper
+        return decorator
@@ -0,0 +1,246 @@
+"""In-process index of the tree catalog, for /api/trees/search and custom report 4.
+
+The trees table is small and read far more often than it is written, so each worker
+keeps it in memory column by column: arrays for the height/width ranges and inventory,
+and for every facet value a bitmask with bit i set when tree i has that value. A search
+ANDs the masks of its filters together and counts facet values with popcounts, so it
+never reaches Postgres.
+
+The index is rebuilt from queries.TREE_CATALOG when the report cache's version of one
+of TABLES changes. Inventory and request counts move with writes to those tables, and
+every write route already bumps them, so the index is as fresh as the report cache.
+"""
+import heapq
+from array import array
+from bisect import bisect_left
+
+# Tables whose writes change the index (inventory, requests, successful plantings)
+TABLES = ('trees', 'tree_requests', 'scheduled_plantings', 'planting_events')
+BOOLEAN_FACETS = ('plantable_under_power_lines', 'native_to_ca', 'pzharshsites', 'pzbay', 'pzurbanized',
+                  'pznearnaturalareas')
+FACETS = ('drought_tolerance', 'growth_rate', 'foliage_type', *BOOLEAN_FACETS, 'visual_attraction')
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 100
+
+
+class SearchError(ValueError):
+    """Raised for a malformed search filter."""
+
+
+def _bits(flags):
+    """Bitmask with bit i set when flags[i] is true."""
+    return int(''.join('1' if flag else '0' for flag in reversed(flags)) or '0', 2)
+
+
+def _indexes(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def attraction_terms(values):
+    """Splits visual_attraction entries like 'Fall color, bark' into lowercase terms."""
+    return sorted({term.strip().lower() for value in values or () for term in value.split(',') if term.strip()})
+
+
+class TreeCatalog:
+    def __init__(self, rows, versions=None):
+        self.versions = versions
+        self.ids = array('i')
+        self.common_names = []
+        self.scientific_names = []
+        self.height_low, self.height_high = array('i'), array('i')
+        self.width_low, self.width_high = array('i'), array('i')
+        self.inventory = array('i')
+        self.requested = array('i')
+        self.num_planted = array('i')
+        self.attributes = []
+        height_known, width_known = [], []
+        facet_values = {facet: [] for facet in FACETS}
+        for row in rows:
+            (tree_id, common_name, scientific_name, height_low, height_high, width_low, width_high,
+             drought_tolerance, growth_rate, foliage_type, *flags, visual_attraction, inventory, requested,
+             num_planted) = row
+            self.ids.append(tree_id)
+            self.common_names.append(common_name)
+            self.scientific_names.append(scientific_name)
+            # A range with a missing bound never matches a filter on it, as in SQL
+            height_known.append(height_low is not None and height_high is not None)
+            width_known.append(width_low is not None and width_high is not None)
+            self.height_low.append(height_low or 0)
+            self.height_high.append(height_high or 0)
+            self.width_low.append(width_low or 0)
+            self.width_high.append(width_high or 0)
+            self.inventory.append(inventory)
+            self.requested.append(requested)
+            self.num_planted.append(num_planted)
+            terms = attraction_terms(visual_attraction)
+            values = (drought_tolerance, growth_rate, foliage_type, *flags, terms)
+            for facet, value in zip(FACETS, values):
+                facet_values[facet].append(value)
+            attributes = dict(zip(FACETS, values))
+            attributes['visual_attraction'] = visual_attraction
+            attributes['height_range'] = [height_low, height_high]
+            attributes['width_range'] = [width_low, width_high]
+            self.attributes.append(attributes)
+        self.size = len(self.ids)
+        self.all = (1 << self.size) - 1
+        self.height_known = _bits(height_known)
+        self.width_known = _bits(width_known)
+        self.requested_mask = _bits([requested > 0 for requested in self.requested])
+        self.available_mask = _bits([available > 0 for available in self.available()])
+        # facet -> {value: mask}. NULLs get no mask, so they're never counted or matched.
+        self.facets = {}
+        for facet, values in facet_values.items():
+            masks = {}
+            for i, value in enumerate(values):
+                for key in (value if facet == 'visual_attraction' else [value]):
+                    if key is not None:
+                        masks[key] = masks.get(key, 0) | 1 << i
+            self.facets[facet] = masks
+
+    def available(self):
+        """Inventory not yet spoken for by a tree request, per tree."""
+        return [inventory - requested for inventory, requested in zip(self.inventory, self.requested)]
+
+    def fits(self, min_height=None, max_height=None, min_width=None, max_width=None):
+        """Mask of the trees whose height and width ranges lie within the given bounds."""
+        mask = self.all
+        for low, high, lows, highs, known in ((min_height, max_height, self.height_low, self.height_high,
+                                               self.height_known),
+                                              (min_width, max_width, self.width_low, self.width_high,
+                                               self.width_known)):
+            if low is None and high is None:
+                continue
+            mask &= known
+            if low is not None:
+                mask &= _bits([value >= low for value in lows])
+            if high is not None:
+                mask &= _bits([value <= high for value in highs])
+        return mask
+
+    def facet_mask(self, facet, values):
+        """Mask of the trees with any of `values` for `facet`."""
+        masks = self.facets[facet]
+        mask = 0
+        for value in values:
+            mask |= masks.get(value, 0)
+        return mask
+
+    def facet_counts(self, facet, mask):
+        """{value: how many trees in `mask` have it} for `facet`."""
+        return {str(value).lower() if isinstance(value, bool) else value: (mask & bits).bit_count()
+                for value, bits in sorted(self.facets[facet].items(), key=lambda item: str(item[0]))}
+
+    def search(self, filters):
+        """Trees matching `filters` (from parse_search_args), most available first.
+
+        Facet counts are over the trees matching every filter except the facet's own,
+        so each count is how many results picking that value would give.
+        """
+        base = self.fits(*filters['bounds'])
+        if filters['in_stock']:
+            base &= self.available_mask
+        selected = {facet: self.facet_mask(facet, values) for facet, values in filters['facets'].items()}
+        mask = base
+        for facet_mask in selected.values():
+            mask &= facet_mask
+        facets = {}
+        for facet in FACETS:
+            others = base
+            for other, facet_mask in selected.items():
+                if other != facet:
+                    others &= facet_mask
+            facets[facet] = self.facet_counts(facet, others)
+        available = self.available()
+        top = heapq.nsmallest(filters['limit'], _indexes(mask),
+                              key=lambda i: (-available[i], self.common_names[i] or '', i))
+        trees = [{'id': self.ids[i], 'common_name': self.common_names[i],
+                  'scientific_name': self.scientific_names[i], 'inventory': self.inventory[i],
+                  'available': available[i], **self.attributes[i]} for i in top]
+        return {'count': mask.bit_count(), 'trees': trees, 'facets': facets}
+
+    def top_by_inventory(self, min_height, max_height, min_width, max_width, places=4):
+        """Custom report 4: the requested trees that fit the bounds and still have inventory left
+        over after their requests, ranked by inventory, with how many of each were planted.
+
+        A tree is kept while at most `places` candidates have at least its inventory, so ties
+        at the cut-off can leave fewer rows.
+        """
+        mask = self.fits(min_height, max_height, min_width, max_width) & self.requested_mask & self.available_mask
+        candidates = sorted(_indexes(mask), key=lambda i: (-self.inventory[i], self.common_names[i] or '', i))
+        inventories = sorted(self.inventory[i] for i in candidates)
+        return [{'common_name': self.common_names[i], 'num_planted': self.num_planted[i]} for i in candidates
+                if len(inventories) - bisect_left(inventories, self.inventory[i]) <= places]
+
+
+def _int_arg(args, name):
+    value = args.get(name)
+    if value is None or value == []:
+        return None
+    if isinstance(value, list):
+        value = value[0]
+    try:
+        return int(value)
+    except ValueError as e:
+        raise SearchError(f"{name} must be a whole number") from e
+
+
+def parse_bounds(args):
+    """(min_height, max_height, min_width, max_width) from the query string, None where absent."""
+    return tuple(_int_arg(args, name) for name in ('min_height', 'max_height', 'min_width', 'max_width'))
+
+
+def parse_search_args(args):
+    """Reads search filters from `args`, a dict of query parameter -> list of values.
+
+    Facets may be repeated (?growth_rate=fast&growth_rate=moderate) to match any of them.
+    Boolean facets take true/false and visual_attraction takes terms like "bark".
+    """
+    facets = {}
+    for facet in FACETS:
+        values = [value for value in args.get(facet, []) if value != '']
+        if not values:
+            continue
+        if facet in BOOLEAN_FACETS:
+            try:
+                values = [{'true': True, 'false': False}[value.lower()] for value in values]
+            except KeyError as e:
+                raise SearchError(f"{facet} must be true or false") from e
+        elif facet == 'visual_attraction':
+            values = [value.lower() for value in values]
+        facets[facet] = values
+    limit = _int_arg(args, 'limit')
+    if limit is None:
+        limit = DEFAULT_SEARCH_LIMIT
+    if limit < 0:
+        raise SearchError("limit must not be negative")
+    in_stock = (args.get('in_stock') or ['false'])[0].lower()
+    if in_stock not in ('true', 'false'):
+        raise SearchError("in_stock must be true or false")
+    return {'bounds': parse_bounds(args), 'facets': facets, 'in_stock': in_stock == 'true',
+            'limit': min(limit, MAX_SEARCH_LIMIT)}
+
+
+class CatalogIndex:
+    """Holds the current TreeCatalog of this process."""
+
+    def __init__(self):
+        self._catalog = None
+
+    def get(self, versions):
+        """The catalog built at `versions` of TABLES, or None if it needs rebuilding."""
+        catalog = self._catalog
+        if catalog is None or catalog.versions != versions:
+            return None
+        return catalog
+
+    def set(self, versions, rows):
+        # Callers read the versions before loading the rows, so a write landing in between
+        # leaves the catalog stamped as older than it is and it is rebuilt next time.
+        catalog = self._catalog = TreeCatalog(rows, versions)
+        return catalog
+
+    def clear(self):
+        self._catalog = None
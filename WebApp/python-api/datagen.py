@@ -0,0 +1,196 @@
+import random
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+# Tables the generator writes to, in foreign key order
+TABLES = [
+    'residents',
+    'organization_members',
+    'volunteer_applications',
+    'tree_requests',
+    'permits',
+    'scheduled_visits',
+    'visit_events',
+    'scheduled_plantings',
+    'planting_events',
+    'organization_members_lead_scheduled_plantings',
+    'scheduled_plantings_have_volunteers',
+    'planting_events_have_volunteers',
+]
+
+FIRST_NAMES = ['Ana', 'Ben', 'Carla', 'Dev', 'Elena', 'Femi', 'Grace', 'Hiro', 'Iris', 'Jamal', 'Kim', 'Luis',
+               'Maya', 'Noah', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sam', 'Tariq', 'Uma', 'Victor', 'Wen', 'Yara']
+LAST_NAMES = ['Alvarez', 'Brown', 'Chen', 'Diaz', 'Evans', 'Fong', 'Garcia', 'Huang', 'Ibrahim', 'Jones', 'Kim',
+              'Lopez', 'Martin', 'Nguyen', 'Okafor', 'Patel', 'Reyes', 'Smith', 'Tran', 'Williams']
+STREETS = ['Linden Street', 'Broadway', 'College Avenue', 'Telegraph Avenue', 'Fruitvale Avenue', 'MacArthur Blvd',
+           'Park Boulevard', 'Lakeshore Avenue', 'International Blvd', 'San Pablo Avenue']
+
+
+def _insert(cur, sql, rows, returning=False):
+    if not rows:
+        return []
+    result = execute_values(cur, sql, rows, page_size=1000, fetch=returning)
+    return [row[0] for row in result] if returning else []
+
+
+def generate(conn, scale=1, seed=42, years=6):
+    """Adds a synthetic, internally consistent history to the database.
+
+    Needs the neighborhoods and trees catalog from dml.sql to already be loaded. One unit
+    of scale is 200 residents and 1000 tree requests spread over the last `years` years,
+    walked through the whole request lifecycle (permit, visit, planting, crew). User
+    triggers are disabled during the load, so the stored statuses and rollups are
+    rebuilt at the end. Returns the number of rows written per table.
+    """
+    rng = random.Random(seed)
+    cur = conn.cursor()
+    cur.execute('SELECT name FROM neighborhoods ORDER BY name;')
+    neighborhoods = [row[0] for row in cur.fetchall()]
+    cur.execute('SELECT id FROM trees ORDER BY id;')
+    tree_ids = [row[0] for row in cur.fetchall()]
+    if not (neighborhoods and tree_ids):
+        raise ValueError("Load the neighborhoods and trees from dml.sql before generating data")
+    cur.execute('SELECT COALESCE(MAX(id), 0) FROM residents;')
+    first_resident = cur.fetchone()[0] + 1
+
+    for table in TABLES:
+        cur.execute(f'ALTER TABLE {table} DISABLE TRIGGER USER;')
+
+    now = datetime.now().replace(microsecond=0)
+    start = now - timedelta(days=365 * years)
+
+    # Once visits and plantings are partitioned by year (migrations/0003), every generated year
+    # needs a partition, and the triggers that fill in event timestamps have to stay on
+    cur.execute("SELECT to_regproc('scheduled_event_timestamp_trigger') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        cur.execute('SELECT create_scheduled_event_partitions(%s, %s);', (start.year, now.year + 1))
+        cur.execute("""
+            SELECT tgrelid::regclass, tgname
+            FROM pg_trigger
+            WHERE tgfoid = 'scheduled_event_timestamp_trigger'::regproc;
+        """)
+        for table, trigger in cur.fetchall():
+            cur.execute(f'ALTER TABLE {table} ENABLE TRIGGER {trigger};')
+    span = int((now - start).total_seconds())
+    counts = {}
+
+    # Residents, a tenth of whom volunteer and a fiftieth of whom are organization members
+    num_residents = 200 * scale
+    residents = []
+    for i in range(num_residents):
+        n = first_resident + i
+        residents.append((
+            rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), f'generated-{seed}-{n}@example.com', 'password',
+            f'{rng.randint(1, 9999)} {rng.choice(STREETS)}', f'946{rng.randint(0, 99):02d}',
+            rng.random() < 0.1, rng.choice(neighborhoods)
+        ))
+    resident_ids = _insert(cur, '''
+        INSERT INTO residents (first_name, last_name, email, password, street, zip_code, is_volunteer, neighborhood)
+        VALUES %s RETURNING id''', residents, returning=True)
+    volunteer_ids = [rid for rid, row in zip(resident_ids, residents) if row[6]]
+    member_ids = rng.sample(resident_ids, max(2, num_residents // 50))
+    _insert(cur, 'INSERT INTO organization_members (resident_id, role, start_date) VALUES %s',
+            [(rid, rng.choice(['administrator', 'group leader']), start.date()) for rid in member_ids])
+    _insert(cur, 'INSERT INTO volunteer_applications (resident_id, created, approved, notes) VALUES %s',
+            [(rid, start.date(), True, None) for rid in volunteer_ids])
+    counts['residents'] = len(resident_ids)
+    counts['organization_members'] = len(member_ids)
+    counts['volunteer_applications'] = len(volunteer_ids)
+
+    # Tree requests, each with the permit that /api/tree-request creates alongside it
+    num_requests = 1000 * scale
+    requests = []
+    for i in range(num_requests):
+        submitted = start + timedelta(seconds=rng.randrange(span))
+        approved = rng.choices([None, False, True], weights=[2, 1, 7])[0]
+        requests.append((rng.choice(resident_ids), submitted + timedelta(microseconds=i), rng.choice(tree_ids),
+                         'Generated site description', approved))
+    request_ids = _insert(cur, '''
+        INSERT INTO tree_requests (resident_id, submission_timestamp, tree_id, site_description, approved)
+        VALUES %s RETURNING id''', requests, returning=True)
+    counts['tree_requests'] = len(request_ids)
+
+    permits = []
+    visits = []
+    for request_id, request in zip(request_ids, requests):
+        resident_id, submitted, _, _, approved = request
+        status = 'pending'
+        if approved:
+            status = rng.choices(['pending', 'approved', 'denied'], weights=[2, 7, 1])[0]
+        decided = None if status == 'pending' else (submitted + timedelta(days=rng.randint(1, 30))).date()
+        permits.append((resident_id, request_id, status, decided))
+        if status == 'approved' and rng.random() < 0.8:
+            visited = submitted + timedelta(days=rng.randint(10, 60), hours=rng.randint(8, 16))
+            visits.append((request_id, visited, rng.random() < 0.05, None, rng.choice(member_ids)))
+    _insert(cur, 'INSERT INTO permits (resident_id, tree_request_id, status, decision_date) VALUES %s', permits)
+    visit_ids = _insert(cur, '''
+        INSERT INTO scheduled_visits (tree_request_id, event_timestamp, cancelled, notes, organization_member_id)
+        VALUES %s RETURNING event_id''', visits, returning=True)
+    counts['permits'] = len(permits)
+    counts['scheduled_visits'] = len(visit_ids)
+
+    visit_events = []
+    plantings = []
+    for visit_id, visit in zip(visit_ids, visits):
+        request_id, visited, cancelled = visit[0], visit[1], visit[2]
+        if cancelled or rng.random() >= 0.7:
+            continue
+        additional_visit_required = rng.random() < 0.2
+        visit_events.append((visit_id, 'Generated observations', None, additional_visit_required))
+        if additional_visit_required or rng.random() >= 0.8:
+            continue
+        planted = visited + timedelta(days=rng.randint(14, 90))
+        if rng.random() < 0.15:
+            # Cancelled and rescheduled
+            plantings.append((request_id, planted, True, 'Rescheduled'))
+            planted += timedelta(days=rng.randint(7, 30))
+        plantings.append((request_id, planted, False, None))
+    _insert(cur, '''
+        INSERT INTO visit_events (scheduled_visit_id, observations, photo_library_link, additional_visit_required)
+        VALUES %s''', visit_events)
+    planting_ids = _insert(cur, '''
+        INSERT INTO scheduled_plantings (tree_request_id, event_timestamp, cancelled, notes)
+        VALUES %s RETURNING event_id''', plantings, returning=True)
+    counts['visit_events'] = len(visit_events)
+    counts['scheduled_plantings'] = len(planting_ids)
+
+    planting_events = []
+    leads = []
+    crews = []
+    attendance = []
+    for planting_id, planting in zip(planting_ids, plantings):
+        leads.append((rng.choice(member_ids), planting_id))
+        crew = rng.sample(volunteer_ids, min(len(volunteer_ids), rng.randint(1, 4)))
+        crews.extend((planting_id, volunteer_id) for volunteer_id in crew)
+        if planting[2] or planting[1] > now or rng.random() >= 0.9:
+            continue
+        planting_events.append((planting_id, 'Generated observations', None, None, rng.random() < 0.85))
+        attendance.extend((planting_id, volunteer_id) for volunteer_id in crew if rng.random() < 0.8)
+    _insert(cur, '''
+        INSERT INTO planting_events (scheduled_planting_id, observations, before_photos_library_link,
+                                     after_photos_library_link, successful)
+        VALUES %s''', planting_events)
+    _insert(cur, '''
+        INSERT INTO organization_members_lead_scheduled_plantings (organization_member_id, scheduled_planting_id)
+        VALUES %s''', leads)
+    _insert(cur, 'INSERT INTO scheduled_plantings_have_volunteers (planting_event_id, volunteer_id) VALUES %s', crews)
+    _insert(cur, 'INSERT INTO planting_events_have_volunteers (planting_event_id, volunteer_id) VALUES %s',
+            attendance)
+    counts['planting_events'] = len(planting_events)
+    counts['organization_members_lead_scheduled_plantings'] = len(leads)
+    counts['scheduled_plantings_have_volunteers'] = len(crews)
+    counts['planting_events_have_volunteers'] = len(attendance)
+
+    for table in TABLES:
+        cur.execute(f'ALTER TABLE {table} ENABLE TRIGGER USER;')
+    cur.execute('SELECT rebuild_tree_request_statuses();')
+    cur.execute('SELECT rebuild_neighborhood_rollup();')
+    cur.execute("SELECT to_regproc('rebuild_yearly_planting_rollups') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        cur.execute('SELECT rebuild_yearly_planting_rollups();')
+    for table in TABLES:
+        cur.execute(f'ANALYZE {table};')
+    conn.commit()
+    cur.close()
+    return counts
@@ -0,0 +1,496 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class DatabaseUnavailable(Exception):
+    """Raised when a connection cannot be checked out of the pool."""
+
+
+class PoolTimeout(DatabaseUnavailable):
+    """Raised when every connection of a pool stayed checked out for the whole wait."""
+
+
+def env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name, default):
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def connect(dsn=None, **kwargs):
+    """Opens a brand-new connection to the PostgreSQL database, or to `dsn` (a replica).
+
+    Extra keyword arguments (e.g. cursor_factory) are passed on to psycopg2.connect.
+    """
+    if dsn is not None:
+        return psycopg2.connect(dsn, **kwargs)
+    return psycopg2.connect(
+        host=os.getenv("POSTGRES_HOST"),
+        database=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USERNAME"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        port=os.getenv("POSTGRES_PORT"),
+        **kwargs
+    )
+
+
+# DISCARD ALL without DEALLOCATE ALL and DISCARD PLANS, so prepared statements and
+# their plans survive from one checkout to the next
+RESET_SQL = '''
+    CLOSE ALL;
+    SET SESSION AUTHORIZATION DEFAULT;
+    RESET ALL;
+    UNLISTEN *;
+    SELECT pg_advisory_unlock_all();
+    DISCARD TEMP;
+    DISCARD SEQUENCES;
+'''
+
+
+class ConnectionPool:
+    """A bounded pool of PostgreSQL connections.
+
+    Keeps at least `min_size` connections open and never more than `max_size`.
+    Callers that find the pool exhausted wait up to `timeout` seconds for a
+    connection to be returned. Connections that sat idle longer than
+    `max_idle` seconds are pinged before being handed out, and every
+    connection is rolled back and reset before it goes back on the shelf.
+    The reset keeps the connection's prepared statements (see statements.py).
+    """
+
+    def __init__(self, min_size=1, max_size=10, timeout=5.0, max_idle=30.0, connect=connect, on_checkout=None):
+        if min_size > max_size:
+            raise ValueError("min_size cannot be larger than max_size")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._connect = connect
+        self._on_checkout = on_checkout
+        self._cond = threading.Condition()
+        self._idle = deque()  # (connection, time it was returned)
+        self._in_use = set()
+        self._closed = False
+        self._stats = {
+            'connections_opened': 0,
+            'connections_closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'validation_failures': 0,
+        }
+        for _ in range(min_size):
+            self._idle.append((self._open(), time.monotonic()))
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._stats['connections_opened'] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._stats['connections_closed'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_alive(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.max_idle:
+            return True
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """Checks a connection out of the pool, waiting up to `timeout` seconds."""
+        started = time.monotonic()
+        deadline = None
+        waited_since = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise DatabaseUnavailable("Connection pool is closed")
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if len(self._in_use) < self.max_size:
+                    conn, idle_since = None, None
+                    break
+                if waited_since is None:
+                    waited_since = time.monotonic()
+                    deadline = waited_since + self.timeout
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    self._stats['wait_time'] += time.monotonic() - waited_since
+                    raise PoolTimeout("Timed out waiting for a database connection")
+                self._cond.wait(remaining)
+            if waited_since is not None:
+                self._stats['wait_time'] += time.monotonic() - waited_since
+            # Reserve the slot before doing any network I/O outside the lock.
+            placeholder = object()
+            self._in_use.add(placeholder)
+
+        try:
+            if conn is not None and not self._is_alive(conn, idle_since):
+                with self._cond:
+                    self._stats['validation_failures'] += 1
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+        except Exception as e:
+            with self._cond:
+                self._in_use.discard(placeholder)
+                self._cond.notify()
+            raise DatabaseUnavailable(str(e)) from e
+
+        with self._cond:
+            self._in_use.discard(placeholder)
+            self._in_use.add(conn)
+            self._stats['checkouts'] += 1
+        if self._on_checkout is not None:
+            self._on_checkout(time.monotonic() - started)
+        return conn
+
+    def _reset(self, conn):
+        """Returns the session to a clean state, or False if it is unusable."""
+        if conn.closed:
+            return False
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            # DISCARD cannot run inside a transaction block.
+            conn.autocommit = True
+            # Plain cursor so pool housekeeping is not counted as the request's queries
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute(RESET_SQL)
+            conn.autocommit = False
+            return True
+        except psycopg2.Error:
+            return False
+
+    def putconn(self, conn):
+        """Returns a connection to the pool, closing it if it cannot be reused."""
+        usable = self._reset(conn)
+        with self._cond:
+            self._in_use.discard(conn)
+            if usable and not self._closed and len(self._idle) + len(self._in_use) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._discard(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'pid': os.getpid(),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+            })
+        return stats
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Installed by metrics.init_app() before the first pool is created: the cursor class
+# pooled connections hand out, and a function called with how long each checkout took.
+pool_hooks = {'cursor_factory': None, 'on_checkout': None}
+
+
+def _pooled_connect(dsn=None):
+    if pool_hooks['cursor_factory'] is None:
+        return connect(dsn)
+    return connect(dsn, cursor_factory=pool_hooks['cursor_factory'])
+
+
+def get_pool():
+    """Returns this worker process's pool, creating it on first use.
+
+    Pools are never shared across a fork: a forked worker gets its own.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                try:
+                    _pool = ConnectionPool(
+                        min_size=env_int("POSTGRES_POOL_MIN", 1),
+                        max_size=env_int("POSTGRES_POOL_MAX", 10),
+                        timeout=env_float("POSTGRES_POOL_TIMEOUT", 5.0),
+                        max_idle=env_float("POSTGRES_POOL_MAX_IDLE", 30.0),
+                        connect=_pooled_connect,
+                        on_checkout=pool_hooks['on_checkout']
+                    )
+                except psycopg2.Error as e:
+                    raise DatabaseUnavailable(str(e)) from e
+                _pool_pid = pid
+    return _pool
+
+
+def configure_pool(**kwargs):
+    """Replaces this worker process's pool with one built from `kwargs`.
+
+    Used by tools that need a differently configured pool, such as the benchmark
+    suite timing every query. Connections held by the old pool are closed.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        old = _pool if _pool_pid == os.getpid() else None
+        _pool = ConnectionPool(**kwargs)
+        _pool_pid = os.getpid()
+    if old is not None:
+        old.closeall()
+    return _pool
+
+
+def replica_dsns():
+    """Connection strings (URLs or key=value) of the read replicas in POSTGRES_REPLICAS, comma-separated."""
+    return [dsn.strip() for dsn in os.getenv("POSTGRES_REPLICAS", "").split(',') if dsn.strip()]
+
+
+# How many seconds a replica is behind: 0 once it has replayed all the WAL it received, else
+# the age of the last transaction it replayed. Right after a restart the receive position
+# starts at the beginning of a WAL segment, behind the replay position. A replica cut off from
+# the primary looks caught up, so connection failures are what take those out of rotation.
+REPLICA_LAG_SQL = '''
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() <= pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::FLOAT8 END;
+'''
+
+
+class ReplicaSet:
+    """Round-robin choice among read replicas, skipping the unhealthy ones.
+
+    A replica is left out for `retry_after` seconds after a connection to it fails, and
+    until its next check when it was more than `max_lag` seconds behind the primary. Lag
+    is checked on a checked-out connection, at most every `check_interval` seconds per
+    replica. Callers keep a pool per replica in `pools` (ConnectionPools here, asyncpg
+    pools in asgi.py); this class only decides which one to use.
+    """
+
+    def __init__(self, dsns, max_lag=None, check_interval=None, retry_after=None):
+        self.dsns = list(dsns)
+        self.max_lag = env_float("POSTGRES_REPLICA_MAX_LAG", 10.0) if max_lag is None else max_lag
+        self.check_interval = (env_float("POSTGRES_REPLICA_CHECK_INTERVAL", 5.0) if check_interval is None
+                               else check_interval)
+        self.retry_after = env_float("POSTGRES_REPLICA_RETRY_AFTER", 30.0) if retry_after is None else retry_after
+        self.pools = [None] * len(self.dsns)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._down_until = [0.0] * len(self.dsns)
+        self._checked_at = [None] * len(self.dsns)
+        self._lag = [None] * len(self.dsns)
+        self._errors = [None] * len(self.dsns)
+        self._stats = [{'checkouts': 0, 'failures': 0, 'lagging': 0} for _ in self.dsns]
+        self._fallbacks = 0
+
+    @property
+    def staleness(self):
+        """Seconds a healthy replica can be behind: its allowed lag, plus the time until its next check."""
+        return self.max_lag + self.check_interval
+
+    def candidates(self):
+        """Indexes of the healthy replicas, starting with the next one in turn."""
+        now = time.monotonic()
+        with self._lock:
+            start = self._next
+            self._next = (start + 1) % len(self.dsns)
+            order = [(start + offset) % len(self.dsns) for offset in range(len(self.dsns))]
+            return [i for i in order if self._down_until[i] <= now]
+
+    def check_due(self, i):
+        """Whether replica `i`'s lag should be checked now. Only one caller at a time gets True."""
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at[i] is not None and now - self._checked_at[i] < self.check_interval:
+                return False
+            self._checked_at[i] = now
+            return True
+
+    def record_lag(self, i, lag):
+        """Records replica `i`'s lag. Returns False, and leaves it out until its next check, if too high."""
+        with self._lock:
+            self._lag[i] = lag
+            if lag is not None and lag <= self.max_lag:
+                return True
+            self._stats[i]['lagging'] += 1
+            self._down_until[i] = time.monotonic() + self.check_interval
+            return False
+
+    def failed(self, i, error):
+        with self._lock:
+            self._stats[i]['failures'] += 1
+            self._errors[i] = str(error).strip()
+            self._down_until[i] = time.monotonic() + self.retry_after
+            # Check the lag again as soon as it is back
+            self._checked_at[i] = None
+
+    def used(self, i):
+        with self._lock:
+            self._stats[i]['checkouts'] += 1
+
+    def fell_back(self):
+        with self._lock:
+            self._fallbacks += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            replicas = []
+            for i, dsn in enumerate(self.dsns):
+                params = psycopg2.extensions.parse_dsn(dsn)
+                replicas.append(dict(self._stats[i], replica=f"{params.get('host', '')}:{params.get('port', '')}",
+                                     healthy=self._down_until[i] <= now, lag=self._lag[i],
+                                     last_error=self._errors[i]))
+            return {'replicas': replicas, 'fallbacks_to_primary': self._fallbacks, 'max_lag': self.max_lag}
+
+
+_replicas = None
+_replicas_pid = None
+
+
+def get_replicas():
+    """Returns this worker process's ReplicaSet, or None when POSTGRES_REPLICAS is empty."""
+    global _replicas, _replicas_pid
+    pid = os.getpid()
+    if _replicas_pid != pid:
+        with _pool_lock:
+            if _replicas_pid != pid:
+                dsns = replica_dsns()
+                _replicas = ReplicaSet(dsns) if dsns else None
+                _replicas_pid = pid
+    return _replicas
+
+
+def _replica_pool(replicas, i):
+    if replicas.pools[i] is None:
+        with _pool_lock:
+            if replicas.pools[i] is None:
+                dsn = replicas.dsns[i]
+                # Opens no connection yet, so a replica that is down doesn't stop the worker
+                replicas.pools[i] = ConnectionPool(
+                    min_size=0,
+                    max_size=env_int("POSTGRES_POOL_MAX", 10),
+                    timeout=env_float("POSTGRES_POOL_TIMEOUT", 5.0),
+                    max_idle=env_float("POSTGRES_POOL_MAX_IDLE", 30.0),
+                    connect=lambda: _pooled_connect(dsn),
+                    on_checkout=pool_hooks['on_checkout']
+                )
+    return replicas.pools[i]
+
+
+def _replica_lag(conn):
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute(REPLICA_LAG_SQL)
+        lag = cur.fetchone()[0]
+    conn.rollback()
+    return lag
+
+
+def _checkout_replica(replicas):
+    """(pool, connection) of the next healthy replica, or None if none is healthy.
+
+    A replica whose pool stays exhausted is skipped but not marked down; if they all are,
+    the PoolTimeout is raised rather than moving their load onto the primary.
+    """
+    timed_out = None
+    for i in replicas.candidates():
+        pool = _replica_pool(replicas, i)
+        try:
+            conn = pool.getconn()
+        except PoolTimeout as e:
+            timed_out = e
+            continue
+        except DatabaseUnavailable as e:
+            replicas.failed(i, e)
+            continue
+        if replicas.check_due(i):
+            try:
+                healthy = replicas.record_lag(i, _replica_lag(conn))
+            except psycopg2.Error as e:
+                replicas.failed(i, e)
+                healthy = False
+            if not healthy:
+                pool.putconn(conn)
+                continue
+        replicas.used(i)
+        return pool, conn
+    if timed_out is not None:
+        raise timed_out
+    return None
+
+
+def _replica_lost(pool):
+    """Takes the replica behind `pool` out of rotation after one of its connections broke."""
+    replicas = get_replicas()
+    if replicas is not None and pool in replicas.pools:
+        replicas.failed(replicas.pools.index(pool), "Connection to the replica was lost")
+
+
+def checkout(replica=False):
+    """Checks a connection out of the primary's pool, or with `replica` out of a healthy
+    replica's when POSTGRES_REPLICAS is set, and returns (pool, connection). Reads fall
+    back to the primary when no replica is healthy."""
+    replicas = get_replicas() if replica else None
+    if replicas is not None:
+        checked_out = _checkout_replica(replicas)
+        if checked_out is not None:
+            return checked_out
+        replicas.fell_back()
+    pool = get_pool()
+    return pool, pool.getconn()
+
+
+@contextmanager
+def db_connection(replica=False):
+    """Checks out a pooled connection and always gives it back.
+
+    With `replica`, the connection is to a read replica when one is configured and
+    healthy (see checkout). Anything left uncommitted when the block exits is rolled back.
+    """
+    pool, conn = checkout(replica)
+    try:
+        yield conn
+    finally:
+        if replica and conn.closed:
+            _replica_lost(pool)
+        pool.putconn(conn)
@@ -0,0 +1,159 @@
+"""Streaming CSV and NDJSON exports of the reports and the tree request listing.
+
+Rows are never turned into Python objects: COPY (query) TO STDOUT writes them already
+formatted, on a pooled connection in a background thread, and the chunks it produces
+are handed to the response through a small queue. A worker holds at most a few chunks
+of an export at a time however long the history is, and the first rows go out while
+Postgres is still producing the rest. Clients that send Accept-Encoding: gzip get the
+stream gzipped as it goes.
+"""
+import csv
+import io
+import json
+import queue
+import threading
+import zlib
+
+import db
+
+CHUNK_SIZE = 64 * 1024
+# Chunks COPY can run ahead of a slow client before it waits
+QUEUE_CHUNKS = 4
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+_DONE = object()
+
+
+class ExportError(ValueError):
+    """Raised for an unknown export or format, or missing parameters."""
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def copy_sql(cur, query, params, fmt):
+    """The COPY statement that writes `query`'s rows as `fmt`, keyed by its column names like its JSON."""
+    select = cur.mogrify(query.sql, params).decode().strip().rstrip(';')
+    if fmt == 'csv':
+        return f'COPY (SELECT * FROM ({select}) AS export) TO STDOUT WITH (FORMAT csv, HEADER)'
+    # One JSON object per line. row_to_json escapes control characters, so with a quote
+    # and delimiter that never appear in JSON the CSV format passes each line through as is.
+    return (f'COPY (SELECT row_to_json(export) FROM ({select}) AS export) '
+            f"TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')")
+
+
+def rows_chunks(columns, rows, fmt):
+    """Chunks of `rows` written as `fmt`, for exports answered without Postgres."""
+    if fmt == 'ndjson':
+        yield ''.join(json.dumps(dict(zip(columns, row)), separators=(',', ':')) + '\n' for row in rows).encode()
+        return
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(columns)
+    writer.writerows(rows)
+    yield out.getvalue().encode()
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _ChunkWriter:
+    """File object for copy_expert that batches COPY's rows into chunks on a queue."""
+
+    def __init__(self, chunks, cancelled):
+        self._chunks = chunks
+        self._cancelled = cancelled
+        self._buffer = bytearray()
+
+    def put(self, item):
+        # Waits for the client to catch up, giving up if the response is closed meanwhile
+        while True:
+            if self._cancelled.is_set():
+                raise _Cancelled()
+            try:
+                self._chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.put(bytes(self._buffer))
+            self._buffer.clear()
+
+
+class CopyStream:
+    """Response body that streams COPY output from a pooled connection.
+
+    Creating one starts the COPY and waits for its first chunk, so a failing query
+    raises here, while the response can still be an error. The connection goes back
+    to the pool when the body is exhausted or the response is closed. With `replica`,
+    the COPY runs on a read replica when one is healthy (see db.checkout).
+    """
+
+    def __init__(self, query, params, fmt, compress=False, replica=False):
+        self._compress = compress
+        self._pool, self._conn = db.checkout(replica)
+        self._chunks = queue.Queue(QUEUE_CHUNKS)
+        self._cancelled = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._copy, args=(query, params, fmt), daemon=True)
+        self._thread.start()
+        self._first = self._chunks.get()
+        if isinstance(self._first, Exception):
+            self.close()
+            raise self._first
+
+    def _copy(self, query, params, fmt):
+        writer = _ChunkWriter(self._chunks, self._cancelled)
+        try:
+            try:
+                with self._conn.cursor() as cur:
+                    cur.copy_expert(copy_sql(cur, query, params, fmt), writer, size=CHUNK_SIZE)
+                writer.flush()
+            except _Cancelled:
+                raise
+            except Exception as e:
+                writer.put(e)
+                return
+            writer.put(_DONE)
+        except _Cancelled:
+            pass
+
+    def __iter__(self):
+        return gzipped(self._stream()) if self._compress else self._stream()
+
+    def _stream(self):
+        try:
+            item = self._first
+            while item is not _DONE:
+                if isinstance(item, Exception):
+                    # Too late for an error status; failing the transfer tells the client it's incomplete
+                    raise item
+                yield item
+                item = self._chunks.get()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._cancelled.set()
+        if self._thread.is_alive():
+            # Stop a COPY the client walked away from, rather than reading it to the end
+            self._conn.cancel()
+        self._thread.join()
+        self._pool.putconn(self._conn)
@@ -0,0 +1,201 @@
+"""Report jobs: reports run in the background, with their results stored in Postgres.
+
+POST /api/report-jobs/<report>, with the report's own query string, queues a job and
+returns its id. GET /api/report-jobs/<id> returns its status, waiting up to ?wait=
+seconds for it to finish, and /api/report-jobs/<id>/result returns the output, the same
+body the report's endpoint would. Jobs run on REPORT_JOB_WORKERS threads of the worker
+that accepted them, at most REPORT_JOB_CONCURRENCY of the same report at a time. Only
+REPORT_JOB_QUEUE_LIMIT jobs can wait beyond the ones running; past that, JobsBusy is
+raised and the route answers 503.
+
+Jobs live in the report_jobs table (migrations/0005), so any worker can answer for
+them. Results are kept for REPORT_JOB_TTL seconds (an hour by default), and submitting
+the same report and parameters in that time returns the stored job rather than running
+it again, unless one of the report's tables has been written to since (?refresh=1 runs
+it anyway), as does submitting it while an identical job is
+still queued or running. A report query is cancelled after REPORT_JOB_TIMEOUT seconds.
+A job whose worker exited before it finished stays queued or running, and is run
+afresh when it is submitted again after that long.
+"""
+import hashlib
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from psycopg2.extras import Json
+
+from db import db_connection, env_float, env_int
+
+
+class JobsBusy(Exception):
+    """Raised when the job queue is full."""
+
+
+COLUMNS = ('id', 'report', 'params', 'status', 'error', 'row_count', 'created', 'started', 'finished', 'expires')
+FINISHED = ('done', 'failed')
+# Query string arguments that change how a job is submitted, not what it computes
+SUBMIT_ARGS = ('refresh',)
+
+
+def params_of(args):
+    """The report parameters in query string `args`, as {name: [values]}."""
+    params = {name: values for name, values in args.lists() if name not in SUBMIT_ARGS}
+    if params.get('format') == ['json']:
+        # The default, so ?format=json shares its jobs with no format at all
+        del params['format']
+    return params
+
+
+def job_key(report, params, stamp=()):
+    """Identifies a job by its report, parameters and `stamp`, the table versions (and date)
+    from ReportCache.stamp(), so a job finished before a write isn't handed out after it."""
+    pairs = sorted((name, value) for name, values in params.items() for value in values)
+    return hashlib.sha1('|'.join([report, urlencode(pairs), *stamp]).encode()).hexdigest()
+
+
+def _job(row):
+    return dict(zip(COLUMNS, row)) if row else None
+
+
+def find(cur, key, timeout):
+    """The stored job for `key` that is done and not expired, or still queued or running
+    and younger than `timeout` seconds, or None."""
+    cur.execute(f'''
+        SELECT {', '.join(COLUMNS)} FROM report_jobs
+        WHERE key = %s
+          AND ((status = 'done' AND expires > now())
+               OR (status IN ('queued', 'running') AND created > now() - make_interval(secs => %s)))
+        ORDER BY created DESC
+        LIMIT 1;
+    ''', (key, timeout))
+    return _job(cur.fetchone())
+
+
+def create(cur, key, report, params):
+    cur.execute(f'''
+        INSERT INTO report_jobs (key, report, params) VALUES (%s, %s, %s)
+        RETURNING {', '.join(COLUMNS)};
+    ''', (key, report, Json(params)))
+    return _job(cur.fetchone())
+
+
+def get(cur, job_id):
+    """Job `job_id`, or None if there is none or it has expired."""
+    cur.execute(f'''
+        SELECT {', '.join(COLUMNS)} FROM report_jobs
+        WHERE id = %s AND (expires IS NULL OR expires > now());
+    ''', (job_id,))
+    return _job(cur.fetchone())
+
+
+def result(cur, job_id):
+    """(job, result body) of job `job_id`; the body is None until it is done."""
+    cur.execute(f'''
+        SELECT {', '.join(COLUMNS)}, result FROM report_jobs
+        WHERE id = %s AND (expires IS NULL OR expires > now());
+    ''', (job_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None, None
+    return _job(row[:-1]), bytes(row[-1]) if row[-1] is not None else None
+
+
+def delete_expired(cur):
+    cur.execute('DELETE FROM report_jobs WHERE expires <= now();')
+    return cur.rowcount
+
+
+class JobRunner:
+    """Runs queued jobs with run(report, params), which returns (body, row count)."""
+
+    def __init__(self, run, workers=None, concurrency=None, queue_limit=None, ttl=None, timeout=None):
+        self._run = run
+        self.workers = workers or env_int("REPORT_JOB_WORKERS", 4)
+        self.concurrency = concurrency or env_int("REPORT_JOB_CONCURRENCY", 2)
+        self.queue_limit = env_int("REPORT_JOB_QUEUE_LIMIT", 100) if queue_limit is None else queue_limit
+        self.ttl = ttl or env_float("REPORT_JOB_TTL", 3600.0)
+        self.timeout = timeout or env_float("REPORT_JOB_TIMEOUT", 600.0)
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_limit)
+        # Notified whenever a job of this process finishes
+        self._cond = threading.Condition()
+        # report -> jobs of it running, and ones waiting for one of those to finish
+        self._running = {}
+        self._waiting = {}
+        self._stats = {'submitted': 0, 'done': 0, 'failed': 0}
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # Called with self._cond held
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='report-job')
+            self._pid = os.getpid()
+        return self._executor
+
+    def reserve(self):
+        """Takes a place in the queue for a job about to be created, or raises JobsBusy."""
+        if not self._slots.acquire(blocking=False):
+            raise JobsBusy("Too many report jobs queued")
+
+    def release(self):
+        """Gives back a place taken by reserve() for a job that was never started."""
+        self._slots.release()
+
+    def start(self, job_id, report, params):
+        """Queues created job `job_id`, whose place reserve() took."""
+        with self._cond:
+            self._stats['submitted'] += 1
+            if self._running.get(report, 0) < self.concurrency:
+                self._running[report] = self._running.get(report, 0) + 1
+                self._get_executor().submit(self._work, job_id, report, params)
+            else:
+                self._waiting.setdefault(report, deque()).append((job_id, params))
+
+    def _work(self, job_id, report, params):
+        try:
+            self._execute(job_id, report, params)
+        finally:
+            self._slots.release()
+            with self._cond:
+                waiting = self._waiting.get(report)
+                if waiting:
+                    # Hand this report's slot straight to its next job
+                    next_id, next_params = waiting.popleft()
+                    self._get_executor().submit(self._work, next_id, report, next_params)
+                else:
+                    self._running[report] -= 1
+                self._cond.notify_all()
+
+    def _execute(self, job_id, report, params):
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute("UPDATE report_jobs SET status = 'running', started = now() WHERE id = %s;", (job_id,))
+            conn.commit()
+        try:
+            body, row_count = self._run(report, params)
+            status, error = 'done', None
+        except Exception as e:
+            print(f"Report job {job_id} ({report}) failed: {e}")
+            body, row_count, status, error = None, None, 'failed', str(e).strip()
+        with db_connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                UPDATE report_jobs
+                SET status = %s, error = %s, result = %s, row_count = %s, finished = now(),
+                    expires = now() + make_interval(secs => %s)
+                WHERE id = %s;
+            ''', (status, error, body, row_count, self.ttl, job_id))
+            conn.commit()
+        with self._cond:
+            self._stats[status] += 1
+
+    def wait(self, timeout):
+        """Waits up to `timeout` seconds, or until one of this process's jobs finishes."""
+        with self._cond:
+            self._cond.wait(timeout)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, workers=self.workers, concurrency=self.concurrency,
+                        queue_limit=self.queue_limit, running=sum(self._running.values()),
+                        waiting=sum(len(waiting) for waiting in self._waiting.values()))
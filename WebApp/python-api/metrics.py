@@ -0,0 +1,254 @@
+"""Request and database metrics in the Prometheus text format.
+
+metrics.init_app(app) times every Flask request, splitting it into connection
+checkout, SQL execution and JSON serialization, and times each SQL statement
+through a cursor subclass installed on pooled connections. The numbers are
+served at /metrics for a local Prometheus (or anything that reads the text
+format). They are per worker process, like /api/pool-stats.
+"""
+import hashlib
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from flask import Response, g, has_request_context, request
+
+import db
+from serialize import JSONProvider
+
+# Seconds. Finer than Prometheus' defaults at the low end, where most queries land.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, labels)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}  # labels -> [count per bucket..., +Inf count, sum]
+
+    def observe(self, *labels, value):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, counts in sorted(self._values.items()):
+                for bound, count in zip((*self.buckets, float('inf')), counts):
+                    bucket_labels = _labels((*self.labels, 'le'), (*labels, _number(bound)))
+                    lines.append(f'{self.name}_bucket{bucket_labels} {count}')
+                lines.append(f'{self.name}_count{_labels(self.labels, labels)} {counts[-2]}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {_number(counts[-1])}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('oakhoury_request_duration_seconds', 'Time to handle a request.',
+                            ('route', 'method', 'status'))
+REQUEST_DB_SECONDS = Histogram('oakhoury_request_db_seconds', 'Time a request spent executing SQL.', ('route',))
+REQUEST_SERIALIZE_SECONDS = Histogram('oakhoury_request_serialize_seconds',
+                                      'Time a request spent turning its result into JSON.', ('route',))
+RESPONSE_BYTES = Histogram('oakhoury_response_bytes', 'Size of response bodies.', ('route',), BYTES_BUCKETS)
+CONNECTION_SECONDS = Histogram('oakhoury_db_connection_acquire_seconds',
+                               'Time to check a connection out of the pool, including waiting.', ('route',))
+QUERY_SECONDS = Histogram('oakhoury_db_query_duration_seconds', 'Time to execute a SQL statement.',
+                          ('route', 'statement'))
+QUERY_ROWS = Counter('oakhoury_db_rows_fetched_total', 'Rows returned by SQL statements.', ('route', 'statement'))
+QUERY_ERRORS = Counter('oakhoury_db_errors_total', 'SQL statements that raised, by SQLSTATE.',
+                       ('route', 'statement', 'pgcode'))
+METRICS = [REQUEST_SECONDS, REQUEST_DB_SECONDS, REQUEST_SERIALIZE_SECONDS, RESPONSE_BYTES, CONNECTION_SECONDS,
+           QUERY_SECONDS, QUERY_ROWS, QUERY_ERRORS]
+
+# statement id -> the start of its SQL, exposed as oakhoury_db_statement_info
+_statements = {}
+_statements_lock = threading.Lock()
+
+
+def _register(key, sql):
+    if key not in _statements:
+        with _statements_lock:
+            _statements[key] = sql[:200]
+
+
+def statement_id(query):
+    """Short stable id for a SQL string, so it can be used as a label.
+
+    Prepared statements are named after this id (see statements.py), so EXECUTE q_<id>
+    is counted under the id of the query it runs.
+    """
+    sql = re.sub(r'\s+', ' ', query).strip()
+    prepared = re.match(r'(PREPARE|EXECUTE) q_([0-9a-f]{12})\b( AS )?', sql)
+    if prepared and prepared.group(1) == 'EXECUTE':
+        return prepared.group(2)
+    if prepared and prepared.group(3):
+        _register(prepared.group(2), sql[prepared.end():])
+    key = hashlib.sha1(sql.encode()).hexdigest()[:12]
+    _register(key, sql)
+    return key
+
+
+def _route():
+    if not has_request_context():
+        return 'none'
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def _add(name, value):
+    if has_request_context():
+        setattr(g, name, g.get(name, 0.0) + value)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Records the time, rows and errors of every statement it executes."""
+
+    def execute(self, query, vars=None):
+        if isinstance(query, bytes):
+            text = query.decode()
+        elif isinstance(query, str):
+            text = query
+        else:
+            text = query.as_string(self)
+        statement = statement_id(text)
+        route = _route()
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except psycopg2.Error as e:
+            QUERY_ERRORS.inc(route, statement, e.pgcode or 'none')
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            QUERY_SECONDS.observe(route, statement, value=elapsed)
+            _add('metrics_db_seconds', elapsed)
+        if self.description is not None:
+            QUERY_ROWS.inc(route, statement, amount=max(self.rowcount, 0))
+        return result
+
+
+class TimedJSONProvider(JSONProvider):
+    """The API's JSON provider, adding the time spent serializing to the request's metrics."""
+
+    def response(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            _add('metrics_serialize_seconds', time.perf_counter() - started)
+
+    def rows(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().rows(*args, **kwargs)
+        finally:
+            _add('metrics_serialize_seconds', time.perf_counter() - started)
+
+
+def _on_checkout(seconds):
+    CONNECTION_SECONDS.observe(_route(), value=seconds)
+
+
+def _pool_lines():
+    try:
+        stats = db.get_pool().stats()
+    except db.DatabaseUnavailable:
+        return []
+    lines = ['# HELP oakhoury_db_pool_connections Pooled connections by state.',
+             '# TYPE oakhoury_db_pool_connections gauge',
+             f'oakhoury_db_pool_connections{{state="in_use"}} {stats["in_use"]}',
+             f'oakhoury_db_pool_connections{{state="idle"}} {stats["idle"]}']
+    for name in ('checkouts', 'waits', 'timeouts', 'connections_opened', 'connections_closed',
+                 'validation_failures'):
+        lines.append(f'# TYPE oakhoury_db_pool_{name}_total counter')
+        lines.append(f'oakhoury_db_pool_{name}_total {stats[name]}')
+    return lines
+
+
+def expose():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    lines.extend(['# HELP oakhoury_db_statement_info SQL text of each statement id.',
+                  '# TYPE oakhoury_db_statement_info gauge'])
+    with _statements_lock:
+        for key, sql in sorted(_statements.items()):
+            lines.append(f'oakhoury_db_statement_info{_labels(("statement", "sql"), (key, sql))} 1')
+    lines.extend(_pool_lines())
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    """Instruments `app` and adds the /metrics route. Call before the first request."""
+    db.pool_hooks['cursor_factory'] = InstrumentedCursor
+    db.pool_hooks['on_checkout'] = _on_checkout
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_started' not in g or request.path == '/metrics':
+            return response
+        route = _route()
+        REQUEST_SECONDS.observe(route, request.method, str(response.status_code),
+                                value=time.perf_counter() - g.metrics_started)
+        REQUEST_DB_SECONDS.observe(route, value=g.get('metrics_db_seconds', 0.0))
+        REQUEST_SERIALIZE_SECONDS.observe(route, value=g.get('metrics_serialize_seconds', 0.0))
+        size = response.calculate_content_length()
+        if size is not None:
+            RESPONSE_BYTES.observe(route, value=size)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(expose(), mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,148 @@
+"""Versioned schema migrations.
+
+ddl.sql creates the baseline schema. Every change after it is a numbered SQL file in
+/migrations (0001_some_name.sql, 0002_...) that "flask --app app migrate" applies in
+order, recording each in the schema_migrations table so it only ever runs once.
+
+A migration runs in one transaction, with a short lock_timeout so it gives up rather
+than queueing live traffic behind it, unless its first line is
+
+    -- migrate: no-transaction
+
+Those run one statement at a time in autocommit mode, which CREATE INDEX CONCURRENTLY
+needs to build an index without blocking writes. They are split on semicolons, so keep
+them to plain statements, and make them safe to re-run (IF NOT EXISTS) since a failure
+halfway leaves the earlier statements applied. Indexes a failed concurrent build left
+behind as invalid are dropped before the migration is retried.
+"""
+import os
+import re
+import time
+
+import psycopg2
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                              'migrations')
+NO_TRANSACTION = '-- migrate: no-transaction'
+# Held for the whole run so two deploys can't apply migrations at the same time
+ADVISORY_LOCK = 7_302_014
+
+
+class MigrationError(Exception):
+    """Raised for a malformed migrations directory or a migration that failed."""
+
+
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+        with open(path) as f:
+            self.sql = f.read()
+        self.transactional = not self.sql.lstrip().startswith(NO_TRANSACTION)
+
+    def statements(self):
+        """The migration's statements, for running one at a time outside a transaction."""
+        sql = re.sub(r'--[^\n]*', '', self.sql)
+        return [statement.strip() for statement in sql.split(';') if statement.strip()]
+
+    def concurrent_indexes(self):
+        return re.findall(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)',
+                          self.sql, re.IGNORECASE)
+
+
+def discover(directory=MIGRATIONS_DIR):
+    """Every migration file in `directory`, in version order."""
+    migrations = {}
+    for filename in sorted(os.listdir(directory)):
+        match = re.fullmatch(r'(\d+)_(\w+)\.sql', filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise MigrationError(f"Two migrations are numbered {version}: "
+                                 f"{os.path.basename(migrations[version].path)} and {filename}")
+        migrations[version] = Migration(version, match.group(2), os.path.join(directory, filename))
+    return [migrations[version] for version in sorted(migrations)]
+
+
+def applied(conn):
+    """{version: (name, applied_at, duration_ms)} of the migrations already applied."""
+    with conn.cursor() as cur:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations
+            (
+                version     INTEGER PRIMARY KEY,
+                name        TEXT      NOT NULL,
+                applied_at  TIMESTAMP NOT NULL DEFAULT NOW(),
+                duration_ms INTEGER   NOT NULL
+            );
+        ''')
+        cur.execute('SELECT version, name, applied_at, duration_ms FROM schema_migrations ORDER BY version;')
+        return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+def _drop_invalid_indexes(cur, names):
+    cur.execute('''
+        SELECT c.relname
+        FROM pg_index i
+                 INNER JOIN pg_class c ON i.indexrelid = c.oid
+        WHERE NOT i.indisvalid
+          AND c.relname = ANY(%s);
+    ''', (names,))
+    for (name,) in cur.fetchall():
+        print(f"  dropping invalid index {name} left by an earlier attempt")
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name};')
+
+
+def _apply(conn, migration, lock_timeout):
+    started = time.perf_counter()
+    if migration.transactional:
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SET LOCAL lock_timeout = %s;', (lock_timeout,))
+                cur.execute(migration.sql)
+                cur.execute('INSERT INTO schema_migrations (version, name, duration_ms) VALUES (%s, %s, %s);',
+                            (migration.version, migration.name, round((time.perf_counter() - started) * 1000)))
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+    else:
+        with conn.cursor() as cur:
+            _drop_invalid_indexes(cur, migration.concurrent_indexes())
+            for statement in migration.statements():
+                cur.execute(statement)
+            cur.execute('INSERT INTO schema_migrations (version, name, duration_ms) VALUES (%s, %s, %s);',
+                        (migration.version, migration.name, round((time.perf_counter() - started) * 1000)))
+    return time.perf_counter() - started
+
+
+def migrate(conn, migrations=None, target=None, lock_timeout=None):
+    """Applies the pending migrations up to `target` (default: all). Returns the ones applied."""
+    migrations = discover() if migrations is None else migrations
+    lock_timeout = lock_timeout or os.getenv("MIGRATION_LOCK_TIMEOUT") or '5s'
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_lock(%s);', (ADVISORY_LOCK,))
+    try:
+        done = applied(conn)
+        ran = []
+        for migration in migrations:
+            if migration.version in done or (target is not None and migration.version > target):
+                continue
+            print(f"Applying {migration.version:04d}_{migration.name}"
+                  f"{'' if migration.transactional else ' (outside a transaction)'}", flush=True)
+            try:
+                seconds = _apply(conn, migration, lock_timeout)
+            except psycopg2.Error as e:
+                raise MigrationError(f"{migration.version:04d}_{migration.name} failed: {e}") from e
+            print(f"  done in {seconds:.2f}s")
+            ran.append(migration)
+        return ran
+    finally:
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_unlock(%s);', (ADVISORY_LOCK,))
@@ -0,0 +1,70 @@
+import base64
+from datetime import datetime
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class PaginationError(ValueError):
+    """Raised for a malformed limit, cursor or date filter."""
+
+
+def encode_cursor(submission_timestamp, tree_request_id):
+    raw = f"{submission_timestamp.isoformat()}|{tree_request_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Turns a cursor back into the (submission_timestamp, id) of the last row on the previous page."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, tree_request_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(tree_request_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise PaginationError("Invalid cursor") from e
+
+
+def parse_page_args(args):
+    """Reads `limit` and `cursor` from the query string. Returns (limit, (timestamp, id) or None)."""
+    limit = args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError as e:
+        raise PaginationError("limit must be a whole number") from e
+    if limit < 1:
+        raise PaginationError("limit must be positive")
+    cursor = args.get('cursor')
+    return min(limit, MAX_PAGE_SIZE), decode_cursor(cursor) if cursor else None
+
+
+def parse_date_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError as e:
+        raise PaginationError(f"{name} must be an ISO 8601 date") from e
+
+
+def parse_id_list(args, name, max_ids=MAX_PAGE_SIZE):
+    """Reads a comma-separated list of ids such as ?ids=3,5,8 for the batch endpoints."""
+    value = args.get(name)
+    if not value:
+        raise PaginationError(f"Missing {name} parameter")
+    try:
+        ids = list(dict.fromkeys(int(part) for part in value.split(',') if part.strip()))
+    except ValueError as e:
+        raise PaginationError(f"{name} must be a comma-separated list of ids") from e
+    if len(ids) > max_ids:
+        raise PaginationError(f"At most {max_ids} {name} per request")
+    return ids
+
+
+def page_headers(rows, limit, timestamp_index, id_index):
+    """Trims the look-ahead row and returns (rows, headers) with X-Next-Cursor set if there is more."""
+    if len(rows) <= limit:
+        return rows, {}
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, {'X-Next-Cursor': encode_cursor(last[timestamp_index], last[id_index])}
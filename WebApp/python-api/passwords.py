@@ -0,0 +1,134 @@
+"""Password hashing and verification for /api/login and /api/register.
+
+Argon2 is deliberately slow (tens of milliseconds of CPU per hash), so it runs on a
+pool of worker processes, one per core by default, rather than in the request thread.
+A burst of logins then spreads over every core instead of queueing on one, and the
+worker's request threads stay free for other requests. The pool only accepts
+PASSWORD_QUEUE_LIMIT jobs beyond the ones running; past that, PasswordBusy is raised
+and the route answers 503 instead of letting waits grow without bound.
+
+With HASH_PASSWORDS=false (the default, so the plain-text passwords in dml.sql work)
+passwords are stored and compared as they are and the pool is never started.
+"""
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from db import env_float, env_int
+
+
+class PasswordBusy(Exception):
+    """Raised when the password pool's queue is full."""
+
+
+def hashing_enabled():
+    return os.getenv("HASH_PASSWORDS", "false").lower() in ("true", "1", "yes")
+
+
+def _hasher():
+    from argon2 import PasswordHasher  # Only needed with HASH_PASSWORDS=true
+
+    return PasswordHasher()
+
+
+# These run in the pool's worker processes
+def _hash(password):
+    return _hasher().hash(password)
+
+
+def _verify(stored, password):
+    """(matches, new hash if the stored one uses outdated parameters, else None)."""
+    from argon2.exceptions import InvalidHashError, VerificationError
+
+    hasher = _hasher()
+    try:
+        hasher.verify(stored, password)
+    except (VerificationError, InvalidHashError):
+        return False, None
+    return True, hasher.hash(password) if hasher.check_needs_rehash(stored) else None
+
+
+class PasswordPool:
+    def __init__(self, workers=None, queue_limit=None, timeout=None):
+        self.workers = workers or env_int("PASSWORD_WORKERS", os.cpu_count() or 1)
+        self.queue_limit = env_int("PASSWORD_QUEUE_LIMIT", 4 * self.workers) if queue_limit is None else queue_limit
+        self.timeout = timeout or env_float("PASSWORD_TIMEOUT", 10.0)
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_limit)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # Spawned, not forked, so workers don't inherit this process's database sockets
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self._pid = os.getpid()
+            return self._executor
+
+    def run(self, fn, *args):
+        """Runs fn(*args) on the pool and waits for its result."""
+        if not self._slots.acquire(blocking=False):
+            raise PasswordBusy("Too many password checks in progress")
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the job finishes, even if this request stops waiting for it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool for the next job
+            with self._lock:
+                self._executor = None
+            raise
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """This process's password pool, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PasswordPool()
+        return _pool
+
+
+def hash_password(password):
+    """The value to store for `password`."""
+    if not hashing_enabled():
+        return password
+    return get_pool().run(_hash, password)
+
+
+# Checked against when the email is unknown, so that takes as long as a wrong password
+_dummy_hash = None
+
+
+def _get_dummy_hash():
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = get_pool().run(_hash, secrets.token_hex(16))
+    return _dummy_hash
+
+
+def verify_password(stored, password):
+    """(matches, new value to store or None) for a login with `password`.
+
+    `stored` is None for an unknown email.
+    """
+    if not hashing_enabled():
+        return stored is not None and hmac.compare_digest(stored.encode(), password.encode()), None
+    if stored is None or not stored.startswith('$argon2'):
+        get_pool().run(_verify, _get_dummy_hash(), password)
+        return False, None
+    return get_pool().run(_verify, stored, password)
@@ -0,0 +1,490 @@
+"""SQL and JSON shapes for the read endpoints.
+
+The Flask app (app.py, psycopg2) and the ASGI app (asgi.py, asyncpg) both serve these
+endpoints, so each query lives here once. The JSON objects built from its rows are keyed
+by its column names. Queries are written with psycopg2's %s placeholders.
+"""
+import re
+from datetime import datetime
+from functools import lru_cache
+
+from pagination import parse_date_arg, parse_page_args
+
+
+@lru_cache(maxsize=None)
+def numbered(sql):
+    """Rewrites psycopg2 %s placeholders as asyncpg's $1, $2, ..."""
+    count = 0
+
+    def replace(match):
+        nonlocal count
+        if match.group() == '%%':
+            return '%'
+        count += 1
+        return f'${count}'
+    return re.sub(r'%%|%s', replace, sql)
+
+
+def column_names(result):
+    """Names of a result's columns: from a psycopg2 cursor's description, or an asyncpg Record's keys."""
+    if hasattr(result, 'description'):
+        return [column.name for column in result.description]
+    return list(result.keys())
+
+
+class Query:
+    """A read query. Its rows become JSON objects keyed by the query's column names, so a
+    key that differs from the underlying column is an alias in the SQL.
+
+    A scalar query's rows each become their first value instead of an object.
+    """
+
+    def __init__(self, sql, scalar=False):
+        self.sql = sql
+        self.scalar = scalar
+
+    @property
+    def async_sql(self):
+        return numbered(self.sql)
+
+    def keys(self, names):
+        """JSON keys for rows of this query with columns `names` (see column_names), or None if it's scalar."""
+        return None if self.scalar else list(names)
+
+    def shape(self, row, names):
+        return dict(zip(names, row))
+
+
+# Both listings page newest first on (submission_timestamp, id) and fetch one row past the
+# page so page_headers() knows whether to hand out a cursor.
+def tree_requests_page(resident_id, args):
+    """Returns (query, params, limit) for one page of a resident's tree requests."""
+    limit, after = parse_page_args(args)
+    filters = ['tr.resident_id = %s']
+    params = [resident_id]
+    if after:
+        filters.append('(tr.submission_timestamp, tr.id) < (%s, %s)')
+        params.extend(after)
+    query = Query(f'''
+        SELECT id, submission_timestamp, approved
+        FROM tree_requests tr
+        WHERE {' AND '.join(filters)}
+        ORDER BY tr.submission_timestamp DESC, tr.id DESC
+        LIMIT %s;
+    ''')
+    return query, [*params, limit + 1], limit
+
+
+def _all_tree_requests_filters(args):
+    """(WHERE conditions, params) for the admin listing's status/neighborhood/tree/date filters."""
+    submitted_after = parse_date_arg(args, 'submitted_after')
+    submitted_before = parse_date_arg(args, 'submitted_before')
+
+    filters = []
+    params = []
+    if args.get('status'):
+        filters.append('tr.status = %s')
+        params.append(args.get('status'))
+    if args.get('neighborhood'):
+        filters.append('r.neighborhood = %s')
+        params.append(args.get('neighborhood'))
+    if args.get('tree_id'):
+        filters.append('tr.tree_id = %s')
+        params.append(args.get('tree_id'))
+    if submitted_after:
+        filters.append('tr.submission_timestamp >= %s')
+        params.append(submitted_after)
+    if submitted_before:
+        filters.append('tr.submission_timestamp < %s')
+        params.append(submitted_before)
+    return filters, params
+
+
+def _all_tree_requests_query(filters, limit=''):
+    return Query(f'''
+        SELECT tr.id,
+               tr.submission_timestamp,
+               tr.approved,
+               tr.status,
+               t.common_name,
+               t.scientific_name
+        FROM tree_requests tr
+                 INNER JOIN trees t ON tr.tree_id = t.id
+                 INNER JOIN residents r ON tr.resident_id = r.id
+        {'WHERE ' + ' AND '.join(filters) if filters else ''}
+        ORDER BY tr.submission_timestamp DESC, tr.id DESC
+        {limit};
+    ''')
+
+
+def all_tree_requests_page(args):
+    """Returns (query, params, limit) for one page of the admin tree request listing."""
+    limit, after = parse_page_args(args)
+    filters, params = _all_tree_requests_filters(args)
+    if after:
+        filters.append('(tr.submission_timestamp, tr.id) < (%s, %s)')
+        params.extend(after)
+    return _all_tree_requests_query(filters, 'LIMIT %s'), [*params, limit + 1], limit
+
+
+def all_tree_requests_export(args):
+    """Returns (query, params) for every tree request matching the admin listing's filters."""
+    filters, params = _all_tree_requests_filters(args)
+    return _all_tree_requests_query(filters), params
+
+
+# A resident's view of one of their tree requests
+TREE_REQUEST_DETAILS = Query('''
+    SELECT
+            t.common_name,
+            t.scientific_name,
+            tr.status,
+            CURRENT_DATE - submission_timestamp::DATE AS days_since_planting,
+            p.status AS permit_status
+        FROM tree_requests tr
+        INNER JOIN trees t ON tr.tree_id = t.id
+        INNER JOIN permits p ON tr.id = p.tree_request_id
+        WHERE tr.id = %s AND tr.resident_id = %s;
+''')
+
+
+# Admin view of tree requests, with their visits and plantings nested as JSON arrays and
+# whether each one's outcome has been recorded. Rows come back in the order of the ids passed.
+TREE_REQUEST_DETAILS_ADMIN = Query('''
+    SELECT tr.id             AS tree_request_id,
+           t.common_name     AS tree_common_name,
+           t.scientific_name AS tree_scientific_name,
+           t.inventory       AS tree_inventory,
+           tr.site_description,
+           r.street          AS resident_street,
+           r.zip_code        AS resident_zip_code,
+           r.neighborhood    AS resident_neighborhood,
+           tr.status,
+           (SELECT COALESCE(json_agg(json_build_object('event_id', sv.event_id,
+                                                       'event_timestamp', sv.event_timestamp,
+                                                       'cancelled', sv.cancelled,
+                                                       'notes', sv.notes,
+                                                       'organization_member_id', sv.organization_member_id,
+                                                       'outcome_recorded', ve.scheduled_visit_id IS NOT NULL)
+                                     ORDER BY sv.event_timestamp DESC), '[]')
+            FROM scheduled_visits sv
+                     LEFT JOIN visit_events ve ON sv.event_id = ve.scheduled_visit_id
+            WHERE sv.tree_request_id = tr.id) AS scheduled_visits,
+           (SELECT COALESCE(json_agg(json_build_object('event_id', sp.event_id,
+                                                       'event_timestamp', sp.event_timestamp,
+                                                       'cancelled', sp.cancelled,
+                                                       'notes', sp.notes,
+                                                       'outcome_recorded', pe.scheduled_planting_id IS NOT NULL)),
+                             '[]')
+            FROM scheduled_plantings sp
+                     LEFT JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+            WHERE sp.tree_request_id = tr.id) AS scheduled_plantings
+    FROM unnest(%s::INTEGER[]) WITH ORDINALITY AS requested(id, position)
+             INNER JOIN tree_requests tr ON tr.id = requested.id
+             INNER JOIN trees t ON tr.tree_id = t.id
+             INNER JOIN residents r ON tr.resident_id = r.id
+    ORDER BY requested.position;
+''')
+
+
+def tree_request_details_admin(row, names):
+    """Shapes a TREE_REQUEST_DETAILS_ADMIN row.
+
+    json_agg writes timestamps as ISO strings, so they are turned back into datetimes to
+    be serialized like every other timestamp the API returns.
+    """
+    details = TREE_REQUEST_DETAILS_ADMIN.shape(row, names)
+    for event in (*details['scheduled_visits'], *details['scheduled_plantings']):
+        event['event_timestamp'] = datetime.fromisoformat(event['event_timestamp'])
+    return details
+
+
+# Manage-planting view of scheduled plantings: the planting, its outcome and everyone assigned
+# to or attending it, one row per planting with the people aggregated as JSON arrays.
+SCHEDULED_PLANTING_DETAILS = Query('''
+    SELECT sp.event_id,
+           sp.tree_request_id,
+           sp.event_timestamp,
+           sp.cancelled,
+           sp.notes,
+           tr.site_description,
+           pe.scheduled_planting_id IS NOT NULL AS outcome_recorded,
+           pe.successful   AS outcome_successful,
+           pe.observations AS outcome_observations,
+           (SELECT COALESCE(json_agg(json_build_object('id', r.id, 'first_name', r.first_name,
+                                                       'last_name', r.last_name)), '[]')
+            FROM planting_events_have_volunteers pehv
+                     INNER JOIN residents r ON pehv.volunteer_id = r.id
+            WHERE pehv.planting_event_id = pe.scheduled_planting_id) AS attended_volunteers,
+           (SELECT COALESCE(json_agg(json_build_object('id', r.id, 'first_name', r.first_name,
+                                                       'last_name', r.last_name)), '[]')
+            FROM scheduled_plantings_have_volunteers spv
+                     INNER JOIN residents r ON spv.volunteer_id = r.id
+            WHERE spv.planting_event_id = sp.event_id) AS assigned_volunteers,
+           (SELECT COALESCE(json_agg(json_build_object('id', r.id, 'first_name', r.first_name,
+                                                       'last_name', r.last_name)), '[]')
+            FROM organization_members_lead_scheduled_plantings omsp
+                     INNER JOIN residents r ON omsp.organization_member_id = r.id
+            WHERE omsp.scheduled_planting_id = sp.event_id) AS assigned_org_members
+    FROM scheduled_plantings sp
+             INNER JOIN tree_requests tr ON sp.tree_request_id = tr.id
+             LEFT JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+    WHERE sp.event_id = ANY(%s::INTEGER[])
+    ORDER BY sp.event_timestamp, sp.event_id;
+''')
+
+
+def planting_details(row, names):
+    """Shapes a SCHEDULED_PLANTING_DETAILS row. The outcome keys are only there once it's recorded."""
+    details = SCHEDULED_PLANTING_DETAILS.shape(row, names)
+    if not details['outcome_recorded']:
+        for key in ('outcome_successful', 'outcome_observations', 'attended_volunteers'):
+            del details[key]
+    return details
+
+
+# Tree catalog
+TREES = Query('''
+    SELECT id, common_name, scientific_name, inventory FROM trees ORDER BY common_name;
+''')
+
+
+# Neighborhood names, returned as a plain list
+NEIGHBORHOODS = Query('''
+    SELECT name FROM neighborhoods ORDER BY name;
+''', scalar=True)
+
+
+# Task 1
+TREE_REQUESTS_STATUS = Query('''
+    SELECT id,
+           status,
+           CURRENT_DATE - submission_timestamp::DATE AS days_since_submission
+    FROM tree_requests tr
+    WHERE status <> 'completed'
+    ORDER BY id;
+''')
+
+
+# Task 2
+TREES_PLANTED = Query('''
+    SELECT t.common_name,
+           COUNT(*) AS number_of_trees
+    FROM neighborhoods n
+             INNER JOIN residents r
+                        ON n.name = r.neighborhood
+             INNER JOIN tree_requests tr
+                        ON r.id = tr.resident_id
+             INNER JOIN scheduled_plantings sp
+                        ON tr.id = sp.tree_request_id
+             INNER JOIN planting_events pe
+                        ON sp.event_id = pe.scheduled_planting_id
+                            AND pe.successful = TRUE
+             INNER JOIN trees t
+                        ON tr.tree_id = t.id
+    WHERE n.name = %s
+    GROUP BY t.common_name;
+''')
+
+
+# Task 3, served from the species_yearly_plantings rollup
+TREE_SPECIES_STATISTICS = Query('''
+    SELECT t.common_name,
+           SUM(syp.num_planted)                                 AS number_of_trees_planted,
+           EXTRACT(YEAR FROM CURRENT_DATE) - MAX(syp.year)      AS years_since_planting,
+           peak.year::NUMERIC                                   AS year_most_planted,
+           peak.num_planted                                     AS num_planted_in_peak_year
+    FROM trees t
+        INNER JOIN species_yearly_plantings syp ON t.id = syp.tree_id
+        CROSS JOIN LATERAL (SELECT year, num_planted
+                            FROM species_yearly_plantings
+                            WHERE tree_id = t.id
+                            ORDER BY num_planted DESC, year DESC
+                            LIMIT 1) peak
+    GROUP BY t.common_name, t.id, peak.year, peak.num_planted
+    ORDER BY t.common_name;
+''')
+
+
+# Task 4, served from the neighborhood_status_counts rollup
+NEIGHBORHOOD_REPORT = Query('''
+    SELECT neighborhood_name,
+           num_of_planted_trees,
+           num_of_requests,
+           num_of_completed_requests,
+           num_of_requests_waiting_for_planting,
+           num_of_requests_waiting_for_visit,
+           num_of_requests_needs_permit,
+           num_of_denied_requests,
+           num_of_requests_pending_approval
+    FROM neighborhood_report
+    ORDER BY neighborhood_name ASC;
+''')
+
+
+# Custom report 1: most active volunteers in a year, from volunteer_yearly_plantings
+CUSTOM_REPORT_1 = Query('''
+    SELECT
+        r.first_name || ' ' || r.last_name AS volunteer_name,
+        vyp.first_planting,
+        vyp.most_recent_planting,
+        vyp.trees_planted,
+        peak.year::NUMERIC                 AS peak_year,
+        peak.plantings_attended            AS trees_planted_in_peak_year
+    FROM
+        volunteer_yearly_plantings AS vyp
+            INNER JOIN residents AS r ON vyp.volunteer_id = r.id
+            CROSS JOIN LATERAL (SELECT year, plantings_attended
+                                FROM volunteer_yearly_plantings
+                                WHERE volunteer_id = vyp.volunteer_id
+                                ORDER BY plantings_attended DESC, year DESC
+                                LIMIT 1) peak
+    WHERE
+          r.is_volunteer = TRUE
+      AND vyp.year = %s::TEXT::INTEGER
+      AND vyp.trees_planted > 0
+    ORDER BY trees_planted DESC, trees_planted_in_peak_year DESC, volunteer_name;
+''')
+
+
+# Custom report 2: plantings led and visits attended by organization members in a year, from
+# org_member_yearly_activity
+CUSTOM_REPORT_2 = Query('''
+    SELECT
+        r.first_name || ' ' || r.last_name                              AS org_member_name,
+        -- The report has always joined every planting led to every visit attended that year,
+        -- so it counts each planting once per visit and each visit once per planting
+        oma.plantings_led * GREATEST(oma.visits_attended, 1)            AS plantings_led,
+        oma.successful_plantings_led * GREATEST(oma.visits_attended, 1) AS successful_plantings_led,
+        led_peak.year::NUMERIC                                          AS plantings_led_peak_year,
+        led_peak.all_successful_plantings_led                           AS plantings_led_in_peak_year,
+        oma.visits_attended * oma.plantings_led                         AS visits_attended,
+        visits_peak.year::NUMERIC                                       AS visits_attended_peak_year,
+        visits_peak.visits_attended                                     AS visits_attended_in_peak_year
+    FROM
+        org_member_yearly_activity AS oma
+            INNER JOIN organization_members AS om ON oma.organization_member_id = om.resident_id
+            INNER JOIN residents AS r ON om.resident_id = r.id
+            LEFT JOIN LATERAL (SELECT year, all_successful_plantings_led
+                               FROM org_member_yearly_activity
+                               WHERE organization_member_id = oma.organization_member_id
+                                 AND all_successful_plantings_led > 0
+                               ORDER BY all_successful_plantings_led DESC, year DESC
+                               LIMIT 1) led_peak ON TRUE
+            LEFT JOIN LATERAL (SELECT year, visits_attended
+                               FROM org_member_yearly_activity
+                               WHERE organization_member_id = oma.organization_member_id
+                                 AND visits_attended > 0
+                               ORDER BY visits_attended DESC, year DESC
+                               LIMIT 1) visits_peak ON TRUE
+    WHERE
+            oma.year = %s::TEXT::INTEGER
+        AND oma.plantings_led > 0
+    ORDER BY plantings_led DESC, visits_attended DESC, org_member_name;
+''')
+
+
+# Custom report 3: plantings of a species by neighborhood, from neighborhood_species_yearly_plantings
+CUSTOM_REPORT_3 = Query('''
+    SELECT
+        planted.common_name,
+        planted.neighborhood        AS neighborhood_name,
+        planted.num_in_neighborhood AS total_trees_planted,
+        this_year.num_planted       AS trees_planted_this_year,
+        peak.year::NUMERIC          AS peak_year,
+        peak.num_planted            AS trees_planted_in_peak_year
+    FROM
+        (SELECT t.common_name, t.id, nsyp.neighborhood, SUM(nsyp.num_planted) AS num_in_neighborhood
+         FROM trees AS t
+                  INNER JOIN neighborhood_species_yearly_plantings AS nsyp ON t.id = nsyp.tree_id
+         WHERE t.common_name = %s
+         GROUP BY t.common_name, t.id, nsyp.neighborhood) planted
+            -- Both of these count every species planted in the neighborhood
+            CROSS JOIN LATERAL (SELECT COALESCE(SUM(num_planted), 0) AS num_planted
+                                FROM neighborhood_species_yearly_plantings
+                                WHERE neighborhood = planted.neighborhood
+                                  AND year = EXTRACT(YEAR FROM CURRENT_DATE)) this_year
+            CROSS JOIN LATERAL (SELECT year, SUM(num_planted) AS num_planted
+                                FROM neighborhood_species_yearly_plantings
+                                WHERE neighborhood = planted.neighborhood
+                                GROUP BY year
+                                ORDER BY SUM(num_planted) DESC, year DESC
+                                LIMIT 1) peak
+    ORDER BY planted.common_name ASC, planted.neighborhood ASC;
+''')
+
+
+# (id, organization role or NULL, is_volunteer) of the given residents, for roles.RoleCache
+RESIDENT_ROLES = Query('''
+    SELECT r.id, om.role, COALESCE(r.is_volunteer, FALSE)
+    FROM residents r
+             LEFT OUTER JOIN organization_members om ON om.resident_id = r.id
+    WHERE r.id = ANY (%s::INTEGER[]);
+''')
+
+
+# The whole tree catalog for catalog.TreeCatalog, which answers /api/trees/search and custom
+# report 4 in memory. Ranges come back as their bounds and each tree carries how many requests
+# it has and how many of those were planted successfully.
+TREE_CATALOG = Query('''
+    SELECT t.id,
+           t.common_name,
+           t.scientific_name,
+           LOWER(t.height_range),
+           UPPER(t.height_range),
+           LOWER(t.width_range),
+           UPPER(t.width_range),
+           t.drought_tolerance::TEXT,
+           t.growth_rate::TEXT,
+           t.foliage_type::TEXT,
+           t.plantable_under_power_lines,
+           t.native_to_ca,
+           t.pzharshsites,
+           t.pzbay,
+           t.pzurbanized,
+           t.pznearnaturalareas,
+           t.visual_attraction,
+           COALESCE(t.inventory, 0),
+           COALESCE(requests.requested, 0),
+           COALESCE(requests.num_planted, 0)
+    FROM trees t
+             LEFT OUTER JOIN (SELECT tr.tree_id,
+                                     COUNT(DISTINCT tr.id) AS requested,
+                                     COUNT(pe)             AS num_planted
+                              FROM tree_requests tr
+                                       LEFT OUTER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
+                                       LEFT OUTER JOIN planting_events pe
+                                                       ON sp.event_id = pe.scheduled_planting_id AND pe.successful = TRUE
+                              GROUP BY tr.tree_id) requests ON t.id = requests.tree_id
+    ORDER BY t.id;
+''')
+
+
+# Custom report 5: volunteer attendance and success rate
+CUSTOM_REPORT_5 = Query('''
+    WITH scheduled_volunters AS (SELECT
+        r.first_name || ' ' || r.last_name AS volunteer_name,
+        COUNT(sp) AS num_plantings_scheduled_for
+    FROM residents r
+         INNER JOIN scheduled_plantings_have_volunteers sphv ON r.id = sphv.volunteer_id
+         LEFT OUTER JOIN scheduled_plantings sp ON sphv.planting_event_id = sp.event_id AND sp.cancelled = FALSE
+    WHERE is_volunteer = TRUE
+    GROUP BY r.first_name, r.last_name),
+    attended_volunteers AS (SELECT
+        r.first_name || ' ' || r.last_name AS volunteer_name,
+        COUNT(pehv) AS num_plantings_attended,
+        COUNT(spe) AS num_successful_plantings_attended
+    FROM residents r
+             INNER JOIN planting_events_have_volunteers pehv ON r.id = pehv.volunteer_id
+             LEFT OUTER JOIN planting_events spe ON pehv.planting_event_id = spe.scheduled_planting_id AND spe.successful = TRUE
+    WHERE is_volunteer = TRUE
+    GROUP BY r.first_name, r.last_name)
+    SELECT sv.volunteer_name,
+           av.num_plantings_attended,
+           (sv.num_plantings_scheduled_for - av.num_plantings_attended) AS num_plantings_missed,
+           (av.num_successful_plantings_attended::FLOAT / av.num_plantings_attended::FLOAT) AS success_rate_of_attended_plantings
+    FROM scheduled_volunters sv
+        LEFT OUTER JOIN attended_volunteers av ON sv.volunteer_name = av.volunteer_name
+    GROUP BY sv.volunteer_name, sv.num_plantings_scheduled_for, av.num_plantings_attended, av.num_successful_plantings_attended
+    ORDER BY success_rate_of_attended_plantings ASC, num_plantings_missed DESC;
+''')
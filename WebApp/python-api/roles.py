@@ -0,0 +1,87 @@
+"""Cached organization-membership and volunteer lookups for admin authorization.
+
+Every admin page asks /api/is_organization_member before doing anything else, so the
+answer is kept in the worker for ROLE_CACHE_TTL seconds (60 by default) instead of being
+queried each time. Entries are also stamped with the report cache's version of
+organization_members, like the catalog index, so a bump of that table drops them at
+once, and approve_volunteer invalidates the resident it changed. With several workers
+and the in-process report cache, another worker can serve a stale role until its
+entry's TTL runs out.
+"""
+import threading
+import time
+
+from db import env_float, env_int
+
+# Tables whose writes change a role
+TABLES = ('organization_members',)
+
+
+def role(resident_id, member_role=None, is_volunteer=False):
+    return {'resident_id': resident_id, 'is_organization_member': member_role is not None, 'role': member_role,
+            'is_volunteer': is_volunteer}
+
+
+class RoleCache:
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = env_float("ROLE_CACHE_TTL", 60.0) if ttl is None else ttl
+        self.max_entries = env_int("ROLE_CACHE_MAX_ENTRIES", 10000) if max_entries is None else max_entries
+        self._lock = threading.Lock()
+        # resident id -> (expires at, versions of TABLES, role)
+        self._entries = {}
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def get_many(self, ids, versions):
+        """({id: role} of the fresh entries among `ids`, [ids to look up])."""
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for resident_id in ids:
+                entry = self._entries.get(resident_id)
+                if entry is not None and entry[0] > now and entry[1] == versions:
+                    found[resident_id] = entry[2]
+                else:
+                    missing.append(resident_id)
+            self._stats['hits'] += len(found)
+            self._stats['misses'] += len(missing)
+        return found, missing
+
+    def set_many(self, roles, versions):
+        if self.ttl <= 0:
+            return
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            if len(self._entries) + len(roles) > self.max_entries:
+                self._entries = {resident_id: entry for resident_id, entry in self._entries.items()
+                                 if entry[1] == versions and entry[0] > time.monotonic()}
+            for resident_id, value in roles.items():
+                if len(self._entries) >= self.max_entries:
+                    break
+                self._entries[resident_id] = (expires, versions, value)
+
+    def invalidate(self, *ids):
+        with self._lock:
+            for resident_id in ids:
+                self._entries.pop(resident_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), max_entries=self.max_entries, ttl=self.ttl)
+
+
+def lookup(cache, versions, ids, load):
+    """Roles of `ids`, in that order. The ones not cached are read with load(ids), which
+    returns queries.RESIDENT_ROLES rows. Unknown ids are neither members nor volunteers."""
+    found, missing = cache.get_many(ids, versions)
+    if missing:
+        # Unknown ids are cached too, so probing them doesn't reach Postgres either
+        loaded = {resident_id: role(resident_id) for resident_id in missing}
+        for resident_id, member_role, is_volunteer in load(missing):
+            loaded[resident_id] = role(resident_id, member_role, is_volunteer)
+        cache.set_many(loaded, versions)
+        found.update(loaded)
+    return [found[resident_id] for resident_id in ids]
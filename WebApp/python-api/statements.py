@@ -0,0 +1,117 @@
+"""Server-side prepared statements for the queries in queries.py.
+
+statements.execute(cur, query, params) replaces cur.execute(query.sql, params) for the
+read routes. The first time a pooled connection runs a query, it is PREPAREd under a
+name derived from its SQL (the same id /metrics labels it with); after that the
+connection only sends EXECUTE name (params), so Postgres skips parsing and analysis and,
+once it settles on a generic plan, planning too. The pool's reset keeps prepared
+statements (see ConnectionPool._reset), so they last as long as the connection.
+
+Postgres re-plans a prepared statement by itself after DDL on the tables it reads. If
+the change alters the statement's result columns ("cached plan must not change result
+type"), or the statement has gone missing from the session, it is prepared again and
+run once more, as long as it was the first statement of its transaction (so rolling
+back loses nothing). A query Postgres can't prepare (e.g. a parameter whose type it
+can't infer) is run as plain text from then on.
+
+Set PREPARE_STATEMENTS=false to send plain text only, e.g. behind PgBouncer in
+transaction pooling mode, where a session's prepared statements aren't guaranteed to
+be on the next transaction's server connection.
+"""
+import hashlib
+import os
+import re
+import threading
+import weakref
+
+import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+
+# Errors after which the statement is prepared again and retried
+REPREPARE_CODES = (psycopg2.errorcodes.FEATURE_NOT_SUPPORTED,  # cached plan must not change result type
+                   psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME)  # prepared statement does not exist
+# Errors PREPARE raises for SQL that only works with the parameters written in
+UNPREPARABLE_CODES = (psycopg2.errorcodes.INDETERMINATE_DATATYPE, psycopg2.errorcodes.AMBIGUOUS_PARAMETER)
+
+_lock = threading.Lock()
+# SQL -> statement name
+_names = {}
+# SQL of the queries Postgres refused to prepare
+_unpreparable = set()
+# statement name -> the types Postgres inferred for its parameters
+_parameter_types = {}
+# connection -> names prepared on it
+_prepared = weakref.WeakKeyDictionary()
+
+
+def enabled():
+    return os.getenv("PREPARE_STATEMENTS", "true").lower() in ("true", "1", "yes")
+
+
+def statement_name(sql):
+    """Name of the prepared statement for `sql`, the same on every connection and worker."""
+    name = _names.get(sql)
+    if name is None:
+        normalized = re.sub(r'\s+', ' ', sql).strip()
+        name = _names.setdefault(sql, 'q_' + hashlib.sha1(normalized.encode()).hexdigest()[:12])
+    return name
+
+
+def prepared_on(conn):
+    """The set of statement names prepared on `conn`."""
+    names = _prepared.get(conn)
+    if names is None:
+        with _lock:
+            names = _prepared.setdefault(conn, set())
+    return names
+
+
+def _prepare(cur, name, query, refresh=False):
+    cur.execute(f'PREPARE {name} AS {query.async_sql}')
+    if refresh or name not in _parameter_types:
+        cur.execute('SELECT parameter_types::TEXT[] FROM pg_prepared_statements WHERE name = %s', (name,))
+        _parameter_types[name] = cur.fetchone()[0]
+
+
+def _execute_prepared(cur, name, params):
+    if params:
+        # Cast like the statement's parameters, since psycopg2 writes e.g. ['1'] as a TEXT[] literal
+        arguments = ', '.join(f'%s::{parameter_type}' for parameter_type in _parameter_types[name])
+        cur.execute(f'EXECUTE {name} ({arguments})', params)
+    else:
+        cur.execute(f'EXECUTE {name}')
+
+
+def execute(cur, query, params=None):
+    """Runs queries.Query `query` with `params` on `cur`, through a prepared statement."""
+    if not enabled() or query.sql in _unpreparable:
+        cur.execute(query.sql, params)
+        return
+    conn = cur.connection
+    name = statement_name(query.sql)
+    prepared = prepared_on(conn)
+    # First statement of its transaction, so a failure can be rolled back and retried
+    fresh = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    try:
+        if name not in prepared:
+            try:
+                _prepare(cur, name, query)
+            except psycopg2.Error as e:
+                if not fresh or e.pgcode not in UNPREPARABLE_CODES:
+                    raise
+                conn.rollback()
+                with _lock:
+                    _unpreparable.add(query.sql)
+                cur.execute(query.sql, params)
+                return
+            prepared.add(name)
+        _execute_prepared(cur, name, params)
+    except psycopg2.Error as e:
+        if not fresh or e.pgcode not in REPREPARE_CODES:
+            raise
+        conn.rollback()
+        if e.pgcode != psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME:
+            cur.execute(f'DEALLOCATE {name}')
+        _prepare(cur, name, query, refresh=True)
+        _execute_prepared(cur, name, params)
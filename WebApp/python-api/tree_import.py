@@ -0,0 +1,236 @@
+"""Bulk import of a nursery feed into the trees catalog.
+
+A feed is a CSV file whose header names trees columns. scientific_name is required
+and identifies the tree; every other column is optional:
+
+    scientific_name,common_name,height_range,width_range,drought_tolerance,inventory
+    Quercus boissieri,Aleppo oak,30-40,30-50,high,20
+
+Ranges are written low-high, booleans true/false (or yes/no, t/f, 1/0), and
+visual_attraction entries are separated by "|". A blank cell leaves the tree's current
+value alone, so a feed of just scientific_name,inventory restocks the catalog.
+
+The file is loaded with COPY into a temporary staging table, checked there with a few
+set-based UPDATEs, and the valid rows are upserted into trees with one INSERT ... ON
+CONFLICT, all in one transaction. Invalid rows are left out and reported with their
+line numbers and reasons.
+"""
+import csv
+
+import psycopg2
+
+# Rejections listed in the result; the count covers all of them
+MAX_REPORTED_REJECTIONS = 500
+
+# trees column -> (kind, argument): text (max length), integer, boolean, enum (type), range, array (max length)
+COLUMNS = {
+    'scientific_name': ('text', 100),
+    'common_name': ('text', 100),
+    'height_range': ('range', None),
+    'width_range': ('range', None),
+    'minimum_planting_bed_width': ('integer', None),
+    'plantable_under_power_lines': ('boolean', None),
+    'native_to_ca': ('boolean', None),
+    'drought_tolerance': ('enum', 'tolerance'),
+    'growth_rate': ('enum', 'rate'),
+    'foliage_type': ('enum', 'foliage'),
+    'debris': ('text', 50),
+    'root_damage_potential': ('enum', 'root_damage'),
+    'nursery_availability': ('enum', 'nursery_availability'),
+    'visual_attraction': ('array', 50),
+    'pzharshsites': ('boolean', None),
+    'pzbay': ('boolean', None),
+    'pzurbanized': ('boolean', None),
+    'pznearnaturalareas': ('boolean', None),
+    'inventory': ('integer', None),
+}
+RANGE_PATTERN = r'^\d{1,9}\s*-\s*\d{1,9}$'
+TRUE_VALUES = ('true', 't', 'yes', 'y', '1')
+FALSE_VALUES = ('false', 'f', 'no', 'n', '0')
+
+
+class FeedError(ValueError):
+    """Raised for a feed that can't be loaded at all: a bad header or malformed CSV."""
+
+
+def _value(column):
+    return f"NULLIF(TRIM({column}), '')"
+
+
+def _check(column):
+    """SQL that is true when the non-blank `column` of a staged row is valid."""
+    kind, arg = COLUMNS[column]
+    value = _value(column)
+    if kind == 'text':
+        return f'LENGTH({value}) <= {arg}'
+    if kind == 'integer':
+        return rf"{value} ~ '^\d{{1,9}}$'"
+    if kind == 'boolean':
+        return f"LOWER({value}) IN {TRUE_VALUES + FALSE_VALUES}"
+    if kind == 'enum':
+        return f'LOWER({value}) = ANY (enum_range(NULL::{arg})::TEXT[])'
+    if kind == 'range':
+        # CASE so the bounds are only cast once the pattern has matched
+        return (f"CASE WHEN {value} ~ '{RANGE_PATTERN}' "
+                f"THEN SPLIT_PART({value}, '-', 1)::INTEGER <= SPLIT_PART({value}, '-', 2)::INTEGER "
+                f"ELSE FALSE END")
+    return f"NOT EXISTS (SELECT FROM UNNEST(STRING_TO_ARRAY({value}, '|')) e WHERE LENGTH(TRIM(e)) > {arg})"
+
+
+def _expected(column):
+    kind, arg = COLUMNS[column]
+    return {
+        'text': f'at most {arg} characters',
+        'integer': 'a whole number',
+        'boolean': 'true or false',
+        'enum': f'one of the {arg} values',
+        'range': 'a range like 30-40',
+        'array': f'entries separated by | of at most {arg} characters each',
+    }[kind]
+
+
+def _cast(column):
+    """SQL for the trees value of a valid staged `column`, NULL when blank."""
+    kind, arg = COLUMNS[column]
+    value = _value(column)
+    if kind == 'integer':
+        return f'{value}::INTEGER'
+    if kind == 'boolean':
+        return f'LOWER({value}) IN {TRUE_VALUES}'
+    if kind == 'enum':
+        return f'LOWER({value})::{arg}'
+    if kind == 'range':
+        # INT4RANGE(NULL, NULL) is unbounded rather than NULL, so a blank cell needs the CASE
+        return (f"CASE WHEN {value} IS NOT NULL "
+                f"THEN INT4RANGE(SPLIT_PART({value}, '-', 1)::INTEGER, SPLIT_PART({value}, '-', 2)::INTEGER) END")
+    if kind == 'array':
+        return (f"(SELECT ARRAY_AGG(TRIM(e)) FROM UNNEST(STRING_TO_ARRAY({value}, '|')) e "
+                f"WHERE TRIM(e) <> '')::VARCHAR(50)[]")
+    return value
+
+
+class _Rewound:
+    """`stream` with `head`, already read off it, put back in front."""
+
+    def __init__(self, head, stream):
+        self._head = head
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._head:
+            return self._stream.read(size)
+        data, self._head = self._head, b''
+        return data
+
+    def readline(self, size=-1):
+        if not self._head:
+            return self._stream.readline(size)
+        data, self._head = self._head, b''
+        return data
+
+
+def read_header(line):
+    """The trees columns named by the header `line`."""
+    try:
+        header = next(csv.reader([line.decode('utf-8-sig')]), [])
+    except UnicodeDecodeError as e:
+        raise FeedError("The feed must be UTF-8 encoded") from e
+    columns = [name.strip().lower() for name in header]
+    unknown = [name for name in columns if name not in COLUMNS]
+    if unknown:
+        raise FeedError(f"Unknown columns: {', '.join(unknown)}. Columns are: {', '.join(COLUMNS)}")
+    if len(set(columns)) != len(columns):
+        raise FeedError("A column is named twice in the header")
+    if 'scientific_name' not in columns:
+        raise FeedError("The feed needs a scientific_name column")
+    return columns
+
+
+def import_trees(conn, stream, dry_run=False):
+    """Upserts the nursery feed on binary `stream` into trees and commits (or rolls back
+    for a dry run). Returns the counts and the rejected rows."""
+    head = stream.readline()
+    columns = read_header(head)
+    with conn.cursor() as cur:
+        staged = ', '.join(f'{column} TEXT' for column in columns)
+        # Lines are numbered as in the file, the header being line 1
+        cur.execute(f'''
+            CREATE TEMPORARY TABLE tree_import
+            (
+                line   INTEGER GENERATED ALWAYS AS IDENTITY (START WITH 2),
+                {staged},
+                errors TEXT[] NOT NULL DEFAULT '{{}}'
+            ) ON COMMIT DROP;
+        ''')
+        try:
+            # HEADER skips the line read above, so COPY's error messages number lines as in the file
+            cur.copy_expert(f"COPY tree_import ({', '.join(columns)}) FROM STDIN "
+                            f"WITH (FORMAT csv, HEADER, ENCODING 'UTF8')", _Rewound(head, stream))
+        except psycopg2.Error as e:
+            conn.rollback()
+            raise FeedError(f"The feed could not be read: {str(e).strip()}") from e
+
+        checks = [f"CASE WHEN {_value(column)} IS NOT NULL AND NOT ({_check(column)}) "
+                  f"THEN '{column} must be {_expected(column)}' END" for column in columns]
+        checks.append(f"CASE WHEN {_value('scientific_name')} IS NULL THEN 'scientific_name is required' END")
+        cur.execute(f'UPDATE tree_import SET errors = ARRAY_REMOVE(ARRAY [{", ".join(checks)}], NULL);')
+        for column in ('scientific_name', 'common_name'):
+            if column in columns:
+                cur.execute(f'''
+                    UPDATE tree_import i
+                    SET errors = i.errors || ('{column} is repeated from line ' || earliest.line)
+                    FROM (SELECT {_value(column)} AS value, MIN(line) AS line
+                          FROM tree_import
+                          GROUP BY 1) earliest
+                    WHERE {_value(f'i.{column}')} = earliest.value
+                      AND i.line > earliest.line;
+                ''')
+        if 'common_name' in columns:
+            cur.execute(f'''
+                UPDATE tree_import i
+                SET errors = i.errors || ('common_name belongs to ' || t.scientific_name)
+                FROM trees t
+                WHERE t.common_name = {_value('i.common_name')}
+                  AND t.scientific_name <> {_value('i.scientific_name')};
+            ''')
+
+        # A blank cell keeps the current value of an existing tree
+        updates = [column for column in columns if column != 'scientific_name']
+        conflict = 'DO NOTHING'
+        if updates:
+            conflict = f'''DO UPDATE SET {', '.join(f'{column} = COALESCE(EXCLUDED.{column}, trees.{column})'
+                                                    for column in updates)}
+                WHERE ({', '.join(f'trees.{column}' for column in updates)}) IS DISTINCT FROM
+                      ({', '.join(f'COALESCE(EXCLUDED.{column}, trees.{column})' for column in updates)})'''
+        cur.execute(f'''
+            WITH upserted AS (
+                INSERT INTO trees ({', '.join(columns)})
+                    SELECT {', '.join(_cast(column) for column in columns)}
+                    FROM tree_import
+                    WHERE errors = '{{}}'
+                    ORDER BY line
+                    ON CONFLICT (scientific_name) {conflict}
+                    RETURNING xmax = 0 AS inserted)
+            SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM upserted;
+        ''')
+        inserted, updated = cur.fetchone()
+        cur.execute('''
+            SELECT COUNT(*) FILTER (WHERE errors = '{}'), COUNT(*) FILTER (WHERE errors <> '{}')
+            FROM tree_import;
+        ''')
+        valid, rejected = cur.fetchone()
+        cur.execute(f'''
+            SELECT line, {_value('scientific_name')}, errors
+            FROM tree_import
+            WHERE errors <> '{{}}'
+            ORDER BY line
+            LIMIT %s;
+        ''', (MAX_REPORTED_REJECTIONS,))
+        rejections = [{'line': line, 'scientific_name': scientific_name, 'errors': errors}
+                      for line, scientific_name, errors in cur.fetchall()]
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    return {'inserted': inserted, 'updated': updated, 'unchanged': valid - inserted - updated,
+            'rejected': rejected, 'rejections': rejections, 'dry_run': dry_run}
@@ -1,6 +1,12 @@
-import type { Handle } from '@sveltejs/kit';
+import type { Handle, HandleFetch } from '@sveltejs/kit';
 import jwt from 'jsonwebtoken';
 import { JWT_SECRET } from '$env/static/private'; // Import the secret
+import { API_ROUTE } from '$lib/constants';
+
+// After a write the API answers with X-Primary-Until; until then, this browser's requests
+// are read from the primary database rather than a replica that may not have the write yet
+const PRIMARY_UNTIL_HEADER = 'X-Primary-Until';
+const PRIMARY_UNTIL_COOKIE = 'api_primary_until';
 
 export const handle: Handle = async ({ event, resolve }) => {
 	const token = event.cookies.get('auth_token');
@@ -23,6 +29,30 @@ export const handle: Handle = async ({ event, resolve }) => {
 	return response;
 };
 
+export const handleFetch: HandleFetch = async ({ event, request, fetch }) => {
+	if (!request.url.startsWith(API_ROUTE)) {
+		return fetch(request);
+	}
+	const primaryUntil = event.cookies.get(PRIMARY_UNTIL_COOKIE);
+	if (primaryUntil) {
+		request.headers.set(PRIMARY_UNTIL_HEADER, primaryUntil);
+	}
+	const response = await fetch(request);
+	const pinnedUntil = response.headers.get(PRIMARY_UNTIL_HEADER);
+	if (pinnedUntil) {
+		const seconds = Math.ceil(Number(pinnedUntil) - Date.now() / 1000);
+		if (seconds > 0) {
+			event.cookies.set(PRIMARY_UNTIL_COOKIE, pinnedUntil, {
+				path: '/',
+				httpOnly: true,
+				sameSite: 'strict',
+				maxAge: seconds
+			});
+		}
+	}
+	return response;
+};
+
 function verifyAuthToken(token: string): App.Locals['user'] | null {
 	try {
 		const decoded = jwt.verify(token, JWT_SECRET);
@@ -1,6 +1,5 @@
 import jwt from 'jsonwebtoken';
 import { JWT_SECRET } from '$env/static/private';
-import argon2 from 'argon2';
 import type { Cookies } from '@sveltejs/kit';
 
 export const signJWT = (payload: object, cookies: Cookies) => {
@@ -16,17 +15,3 @@ export const signJWT = (payload: object, cookies: Cookies) => {
 		sameSite: 'lax'
 	});
 };
-
-export const hashPassword = async (password: string) => {
-	if (process.env.HASH_PASSWORDS) {
-		return await argon2.hash(password);
-	}
-	return password;
-};
-
-export const verifyPassword = async (password: string, hashedPassword: string) => {
-	if (process.env.HASH_PASSWORDS) {
-		return await argon2.verify(password, hashedPassword);
-	}
-	return password == hashedPassword;
-};
@@ -9,7 +9,7 @@ const schema = z.object({
 	requestId: z.coerce.number().int().positive()
 });
 
-export const load: PageServerLoad = async ({ locals, fetch }) => {
+export const load: PageServerLoad = async ({ locals, fetch, url }) => {
 	if (!locals.user) {
 		throw redirect(302, '/login');
 	}
@@ -29,8 +29,21 @@ export const load: PageServerLoad = async ({ locals, fetch }) => {
 		throw redirect(302, '/dashboard');
 	}
 
-	// Fetch all tree requests
-	const apiUrlTreeRequests = `${API_ROUTE}/all-tree-requests`;
+	// Fetch a page of tree requests, passing the cursor and any filters through to the API
+	const params = new URLSearchParams();
+	const passthrough = [
+		'cursor',
+		'status',
+		'neighborhood',
+		'tree_id',
+		'submitted_after',
+		'submitted_before'
+	];
+	for (const key of passthrough) {
+		const value = url.searchParams.get(key);
+		if (value) params.set(key, value);
+	}
+	const apiUrlTreeRequests = `${API_ROUTE}/all-tree-requests?${params}`;
 	const responseTreeRequests = await fetch(apiUrlTreeRequests);
 	if (!responseTreeRequests.ok) {
 		const errorBody = await responseTreeRequests.text();
@@ -42,11 +55,20 @@ export const load: PageServerLoad = async ({ locals, fetch }) => {
 	const tree_requests = await responseTreeRequests.json();
 	console.log('Successfully fetched tree requests:', tree_requests);
 
+	// Link to the next page keeps the current filters
+	let nextPage: string | null = null;
+	const nextCursor = responseTreeRequests.headers.get('X-Next-Cursor');
+	if (nextCursor) {
+		params.set('cursor', nextCursor);
+		nextPage = `?${params}`;
+	}
+
 	const form = await superValidate(zod(schema));
 
 	return {
 		user: locals.user,
 		treeRequests: tree_requests,
+		nextPage,
 		form
 	};
 };
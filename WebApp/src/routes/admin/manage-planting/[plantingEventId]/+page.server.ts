@@ -19,6 +19,23 @@ const recordOutcomeSchema = z.object({
 	attended_volunteer_ids: z.array(z.coerce.number().int().positive()).optional().default([])
 });
 
+// Applies crew changes with one call to the batch endpoint. Returns why it failed, or null.
+async function updateCrew(fetch: typeof globalThis.fetch, body: Record<string, unknown>) {
+	const response = await fetch(`${API_ROUTE}/planting-crew`, {
+		method: 'POST',
+		headers: { 'Content-Type': 'application/json' },
+		body: JSON.stringify(body)
+	});
+	if (!response.ok) {
+		return await response.text();
+	}
+	const { conflicts } = await response.json();
+	if (conflicts.length > 0) {
+		return conflicts.map((c: { id: number; reason: string }) => `${c.id} ${c.reason}`).join(', ');
+	}
+	return null;
+}
+
 export const load: PageServerLoad = async ({ locals, fetch, params }) => {
 	if (!locals.user) {
 		throw redirect(302, '/login');
@@ -84,20 +101,12 @@ export const actions: Actions = {
 		if (!form.valid) return fail(400, { form });
 		if (!plantingEventId) return message(form, 'Missing planting event ID.', { status: 400 });
 
-		const apiUrl = `${API_ROUTE}/add-volunteer-to-planting`;
-		const response = await fetch(apiUrl, {
-			method: 'POST',
-			headers: { 'Content-Type': 'application/json' },
-			body: JSON.stringify({
-				planting_event_id: parseInt(plantingEventId),
-				volunteer_id: form.data.volunteerId
-			})
+		const failure = await updateCrew(fetch, {
+			scheduled_planting_id: parseInt(plantingEventId),
+			add_volunteer_ids: [form.data.volunteerId]
 		});
-		if (!response.ok) {
-			const errorBody = await response.text();
-			return message(form, `Failed to assign volunteer: ${errorBody}`, {
-				status: 500
-			});
+		if (failure) {
+			return message(form, `Failed to assign volunteer: ${failure}`, { status: 500 });
 		}
 		return message(form, 'Volunteer assigned successfully!');
 	},
@@ -111,20 +120,12 @@ export const actions: Actions = {
 		if (!form.valid) return fail(400, { form });
 		if (!plantingEventId) return message(form, 'Missing planting event ID.', { status: 400 });
 
-		const apiUrl = `${API_ROUTE}/add-org-member-to-planting`;
-		const response = await fetch(apiUrl, {
-			method: 'POST',
-			headers: { 'Content-Type': 'application/json' },
-			body: JSON.stringify({
-				scheduled_planting_id: parseInt(plantingEventId),
-				organization_member_id: form.data.orgMemberId
-			})
+		const failure = await updateCrew(fetch, {
+			scheduled_planting_id: parseInt(plantingEventId),
+			add_org_member_ids: [form.data.orgMemberId]
 		});
-		if (!response.ok) {
-			const errorBody = await response.text();
-			return message(form, `Failed to assign org member: ${errorBody}`, {
-				status: 500
-			});
+		if (failure) {
+			return message(form, `Failed to assign org member: ${failure}`, { status: 500 });
 		}
 		return message(form, 'Organization member assigned successfully!');
 	},
@@ -157,14 +158,16 @@ export const actions: Actions = {
 		}
 		const eventIdNum = parseInt(plantingEventId);
 
-		const outcomeApiUrl = `${API_ROUTE}/new-planting-event`;
+		// Outcome, attendance and the inventory change are recorded together, or not at all
+		const outcomeApiUrl = `${API_ROUTE}/planting-outcome`;
 		const outcomeResponse = await fetch(outcomeApiUrl, {
 			method: 'POST',
 			headers: { 'Content-Type': 'application/json' },
 			body: JSON.stringify({
 				scheduled_planting_id: eventIdNum,
 				successful: form.data.successful,
-				observations: form.data.observations
+				observations: form.data.observations,
+				attended_volunteer_ids: form.data.attended_volunteer_ids || []
 			})
 		});
 
@@ -176,29 +179,9 @@ export const actions: Actions = {
 			let errorMessage = `Failed to record planting outcome. Server responded: ${outcomeResponse.statusText}`;
 			errorMessage = JSON.parse(errorBody).error || errorMessage;
 
-			return message(form, errorMessage, { status: 500 });
+			return message(form, errorMessage, { status: outcomeResponse.status });
 		}
 
-		const attendedVolunteerIds = form.data.attended_volunteer_ids || [];
-		const volunteerAttendApiUrl = `${API_ROUTE}/add-volunteer-to-planting-event`;
-
-		const volunteerPromises = attendedVolunteerIds.map((volunteerId) =>
-			fetch(volunteerAttendApiUrl, {
-				method: 'POST',
-				headers: { 'Content-Type': 'application/json' },
-				body: JSON.stringify({
-					planting_event_id: eventIdNum,
-					volunteer_id: volunteerId
-				})
-			}).then((res) => {
-				if (!res.ok) {
-					console.error(`Failed to record attendance for volunteer ${volunteerId}: ${res.status}`);
-				}
-				return res.ok;
-			})
-		);
-
-		await Promise.all(volunteerPromises);
 		const detailsRes = await fetch(`${API_ROUTE}/scheduled-planting-details/${eventIdNum}`);
 		if (detailsRes.ok) {
 			const details = await detailsRes.json();
@@ -186,6 +186,39 @@ export const load: PageServerLoad = async ({ locals, fetch }) => {
 	return { form, queryTasks, neighborhoods, commonNames };
 };
 
+// Reports run as background jobs on the API, so a long one doesn't hold this request's fetch
+// open until it times out: the job is submitted, long-polled until it finishes, then downloaded
+const REPORT_JOB_WAIT_SECONDS = 25;
+const REPORT_JOB_MAX_POLLS = 24;
+
+async function runReportJob(
+	fetch: typeof globalThis.fetch,
+	endpoint: string,
+	queryString: string
+): Promise<Response> {
+	const submitted = await fetch(
+		`${API_ROUTE}/report-jobs${endpoint}${queryString ? `?${queryString}` : ''}`,
+		{ method: 'POST' }
+	);
+	if (!submitted.ok) {
+		return submitted;
+	}
+	let job = await submitted.json();
+	for (let polls = 0; job.status === 'queued' || job.status === 'running'; polls++) {
+		if (polls >= REPORT_JOB_MAX_POLLS) {
+			throw new Error('The report is taking too long, try again later.');
+		}
+		const status = await fetch(
+			`${API_ROUTE}/report-jobs/${job.id}?wait=${REPORT_JOB_WAIT_SECONDS}`
+		);
+		if (!status.ok) {
+			return status;
+		}
+		job = await status.json();
+	}
+	return fetch(`${API_ROUTE}/report-jobs/${job.id}/result`);
+}
+
 export const actions: Actions = {
 	runQuery: async ({ request, fetch }) => {
 		const form = await superValidate(request, zod(queryFormSchema));
@@ -204,7 +237,6 @@ export const actions: Actions = {
 		let headers: string[] = [];
 		let apiError: string | null = null;
 
-		let apiUrl = `${API_ROUTE}${selectedTask.endpoint}`;
 		const queryParams = new URLSearchParams();
 
 		if (selectedTask.parameter) {
@@ -220,11 +252,7 @@ export const actions: Actions = {
 			queryParams.set('max_width', String(form.data.max_width));
 		}
 
-		const queryString = queryParams.toString();
-		if (queryString) {
-			apiUrl += `?${queryString}`;
-		}
-		const response = await fetch(apiUrl);
+		const response = await runReportJob(fetch, selectedTask.endpoint, queryParams.toString());
 
 		if (!response.ok) {
 			let errorText = `API Error ${response.status}: ${response.statusText}`;
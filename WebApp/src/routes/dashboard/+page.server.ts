@@ -8,13 +8,17 @@ interface ApiTreeRequest {
 	approved: boolean;
 }
 
-export const load: PageServerLoad = async ({ locals, fetch }) => {
+export const load: PageServerLoad = async ({ locals, fetch, url }) => {
 	if (!locals.user) {
 		throw redirect(302, '/login');
 	}
 	// Fetch all tree requests based on user id
 	let treeRequests: ApiTreeRequest[] = [];
-	const apiUrl = `${API_ROUTE}/tree-requests?resident_id=${encodeURIComponent(locals.user.id)}`;
+	let apiUrl = `${API_ROUTE}/tree-requests?resident_id=${encodeURIComponent(locals.user.id)}`;
+	const cursor = url.searchParams.get('cursor');
+	if (cursor) {
+		apiUrl += `&cursor=${encodeURIComponent(cursor)}`;
+	}
 	const response = await fetch(apiUrl);
 
 	if (!response.ok) {
@@ -27,9 +31,11 @@ export const load: PageServerLoad = async ({ locals, fetch }) => {
 
 	treeRequests = await response.json();
 	console.log('Successfully fetched tree requests:', treeRequests);
+	const nextCursor = response.headers.get('X-Next-Cursor');
 	return {
 		user: locals.user,
-		treeRequests: treeRequests
+		treeRequests: treeRequests,
+		nextPage: nextCursor ? `?cursor=${encodeURIComponent(nextCursor)}` : null
 	};
 };
 
@@ -3,12 +3,11 @@ import { message, superValidate } from 'sveltekit-superforms/server';
 import { fail, redirect } from '@sveltejs/kit';
 import type { Actions, PageServerLoad } from './$types';
 import { zod } from 'sveltekit-superforms/adapters';
-import { signJWT, verifyPassword } from '$lib/utils';
+import { signJWT } from '$lib/utils';
 import { API_ROUTE } from '$lib/constants';
 
 interface APIUser {
 	id: number;
-	password: string;
 	first_name: string;
 	last_name: string;
 	is_volunteer: boolean;
@@ -38,23 +37,32 @@ export const actions: Actions = {
 		}
 
 		const apiUrl = `${API_ROUTE}/login`;
-		// This will return the hashed password. We compare here.
+		// The API checks the password and only returns the user if it matches
 		const response = await fetch(apiUrl, {
 			method: 'POST',
 			headers: {
 				'Content-Type': 'application/json'
 			},
 			body: JSON.stringify({
-				email: form.data.email
+				email: form.data.email,
+				password: form.data.password
 			})
 		});
 
-		if (response.status === 404) {
+		if (response.status === 401) {
+			console.error('Invalid login attempt for email:', form.data.email);
+			// Return same error message because this is more secure :) (they don't know that this is a valid email)
 			return message(form, 'Invalid email or password.', {
 				status: 401
 			});
 		}
 
+		if (response.status === 503) {
+			return message(form, 'Too many sign-ins right now. Please try again in a moment.', {
+				status: 503
+			});
+		}
+
 		if (!response.ok) {
 			const errorBody = await response.text();
 			console.error(`API Error (${response.status}): ${errorBody}`);
@@ -64,14 +72,6 @@ export const actions: Actions = {
 		}
 		const user: APIUser = await response.json();
 
-		const validPassword = user && (await verifyPassword(user.password, form.data.password));
-		if (!validPassword) {
-			console.error('Invalid login attempt for email:', form.data.email);
-			// Return same error message because this is more secure :) (they don't know that this is a valid email)
-			return message(form, 'Invalid email or password.', {
-				status: 401
-			});
-		}
 		// Credentials are correct, generate JWT
 		const payload = {
 			userId: user.id,
@@ -49,7 +49,7 @@ export const load: PageServerLoad = async ({ locals }) => {
 };
 
 export const actions: Actions = {
-	default: async ({ request, locals }) => {
+	default: async ({ request, locals, fetch }) => {
 		if (!locals.user) {
 			return fail(401, { message: 'Authentication required.' });
 		}
@@ -2,7 +2,7 @@ import { error, fail, redirect } from '@sveltejs/kit';
 import { superValidate, message } from 'sveltekit-superforms';
 import { zod } from 'sveltekit-superforms/adapters';
 import { z } from 'zod';
-import { hashPassword, signJWT } from '$lib/utils';
+import { signJWT } from '$lib/utils';
 import { API_ROUTE } from '$lib/constants';
 
 const POSTGRESQL_UNIQUE_VIOLATION = '23505';
@@ -42,8 +42,7 @@ export const actions = {
 			return fail(400, { form });
 		}
 
-		const hashedPassword = await hashPassword(form.data.password);
-		// Register the user in the database
+		// Register the user in the database. The API hashes the password.
 		const apiUrl = `${API_ROUTE}/register`;
 		const response = await fetch(apiUrl, {
 			method: 'POST',
@@ -52,7 +51,7 @@ export const actions = {
 			},
 			body: JSON.stringify({
 				email: form.data.email,
-				password: hashedPassword,
+				password: form.data.password,
 				first_name: form.data.firstName,
 				last_name: form.data.lastName,
 				street: form.data.street,
@@ -60,6 +59,11 @@ export const actions = {
 				neighborhood: form.data.neighborhood
 			})
 		});
+		if (response.status === 503) {
+			return message(form, 'Too many sign-ins right now. Please try again in a moment.', {
+				status: 503
+			});
+		}
 		if (!response.ok) {
 			const errorData = await response.json();
 			if (errorData && errorData.error === POSTGRESQL_UNIQUE_VIOLATION) {
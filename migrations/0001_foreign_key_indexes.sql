@@ -0,0 +1,39 @@
+-- migrate: no-transaction
+-- Indexes for the foreign keys and lookups that were sequential scans. Built concurrently so
+-- they can be added to a live database without blocking writes.
+
+-- The tree request listings page newest first on (submission_timestamp, id), so each filter
+-- they accept has an index ending in those columns. These also cover tree_requests.resident_id
+-- and residents.neighborhood. Databases created from the current ddl.sql already have them.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tree_requests_submitted_idx ON tree_requests (submission_timestamp, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tree_requests_resident_submitted_idx
+    ON tree_requests (resident_id, submission_timestamp, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tree_requests_tree_submitted_idx
+    ON tree_requests (tree_id, submission_timestamp, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS residents_neighborhood_idx ON residents (neighborhood);
+
+-- Visits and plantings of a tree request: status evaluation, admin details, reports.
+-- Indexes are not inherited, so each table of scheduled_events needs its own.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS scheduled_events_tree_request_idx ON scheduled_events (tree_request_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS scheduled_visits_tree_request_idx
+    ON scheduled_visits (tree_request_id, event_timestamp);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS scheduled_plantings_tree_request_idx
+    ON scheduled_plantings (tree_request_id, event_timestamp);
+
+-- Permits are keyed (resident_id, tree_request_id) but looked up by tree request
+CREATE INDEX CONCURRENTLY IF NOT EXISTS permits_tree_request_idx ON permits (tree_request_id);
+
+-- The reverse side of the junction tables, for "which plantings is this person on"
+-- and for the ON DELETE CASCADE from residents
+CREATE INDEX CONCURRENTLY IF NOT EXISTS scheduled_visits_organization_member_idx
+    ON scheduled_visits (organization_member_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS org_members_lead_plantings_planting_idx
+    ON organization_members_lead_scheduled_plantings (scheduled_planting_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS scheduled_plantings_volunteers_volunteer_idx
+    ON scheduled_plantings_have_volunteers (volunteer_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS planting_events_volunteers_volunteer_idx
+    ON planting_events_have_volunteers (volunteer_id);
+
+-- /api/available-volunteers lists volunteers by name
+CREATE INDEX CONCURRENTLY IF NOT EXISTS residents_volunteer_name_idx
+    ON residents (last_name, first_name) WHERE is_volunteer;
@@ -0,0 +1,400 @@
+-- The stored tree request status and the neighborhood report rollup, for databases created
+-- from ddl.sql before they were added to it. On a database created from the current ddl.sql
+-- this changes nothing but refilling both.
+--
+-- Adding the column and filling it rewrites tree_requests under a lock anyway, so its index
+-- is built in the same transaction rather than concurrently. The listing indexes are in 0001.
+
+-- Stored tree request status
+-- tree_requests.status caches get_tree_request_status(id) so listings and reports can read and filter
+-- on it directly. The triggers below refresh it whenever a table the status depends on changes.
+ALTER TABLE tree_requests ADD COLUMN IF NOT EXISTS status TEXT;
+CREATE INDEX IF NOT EXISTS tree_requests_status_idx ON tree_requests (status, submission_timestamp, id);
+
+CREATE OR REPLACE FUNCTION refresh_tree_request_status(p_tree_request_id INTEGER)
+    RETURNS VOID
+AS
+$$
+BEGIN
+    UPDATE tree_requests tr
+    SET status = s.status
+    FROM (SELECT get_tree_request_status(p_tree_request_id) AS status) s
+    WHERE tr.id = p_tree_request_id
+      AND tr.status IS DISTINCT FROM s.status;
+END;
+$$ LANGUAGE plpgsql;
+
+-- https://www.postgresql.org/docs/current/plpgsql-trigger.html
+CREATE OR REPLACE FUNCTION tree_request_status_trigger()
+    RETURNS TRIGGER
+AS
+$$
+DECLARE
+    v_old_id INTEGER;
+    v_new_id INTEGER;
+BEGIN
+    IF TG_TABLE_NAME = 'tree_requests' THEN
+        v_new_id := NEW.id;
+    ELSIF TG_TABLE_NAME = 'visit_events' THEN
+        IF TG_OP <> 'INSERT' THEN
+            SELECT tree_request_id INTO v_old_id FROM scheduled_visits WHERE event_id = OLD.scheduled_visit_id;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            SELECT tree_request_id INTO v_new_id FROM scheduled_visits WHERE event_id = NEW.scheduled_visit_id;
+        END IF;
+    ELSIF TG_TABLE_NAME = 'planting_events' THEN
+        IF TG_OP <> 'INSERT' THEN
+            SELECT tree_request_id INTO v_old_id FROM scheduled_plantings WHERE event_id = OLD.scheduled_planting_id;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            SELECT tree_request_id INTO v_new_id FROM scheduled_plantings WHERE event_id = NEW.scheduled_planting_id;
+        END IF;
+    ELSE
+        -- permits, scheduled_visits and scheduled_plantings all carry tree_request_id
+        IF TG_OP <> 'INSERT' THEN
+            v_old_id := OLD.tree_request_id;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            v_new_id := NEW.tree_request_id;
+        END IF;
+    END IF;
+
+    IF v_old_id IS NOT NULL AND v_old_id IS DISTINCT FROM v_new_id THEN
+        PERFORM refresh_tree_request_status(v_old_id);
+    END IF;
+    IF v_new_id IS NOT NULL THEN
+        PERFORM refresh_tree_request_status(v_new_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER tree_requests_status
+    AFTER INSERT OR UPDATE OF approved
+    ON tree_requests
+    FOR EACH ROW
+EXECUTE FUNCTION tree_request_status_trigger();
+
+CREATE OR REPLACE TRIGGER permits_status
+    AFTER INSERT OR UPDATE OR DELETE
+    ON permits
+    FOR EACH ROW
+EXECUTE FUNCTION tree_request_status_trigger();
+
+CREATE OR REPLACE TRIGGER scheduled_visits_status
+    AFTER INSERT OR UPDATE OF tree_request_id OR DELETE
+    ON scheduled_visits
+    FOR EACH ROW
+EXECUTE FUNCTION tree_request_status_trigger();
+
+CREATE OR REPLACE TRIGGER visit_events_status
+    AFTER INSERT OR UPDATE OR DELETE
+    ON visit_events
+    FOR EACH ROW
+EXECUTE FUNCTION tree_request_status_trigger();
+
+CREATE OR REPLACE TRIGGER scheduled_plantings_status
+    AFTER INSERT OR UPDATE OF tree_request_id OR DELETE
+    ON scheduled_plantings
+    FOR EACH ROW
+EXECUTE FUNCTION tree_request_status_trigger();
+
+CREATE OR REPLACE TRIGGER planting_events_status
+    AFTER INSERT OR UPDATE OR DELETE
+    ON planting_events
+    FOR EACH ROW
+EXECUTE FUNCTION tree_request_status_trigger();
+
+-- Recomputes every stored status, returning how many rows were out of date
+CREATE OR REPLACE FUNCTION rebuild_tree_request_statuses()
+    RETURNS INTEGER
+AS
+$$
+DECLARE
+    v_updated INTEGER;
+BEGIN
+    UPDATE tree_requests tr
+    SET status = s.status
+    FROM (SELECT id, get_tree_request_status(id) AS status FROM tree_requests) s
+    WHERE tr.id = s.id
+      AND tr.status IS DISTINCT FROM s.status;
+    GET DIAGNOSTICS v_updated = ROW_COUNT;
+    RETURN v_updated;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Lists tree requests whose stored status differs from get_tree_request_status()
+CREATE OR REPLACE FUNCTION check_tree_request_statuses()
+    RETURNS TABLE
+            (
+                tree_request_id INTEGER,
+                stored_status   TEXT,
+                computed_status TEXT
+            )
+AS
+$$
+BEGIN
+    RETURN QUERY
+        SELECT s.id, s.status, s.computed
+        FROM (SELECT tr.id, tr.status, get_tree_request_status(tr.id) AS computed FROM tree_requests tr) s
+        WHERE s.status IS DISTINCT FROM s.computed
+        ORDER BY s.id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Neighborhood report rollup
+-- neighborhood_status_counts holds, per neighborhood and stored status, the numbers that
+-- /api/neighborhood-report used to compute by joining tree_requests to itself once per status.
+-- Each tree request's share of the counters is remembered in neighborhood_rollup_contributions,
+-- so a change to one request only has to swap its old share for its new one.
+CREATE TABLE IF NOT EXISTS neighborhood_status_counts
+(
+    neighborhood      VARCHAR(100) NOT NULL,
+    status            TEXT NOT NULL,
+    num_requests      INTEGER NOT NULL DEFAULT 0,
+    num_planted_trees INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (neighborhood, status)
+);
+
+CREATE TABLE IF NOT EXISTS neighborhood_rollup_contributions
+(
+    tree_request_id   INTEGER PRIMARY KEY,
+    neighborhood      VARCHAR(100) NOT NULL,
+    status            TEXT NOT NULL,
+    -- The report counts a request once per scheduled planting (LEFT JOIN fan-out), so do we
+    num_requests      INTEGER NOT NULL,
+    num_planted_trees INTEGER NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION refresh_neighborhood_rollup(p_tree_request_id INTEGER)
+    RETURNS VOID
+AS
+$$
+DECLARE
+    v_old neighborhood_rollup_contributions%ROWTYPE;
+    v_new neighborhood_rollup_contributions%ROWTYPE;
+BEGIN
+    DELETE
+    FROM neighborhood_rollup_contributions
+    WHERE tree_request_id = p_tree_request_id
+    RETURNING * INTO v_old;
+    IF FOUND THEN
+        UPDATE neighborhood_status_counts
+        SET num_requests      = num_requests - v_old.num_requests,
+            num_planted_trees = num_planted_trees - v_old.num_planted_trees
+        WHERE neighborhood = v_old.neighborhood
+          AND status = v_old.status;
+    END IF;
+
+    SELECT tr.id,
+           r.neighborhood,
+           tr.status,
+           GREATEST(COUNT(sp.event_id), 1),
+           COUNT(pe.scheduled_planting_id) FILTER (WHERE pe.successful)
+    INTO v_new
+    FROM tree_requests tr
+             INNER JOIN residents r ON tr.resident_id = r.id
+             LEFT JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
+             LEFT JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+    WHERE tr.id = p_tree_request_id
+      AND tr.status IS NOT NULL
+    GROUP BY tr.id, r.neighborhood, tr.status;
+    IF FOUND THEN
+        INSERT INTO neighborhood_rollup_contributions VALUES (v_new.*);
+        INSERT INTO neighborhood_status_counts (neighborhood, status, num_requests, num_planted_trees)
+        VALUES (v_new.neighborhood, v_new.status, v_new.num_requests, v_new.num_planted_trees)
+        ON CONFLICT (neighborhood, status) DO UPDATE
+            SET num_requests      = neighborhood_status_counts.num_requests + EXCLUDED.num_requests,
+                num_planted_trees = neighborhood_status_counts.num_planted_trees + EXCLUDED.num_planted_trees;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION neighborhood_rollup_trigger()
+    RETURNS TRIGGER
+AS
+$$
+DECLARE
+    v_old_id INTEGER;
+    v_new_id INTEGER;
+    v_id     INTEGER;
+BEGIN
+    IF TG_TABLE_NAME = 'residents' THEN
+        FOR v_id IN SELECT id FROM tree_requests WHERE resident_id = NEW.id
+            LOOP
+                PERFORM refresh_neighborhood_rollup(v_id);
+            END LOOP;
+        RETURN NULL;
+    ELSIF TG_TABLE_NAME = 'tree_requests' THEN
+        IF TG_OP <> 'INSERT' THEN
+            v_old_id := OLD.id;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            v_new_id := NEW.id;
+        END IF;
+    ELSIF TG_TABLE_NAME = 'planting_events' THEN
+        IF TG_OP <> 'INSERT' THEN
+            SELECT tree_request_id INTO v_old_id FROM scheduled_plantings WHERE event_id = OLD.scheduled_planting_id;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            SELECT tree_request_id INTO v_new_id FROM scheduled_plantings WHERE event_id = NEW.scheduled_planting_id;
+        END IF;
+    ELSE
+        -- scheduled_plantings
+        IF TG_OP <> 'INSERT' THEN
+            v_old_id := OLD.tree_request_id;
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            v_new_id := NEW.tree_request_id;
+        END IF;
+    END IF;
+
+    IF v_old_id IS NOT NULL AND v_old_id IS DISTINCT FROM v_new_id THEN
+        PERFORM refresh_neighborhood_rollup(v_old_id);
+    END IF;
+    IF v_new_id IS NOT NULL THEN
+        PERFORM refresh_neighborhood_rollup(v_new_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER residents_neighborhood_rollup
+    AFTER UPDATE OF neighborhood
+    ON residents
+    FOR EACH ROW
+EXECUTE FUNCTION neighborhood_rollup_trigger();
+
+CREATE OR REPLACE TRIGGER tree_requests_neighborhood_rollup
+    AFTER INSERT OR UPDATE OF status, resident_id OR DELETE
+    ON tree_requests
+    FOR EACH ROW
+EXECUTE FUNCTION neighborhood_rollup_trigger();
+
+CREATE OR REPLACE TRIGGER scheduled_plantings_neighborhood_rollup
+    AFTER INSERT OR UPDATE OF tree_request_id OR DELETE
+    ON scheduled_plantings
+    FOR EACH ROW
+EXECUTE FUNCTION neighborhood_rollup_trigger();
+
+CREATE OR REPLACE TRIGGER planting_events_neighborhood_rollup
+    AFTER INSERT OR UPDATE OF scheduled_planting_id, successful OR DELETE
+    ON planting_events
+    FOR EACH ROW
+EXECUTE FUNCTION neighborhood_rollup_trigger();
+
+-- Throws the rollup away and rebuilds it from the stored statuses
+CREATE OR REPLACE FUNCTION rebuild_neighborhood_rollup()
+    RETURNS VOID
+AS
+$$
+BEGIN
+    -- Serialize with the triggers, which only ever touch these two tables
+    LOCK TABLE neighborhood_rollup_contributions, neighborhood_status_counts IN EXCLUSIVE MODE;
+    DELETE FROM neighborhood_rollup_contributions;
+    DELETE FROM neighborhood_status_counts;
+
+    INSERT INTO neighborhood_rollup_contributions
+    SELECT tr.id,
+           r.neighborhood,
+           tr.status,
+           GREATEST(COUNT(sp.event_id), 1),
+           COUNT(pe.scheduled_planting_id) FILTER (WHERE pe.successful)
+    FROM tree_requests tr
+             INNER JOIN residents r ON tr.resident_id = r.id
+             LEFT JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
+             LEFT JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+    WHERE tr.status IS NOT NULL
+    GROUP BY tr.id, r.neighborhood, tr.status;
+
+    INSERT INTO neighborhood_status_counts (neighborhood, status, num_requests, num_planted_trees)
+    SELECT neighborhood, status, SUM(num_requests), SUM(num_planted_trees)
+    FROM neighborhood_rollup_contributions
+    GROUP BY neighborhood, status;
+END;
+$$ LANGUAGE plpgsql;
+
+-- The neighborhood report, served from the rollup
+CREATE OR REPLACE VIEW neighborhood_report AS
+SELECT neighborhood                                                                    AS neighborhood_name,
+       SUM(num_planted_trees)                                                          AS num_of_planted_trees,
+       SUM(num_requests)                                                               AS num_of_requests,
+       COALESCE(SUM(num_requests) FILTER (WHERE status = 'completed'), 0)            AS num_of_completed_requests,
+       COALESCE(SUM(num_requests) FILTER (WHERE status = 'waiting for planting'), 0) AS num_of_requests_waiting_for_planting,
+       COALESCE(SUM(num_requests) FILTER (WHERE status = 'waiting for visit'), 0)    AS num_of_requests_waiting_for_visit,
+       COALESCE(SUM(num_requests) FILTER (WHERE status = 'needs permit'), 0)         AS num_of_requests_needs_permit,
+       COALESCE(SUM(num_requests) FILTER (WHERE status = 'denied'), 0)               AS num_of_denied_requests,
+       COALESCE(SUM(num_requests) FILTER (WHERE status = 'pending approval'), 0)     AS num_of_requests_pending_approval
+FROM neighborhood_status_counts
+GROUP BY neighborhood
+HAVING SUM(num_requests) > 0;
+
+-- Lists neighborhoods where the rollup disagrees with the original report query (Task 4 in tasks.sql)
+CREATE OR REPLACE FUNCTION check_neighborhood_rollup()
+    RETURNS TABLE
+            (
+                neighborhood_name TEXT,
+                rollup            TEXT,
+                computed          TEXT
+            )
+AS
+$$
+BEGIN
+    RETURN QUERY
+        WITH computed AS (SELECT n.name         AS neighborhood_name,
+                                 COUNT(spe)     AS num_of_planted_trees,
+                                 COUNT(tr)      AS num_of_requests,
+                                 COUNT(ctr)     AS num_of_completed_requests,
+                                 COUNT(wfptr)   AS num_of_requests_waiting_for_planting,
+                                 COUNT(wfvtr)   AS num_of_requests_waiting_for_visit,
+                                 COUNT(nptr)    AS num_of_requests_needs_permit,
+                                 COUNT(dtr)     AS num_of_denied_requests,
+                                 COUNT(patr)    AS num_of_requests_pending_approval
+                          FROM neighborhoods n
+                                   INNER JOIN residents r
+                                              ON n.name = r.neighborhood
+                                   INNER JOIN tree_requests tr
+                                              ON r.id = tr.resident_id
+                                   LEFT OUTER JOIN scheduled_plantings sp
+                                                   ON tr.id = sp.tree_request_id
+                                   LEFT OUTER JOIN planting_events spe
+                                                   ON sp.event_id = spe.scheduled_planting_id
+                                                       AND spe.successful = TRUE
+                                   INNER JOIN trees t
+                                              ON tr.tree_id = t.id
+                                   LEFT OUTER JOIN tree_requests ctr ON tr.id = ctr.id
+                              AND get_tree_request_status(ctr.id) = 'completed'
+                                   LEFT OUTER JOIN tree_requests wfptr ON tr.id = wfptr.id
+                              AND get_tree_request_status(wfptr.id) = 'waiting for planting'
+                                   LEFT OUTER JOIN tree_requests wfvtr ON tr.id = wfvtr.id
+                              AND get_tree_request_status(wfvtr.id) = 'waiting for visit'
+                                   LEFT OUTER JOIN tree_requests nptr ON tr.id = nptr.id
+                              AND get_tree_request_status(nptr.id) = 'needs permit'
+                                   LEFT OUTER JOIN tree_requests dtr ON tr.id = dtr.id
+                              AND get_tree_request_status(dtr.id) = 'denied'
+                                   LEFT OUTER JOIN tree_requests patr ON tr.id = patr.id
+                              AND get_tree_request_status(patr.id) = 'pending approval'
+                          GROUP BY n.name),
+             rollup AS (SELECT nr.neighborhood_name,
+                               nr.num_of_planted_trees,
+                               nr.num_of_requests,
+                               nr.num_of_completed_requests,
+                               nr.num_of_requests_waiting_for_planting,
+                               nr.num_of_requests_waiting_for_visit,
+                               nr.num_of_requests_needs_permit,
+                               nr.num_of_denied_requests,
+                               nr.num_of_requests_pending_approval
+                        FROM neighborhood_report nr)
+        SELECT COALESCE(r.neighborhood_name, c.neighborhood_name)::TEXT,
+               (SELECT row_to_json(r)::TEXT),
+               (SELECT row_to_json(c)::TEXT)
+        FROM rollup r
+                 FULL OUTER JOIN computed c ON r.neighborhood_name = c.neighborhood_name
+        WHERE r IS DISTINCT FROM c
+        ORDER BY 1;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Fill in the status of every tree request, then the rollup counted from it
+SELECT rebuild_tree_request_statuses();
+SELECT rebuild_neighborhood_rollup();
@@ -0,0 +1,276 @@
+-- Store scheduled visits and plantings in tables range-partitioned by year of event_timestamp,
+-- replacing the scheduled_events inheritance tree.
+--
+-- Queries that filter on event_timestamp only read the partitions for those years. Event
+-- ids are kept and keep coming from the same sequence, so visit and planting ids stay
+-- unique across both tables.
+--
+-- A primary key on a partitioned table has to include the partition key, so it is now
+-- (event_id, event_timestamp). The tables that reference a visit or planting carry its
+-- timestamp as well, for their foreign keys. A trigger fills it in from the event id, so
+-- inserts don't change. ON UPDATE CASCADE keeps it in step when an event is rescheduled,
+-- and the row then moves to the new year's partition.
+--
+-- scheduled_events is replaced by a view over both tables for ad hoc queries. The API
+-- writes to and reads from scheduled_visits and scheduled_plantings directly.
+--
+-- This rewrites both tables and the tables that reference them in one transaction. Run it
+-- when the API can take a few seconds of blocked writes.
+
+-- Creates the yearly partitions of scheduled_visits and scheduled_plantings from p_from_year
+-- through p_through_year that don't exist yet. Returns how many it created.
+CREATE OR REPLACE FUNCTION create_scheduled_event_partitions(p_from_year INTEGER, p_through_year INTEGER)
+    RETURNS INTEGER
+AS
+$$
+DECLARE
+    v_year    INTEGER;
+    v_table   TEXT;
+    v_created INTEGER := 0;
+BEGIN
+    FOR v_year IN p_from_year..p_through_year
+        LOOP
+            FOREACH v_table IN ARRAY ARRAY ['scheduled_visits', 'scheduled_plantings']
+                LOOP
+                    IF to_regclass(v_table || '_' || v_year) IS NULL THEN
+                        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                                       v_table || '_' || v_year, v_table,
+                                       make_date(v_year, 1, 1), make_date(v_year + 1, 1, 1));
+                        v_created := v_created + 1;
+                    END IF;
+                END LOOP;
+        END LOOP;
+    RETURN v_created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Makes sure an event at p_event_timestamp has a partition to go to. The scheduling routes
+-- call this before inserting, so partitions for new years are created as they're needed.
+CREATE OR REPLACE FUNCTION ensure_scheduled_event_partition(p_event_timestamp TIMESTAMP)
+    RETURNS VOID
+AS
+$$
+BEGIN
+    PERFORM create_scheduled_event_partitions(EXTRACT(YEAR FROM p_event_timestamp)::INTEGER,
+                                              EXTRACT(YEAR FROM p_event_timestamp)::INTEGER);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Fills in the timestamp of the visit or planting a row references, for its foreign key
+CREATE OR REPLACE FUNCTION scheduled_event_timestamp_trigger()
+    RETURNS TRIGGER
+AS
+$$
+DECLARE
+    v_event_id INTEGER;
+    v_column   TEXT;
+    v_parent   TEXT;
+BEGIN
+    IF TG_TABLE_NAME = 'visit_events' THEN
+        v_event_id := NEW.scheduled_visit_id;
+        v_column := 'scheduled_visit_id';
+        v_parent := 'scheduled_visits';
+        SELECT event_timestamp INTO NEW.scheduled_visit_timestamp FROM scheduled_visits WHERE event_id = v_event_id;
+        IF FOUND THEN
+            RETURN NEW;
+        END IF;
+    ELSIF TG_TABLE_NAME = 'scheduled_plantings_have_volunteers' THEN
+        v_event_id := NEW.planting_event_id;
+        v_column := 'planting_event_id';
+        v_parent := 'scheduled_plantings';
+        SELECT event_timestamp INTO NEW.planting_event_timestamp FROM scheduled_plantings WHERE event_id = v_event_id;
+        IF FOUND THEN
+            RETURN NEW;
+        END IF;
+    ELSE
+        -- planting_events and organization_members_lead_scheduled_plantings
+        v_event_id := NEW.scheduled_planting_id;
+        v_column := 'scheduled_planting_id';
+        v_parent := 'scheduled_plantings';
+        SELECT event_timestamp INTO NEW.scheduled_planting_timestamp FROM scheduled_plantings WHERE event_id = v_event_id;
+        IF FOUND THEN
+            RETURN NEW;
+        END IF;
+    END IF;
+    -- Same error the foreign key itself would raise
+    RAISE EXCEPTION 'insert or update on table "%" violates foreign key constraint', TG_TABLE_NAME
+        USING ERRCODE = 'foreign_key_violation',
+            DETAIL = format('Key (%s)=(%s) is not present in table "%s".', v_column, v_event_id, v_parent);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Move the inheritance tables out of the way, keeping the event id sequence
+ALTER SEQUENCE scheduled_events_event_id_seq OWNED BY NONE;
+DROP INDEX IF EXISTS scheduled_events_tree_request_idx, scheduled_visits_tree_request_idx,
+    scheduled_plantings_tree_request_idx, scheduled_visits_organization_member_idx;
+ALTER TABLE scheduled_visits RENAME TO scheduled_visits_inherited;
+ALTER TABLE scheduled_visits_inherited RENAME CONSTRAINT scheduled_visits_pkey TO scheduled_visits_inherited_pkey;
+ALTER TABLE scheduled_plantings RENAME TO scheduled_plantings_inherited;
+ALTER TABLE scheduled_plantings_inherited RENAME CONSTRAINT scheduled_plantings_pkey TO scheduled_plantings_inherited_pkey;
+ALTER TABLE scheduled_events RENAME TO scheduled_events_inherited;
+
+-- Same columns, in the same order, as before
+CREATE TABLE scheduled_visits
+(
+    event_id               INTEGER   NOT NULL DEFAULT nextval('scheduled_events_event_id_seq'),
+    tree_request_id        INTEGER REFERENCES tree_requests (id) ON DELETE CASCADE ON UPDATE NO ACTION NOT NULL,
+    event_timestamp        TIMESTAMP NOT NULL,
+    cancelled              BOOLEAN,
+    notes                  TEXT,
+    organization_member_id INTEGER REFERENCES organization_members (resident_id) ON DELETE CASCADE ON UPDATE CASCADE NOT NULL,
+    PRIMARY KEY (event_id, event_timestamp)
+) PARTITION BY RANGE (event_timestamp);
+
+CREATE TABLE scheduled_plantings
+(
+    event_id        INTEGER   NOT NULL DEFAULT nextval('scheduled_events_event_id_seq'),
+    tree_request_id INTEGER REFERENCES tree_requests (id) ON DELETE CASCADE ON UPDATE NO ACTION NOT NULL,
+    event_timestamp TIMESTAMP NOT NULL,
+    cancelled       BOOLEAN,
+    notes           TEXT,
+    PRIMARY KEY (event_id, event_timestamp)
+) PARTITION BY RANGE (event_timestamp);
+
+-- Every year with events, through two years from now
+SELECT create_scheduled_event_partitions(
+               LEAST(EXTRACT(YEAR FROM CURRENT_DATE)::INTEGER,
+                     (SELECT EXTRACT(YEAR FROM MIN(event_timestamp))::INTEGER FROM scheduled_events_inherited)),
+               GREATEST(EXTRACT(YEAR FROM CURRENT_DATE)::INTEGER + 2,
+                        (SELECT EXTRACT(YEAR FROM MAX(event_timestamp))::INTEGER FROM scheduled_events_inherited)));
+
+INSERT INTO scheduled_visits (event_id, tree_request_id, event_timestamp, cancelled, notes, organization_member_id)
+SELECT event_id, tree_request_id, event_timestamp, cancelled, notes, organization_member_id
+FROM scheduled_visits_inherited;
+INSERT INTO scheduled_plantings (event_id, tree_request_id, event_timestamp, cancelled, notes)
+SELECT event_id, tree_request_id, event_timestamp, cancelled, notes
+FROM scheduled_plantings_inherited;
+
+CREATE INDEX scheduled_visits_tree_request_idx ON scheduled_visits (tree_request_id, event_timestamp);
+CREATE INDEX scheduled_plantings_tree_request_idx ON scheduled_plantings (tree_request_id, event_timestamp);
+CREATE INDEX scheduled_visits_organization_member_idx ON scheduled_visits (organization_member_id);
+
+-- The referencing tables get the event's timestamp. Their status and rollup triggers stay
+-- off while it is backfilled, since nothing they track changes.
+ALTER TABLE visit_events DISABLE TRIGGER USER;
+ALTER TABLE planting_events DISABLE TRIGGER USER;
+
+ALTER TABLE visit_events ADD COLUMN scheduled_visit_timestamp TIMESTAMP;
+UPDATE visit_events ve
+SET scheduled_visit_timestamp = sv.event_timestamp
+FROM scheduled_visits sv
+WHERE sv.event_id = ve.scheduled_visit_id;
+
+ALTER TABLE planting_events ADD COLUMN scheduled_planting_timestamp TIMESTAMP;
+UPDATE planting_events pe
+SET scheduled_planting_timestamp = sp.event_timestamp
+FROM scheduled_plantings sp
+WHERE sp.event_id = pe.scheduled_planting_id;
+
+ALTER TABLE organization_members_lead_scheduled_plantings ADD COLUMN scheduled_planting_timestamp TIMESTAMP;
+UPDATE organization_members_lead_scheduled_plantings omsp
+SET scheduled_planting_timestamp = sp.event_timestamp
+FROM scheduled_plantings sp
+WHERE sp.event_id = omsp.scheduled_planting_id;
+
+ALTER TABLE scheduled_plantings_have_volunteers ADD COLUMN planting_event_timestamp TIMESTAMP;
+UPDATE scheduled_plantings_have_volunteers spv
+SET planting_event_timestamp = sp.event_timestamp
+FROM scheduled_plantings sp
+WHERE sp.event_id = spv.planting_event_id;
+
+ALTER TABLE visit_events ENABLE TRIGGER USER;
+ALTER TABLE planting_events ENABLE TRIGGER USER;
+
+-- Drop the foreign keys that pointed at the old tables, then the tables. Anything else still
+-- depending on them makes the DROP, and so the migration, fail.
+DO
+$$
+    DECLARE
+        v_constraint RECORD;
+    BEGIN
+        FOR v_constraint IN SELECT conrelid::regclass AS table_name, conname
+                            FROM pg_constraint
+                            WHERE contype = 'f'
+                              AND confrelid IN ('scheduled_visits_inherited'::regclass,
+                                                'scheduled_plantings_inherited'::regclass)
+            LOOP
+                EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', v_constraint.table_name, v_constraint.conname);
+            END LOOP;
+    END
+$$;
+DROP TABLE scheduled_visits_inherited, scheduled_plantings_inherited, scheduled_events_inherited;
+
+ALTER TABLE visit_events
+    ALTER COLUMN scheduled_visit_timestamp SET NOT NULL,
+    ADD FOREIGN KEY (scheduled_visit_id, scheduled_visit_timestamp)
+        REFERENCES scheduled_visits (event_id, event_timestamp) ON DELETE CASCADE ON UPDATE CASCADE;
+ALTER TABLE planting_events
+    ALTER COLUMN scheduled_planting_timestamp SET NOT NULL,
+    ADD FOREIGN KEY (scheduled_planting_id, scheduled_planting_timestamp)
+        REFERENCES scheduled_plantings (event_id, event_timestamp) ON DELETE CASCADE ON UPDATE CASCADE;
+ALTER TABLE organization_members_lead_scheduled_plantings
+    ALTER COLUMN scheduled_planting_timestamp SET NOT NULL,
+    ADD FOREIGN KEY (scheduled_planting_id, scheduled_planting_timestamp)
+        REFERENCES scheduled_plantings (event_id, event_timestamp) ON DELETE CASCADE ON UPDATE CASCADE;
+ALTER TABLE scheduled_plantings_have_volunteers
+    ALTER COLUMN planting_event_timestamp SET NOT NULL,
+    ADD FOREIGN KEY (planting_event_id, planting_event_timestamp)
+        REFERENCES scheduled_plantings (event_id, event_timestamp) ON DELETE CASCADE ON UPDATE CASCADE;
+
+CREATE TRIGGER visit_events_event_timestamp
+    BEFORE INSERT OR UPDATE OF scheduled_visit_id
+    ON visit_events
+    FOR EACH ROW
+EXECUTE FUNCTION scheduled_event_timestamp_trigger();
+
+CREATE TRIGGER planting_events_event_timestamp
+    BEFORE INSERT OR UPDATE OF scheduled_planting_id
+    ON planting_events
+    FOR EACH ROW
+EXECUTE FUNCTION scheduled_event_timestamp_trigger();
+
+CREATE TRIGGER org_members_lead_plantings_event_timestamp
+    BEFORE INSERT OR UPDATE OF scheduled_planting_id
+    ON organization_members_lead_scheduled_plantings
+    FOR EACH ROW
+EXECUTE FUNCTION scheduled_event_timestamp_trigger();
+
+CREATE TRIGGER scheduled_plantings_volunteers_event_timestamp
+    BEFORE INSERT OR UPDATE OF planting_event_id
+    ON scheduled_plantings_have_volunteers
+    FOR EACH ROW
+EXECUTE FUNCTION scheduled_event_timestamp_trigger();
+
+-- The status and rollup triggers from ddl.sql went with the old tables
+CREATE TRIGGER scheduled_visits_status
+    AFTER INSERT OR UPDATE OF tree_request_id OR DELETE
+    ON scheduled_visits
+    FOR EACH ROW
+EXECUTE FUNCTION tree_request_status_trigger();
+
+CREATE TRIGGER scheduled_plantings_status
+    AFTER INSERT OR UPDATE OF tree_request_id OR DELETE
+    ON scheduled_plantings
+    FOR EACH ROW
+EXECUTE FUNCTION tree_request_status_trigger();
+
+CREATE TRIGGER scheduled_plantings_neighborhood_rollup
+    AFTER INSERT OR UPDATE OF tree_request_id OR DELETE
+    ON scheduled_plantings
+    FOR EACH ROW
+EXECUTE FUNCTION neighborhood_rollup_trigger();
+
+-- get_tree_request_status() and the rebuild functions look their tables up by name when
+-- they run, so they read the new tables as they are. Refill what the triggers maintain.
+SELECT rebuild_tree_request_statuses();
+SELECT rebuild_neighborhood_rollup();
+
+CREATE VIEW scheduled_events AS
+SELECT event_id, tree_request_id, event_timestamp, cancelled, notes
+FROM scheduled_visits
+UNION ALL
+SELECT event_id, tree_request_id, event_timestamp, cancelled, notes
+FROM scheduled_plantings;
+
+ANALYZE scheduled_visits, scheduled_plantings, visit_events, planting_events,
+    organization_members_lead_scheduled_plantings, scheduled_plantings_have_volunteers;
@@ -0,0 +1,372 @@
+-- Yearly planting and visit counts for the peak-year reports.
+--
+-- /api/tree-species-statistics and custom reports 1-3 find each row's "peak year" by
+-- grouping its whole planting history by year, once per output row. These tables hold
+-- those per-year counts, kept current by triggers, so the reports read a few rows per
+-- species, neighborhood, volunteer or organization member instead.
+--
+-- Each *_computed view is the definition of its table. A trigger refreshes the rows of
+-- one species, neighborhood, volunteer or organization member (every year) from the
+-- view whenever something they count changes, so deletes that cascade in any order end
+-- up right. rebuild_yearly_planting_rollups() refills all four after a bulk load with
+-- the triggers off, and check_yearly_planting_rollups() lists rows that disagree.
+
+-- Successful plantings of each tree species per year
+CREATE TABLE species_yearly_plantings
+(
+    tree_id     INTEGER NOT NULL,
+    year        INTEGER NOT NULL,
+    num_planted INTEGER NOT NULL,
+    PRIMARY KEY (tree_id, year)
+);
+
+CREATE VIEW species_yearly_plantings_computed AS
+SELECT tr.tree_id,
+       EXTRACT(YEAR FROM sp.event_timestamp)::INTEGER AS year,
+       COUNT(*)::INTEGER                              AS num_planted
+FROM tree_requests tr
+         INNER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
+         INNER JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+WHERE pe.successful = TRUE
+GROUP BY tr.tree_id, EXTRACT(YEAR FROM sp.event_timestamp)::INTEGER;
+
+-- Successful plantings of each species per year in each neighborhood (the requester's)
+CREATE TABLE neighborhood_species_yearly_plantings
+(
+    neighborhood VARCHAR(100) NOT NULL,
+    tree_id      INTEGER NOT NULL,
+    year         INTEGER NOT NULL,
+    num_planted  INTEGER NOT NULL,
+    PRIMARY KEY (neighborhood, tree_id, year)
+);
+
+CREATE VIEW neighborhood_species_yearly_plantings_computed AS
+SELECT r.neighborhood,
+       tr.tree_id,
+       EXTRACT(YEAR FROM sp.event_timestamp)::INTEGER AS year,
+       COUNT(*)::INTEGER                              AS num_planted
+FROM residents r
+         INNER JOIN tree_requests tr ON r.id = tr.resident_id
+         INNER JOIN scheduled_plantings sp ON tr.id = sp.tree_request_id
+         INNER JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+WHERE pe.successful = TRUE
+GROUP BY r.neighborhood, tr.tree_id, EXTRACT(YEAR FROM sp.event_timestamp)::INTEGER;
+
+-- Planting events each volunteer attended per year. Custom report 1 lists the successful
+-- ones but finds the peak year over all of them.
+CREATE TABLE volunteer_yearly_plantings
+(
+    volunteer_id         INTEGER NOT NULL,
+    year                 INTEGER NOT NULL,
+    plantings_attended   INTEGER NOT NULL,
+    trees_planted        INTEGER NOT NULL,
+    first_planting       TIMESTAMP,
+    most_recent_planting TIMESTAMP,
+    PRIMARY KEY (volunteer_id, year)
+);
+
+CREATE VIEW volunteer_yearly_plantings_computed AS
+SELECT pev.volunteer_id,
+       EXTRACT(YEAR FROM sp.event_timestamp)::INTEGER                AS year,
+       COUNT(*)::INTEGER                                             AS plantings_attended,
+       (COUNT(*) FILTER (WHERE pe.successful = TRUE))::INTEGER       AS trees_planted,
+       MIN(sp.event_timestamp) FILTER (WHERE pe.successful = TRUE) AS first_planting,
+       MAX(sp.event_timestamp) FILTER (WHERE pe.successful = TRUE) AS most_recent_planting
+FROM planting_events_have_volunteers pev
+         INNER JOIN planting_events pe ON pev.planting_event_id = pe.scheduled_planting_id
+         INNER JOIN scheduled_plantings sp ON pe.scheduled_planting_id = sp.event_id
+GROUP BY pev.volunteer_id, EXTRACT(YEAR FROM sp.event_timestamp)::INTEGER;
+
+-- Plantings led and visits attended by each organization member per year. Custom report 2
+-- counts plantings and visits that weren't cancelled, but finds the plantings peak year
+-- over every successful planting led, cancelled or not.
+CREATE TABLE org_member_yearly_activity
+(
+    organization_member_id       INTEGER NOT NULL,
+    year                         INTEGER NOT NULL,
+    plantings_led                INTEGER NOT NULL,
+    successful_plantings_led     INTEGER NOT NULL,
+    all_successful_plantings_led INTEGER NOT NULL,
+    visits_attended              INTEGER NOT NULL,
+    PRIMARY KEY (organization_member_id, year)
+);
+
+CREATE VIEW org_member_yearly_activity_computed AS
+SELECT organization_member_id,
+       year,
+       SUM(plantings_led)::INTEGER                AS plantings_led,
+       SUM(successful_plantings_led)::INTEGER     AS successful_plantings_led,
+       SUM(all_successful_plantings_led)::INTEGER AS all_successful_plantings_led,
+       SUM(visits_attended)::INTEGER              AS visits_attended
+FROM (SELECT ompe.organization_member_id,
+             EXTRACT(YEAR FROM sp.event_timestamp)::INTEGER                       AS year,
+             COUNT(*) FILTER (WHERE sp.cancelled = FALSE)                         AS plantings_led,
+             COUNT(*) FILTER (WHERE sp.cancelled = FALSE AND pe.successful = TRUE) AS successful_plantings_led,
+             COUNT(*) FILTER (WHERE pe.successful = TRUE)                         AS all_successful_plantings_led,
+             0                                                                    AS visits_attended
+      FROM organization_members_lead_scheduled_plantings ompe
+               INNER JOIN scheduled_plantings sp ON ompe.scheduled_planting_id = sp.event_id
+               LEFT JOIN planting_events pe ON sp.event_id = pe.scheduled_planting_id
+      GROUP BY ompe.organization_member_id, EXTRACT(YEAR FROM sp.event_timestamp)::INTEGER
+      UNION ALL
+      SELECT sv.organization_member_id,
+             EXTRACT(YEAR FROM sv.event_timestamp)::INTEGER,
+             0,
+             0,
+             0,
+             COUNT(*)
+      FROM scheduled_visits sv
+      WHERE sv.cancelled = FALSE
+      GROUP BY sv.organization_member_id, EXTRACT(YEAR FROM sv.event_timestamp)::INTEGER) activity
+GROUP BY organization_member_id, year
+HAVING SUM(plantings_led) + SUM(all_successful_plantings_led) + SUM(visits_attended) > 0;
+
+-- The refresh functions rewrite every year of one key. The advisory lock keeps two
+-- transactions refreshing the same key from both inserting its rows.
+CREATE OR REPLACE FUNCTION refresh_species_yearly_plantings(p_tree_id INTEGER)
+    RETURNS VOID
+AS
+$$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('species_yearly_plantings'), p_tree_id);
+    DELETE FROM species_yearly_plantings WHERE tree_id = p_tree_id;
+    INSERT INTO species_yearly_plantings
+    SELECT * FROM species_yearly_plantings_computed WHERE tree_id = p_tree_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_neighborhood_yearly_plantings(p_neighborhood VARCHAR)
+    RETURNS VOID
+AS
+$$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('neighborhood_species_yearly_plantings'), hashtext(p_neighborhood));
+    DELETE FROM neighborhood_species_yearly_plantings WHERE neighborhood = p_neighborhood;
+    INSERT INTO neighborhood_species_yearly_plantings
+    SELECT * FROM neighborhood_species_yearly_plantings_computed WHERE neighborhood = p_neighborhood;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_volunteer_yearly_plantings(p_volunteer_id INTEGER)
+    RETURNS VOID
+AS
+$$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('volunteer_yearly_plantings'), p_volunteer_id);
+    DELETE FROM volunteer_yearly_plantings WHERE volunteer_id = p_volunteer_id;
+    INSERT INTO volunteer_yearly_plantings
+    SELECT * FROM volunteer_yearly_plantings_computed WHERE volunteer_id = p_volunteer_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_org_member_yearly_activity(p_organization_member_id INTEGER)
+    RETURNS VOID
+AS
+$$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('org_member_yearly_activity'), p_organization_member_id);
+    DELETE FROM org_member_yearly_activity WHERE organization_member_id = p_organization_member_id;
+    INSERT INTO org_member_yearly_activity
+    SELECT * FROM org_member_yearly_activity_computed WHERE organization_member_id = p_organization_member_id;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Everything a scheduled planting counts towards: its species and neighborhood, the
+-- organization members who lead it and (unless p_volunteers is false) the volunteers who
+-- attended it
+CREATE OR REPLACE FUNCTION refresh_planting_yearly_rollups(p_scheduled_planting_id INTEGER, p_volunteers BOOLEAN)
+    RETURNS VOID
+AS
+$$
+BEGIN
+    PERFORM refresh_species_yearly_plantings(tr.tree_id), refresh_neighborhood_yearly_plantings(r.neighborhood)
+    FROM scheduled_plantings sp
+             INNER JOIN tree_requests tr ON sp.tree_request_id = tr.id
+             INNER JOIN residents r ON tr.resident_id = r.id
+    WHERE sp.event_id = p_scheduled_planting_id;
+    PERFORM refresh_org_member_yearly_activity(organization_member_id)
+    FROM organization_members_lead_scheduled_plantings
+    WHERE scheduled_planting_id = p_scheduled_planting_id;
+    PERFORM refresh_volunteer_yearly_plantings(volunteer_id)
+    FROM planting_events_have_volunteers
+    WHERE planting_event_id = p_scheduled_planting_id
+      AND p_volunteers;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Each trigger passes its table's name, since rows of a partitioned table fire it with
+-- TG_TABLE_NAME set to their partition's
+CREATE OR REPLACE FUNCTION yearly_rollup_trigger()
+    RETURNS TRIGGER
+AS
+$$
+BEGIN
+    IF TG_ARGV[0] = 'residents' THEN
+        IF OLD.neighborhood IS DISTINCT FROM NEW.neighborhood THEN
+            PERFORM refresh_neighborhood_yearly_plantings(OLD.neighborhood);
+            PERFORM refresh_neighborhood_yearly_plantings(NEW.neighborhood);
+        END IF;
+    ELSIF TG_ARGV[0] = 'tree_requests' THEN
+        PERFORM refresh_species_yearly_plantings(OLD.tree_id);
+        PERFORM refresh_neighborhood_yearly_plantings(neighborhood) FROM residents WHERE id = OLD.resident_id;
+        IF TG_OP = 'UPDATE' THEN
+            IF NEW.tree_id IS DISTINCT FROM OLD.tree_id THEN
+                PERFORM refresh_species_yearly_plantings(NEW.tree_id);
+            END IF;
+            IF NEW.resident_id IS DISTINCT FROM OLD.resident_id THEN
+                PERFORM refresh_neighborhood_yearly_plantings(neighborhood) FROM residents WHERE id = NEW.resident_id;
+            END IF;
+        END IF;
+    ELSIF TG_ARGV[0] = 'scheduled_plantings' THEN
+        IF TG_OP = 'DELETE' THEN
+            -- Its leads and attendance are deleted with it and refresh their own rows
+            PERFORM refresh_species_yearly_plantings(tr.tree_id), refresh_neighborhood_yearly_plantings(r.neighborhood)
+            FROM tree_requests tr
+                     INNER JOIN residents r ON tr.resident_id = r.id
+            WHERE tr.id = OLD.tree_request_id;
+        ELSE
+            PERFORM refresh_planting_yearly_rollups(NEW.event_id, TRUE);
+            IF NEW.tree_request_id IS DISTINCT FROM OLD.tree_request_id THEN
+                PERFORM refresh_species_yearly_plantings(tr.tree_id), refresh_neighborhood_yearly_plantings(r.neighborhood)
+                FROM tree_requests tr
+                         INNER JOIN residents r ON tr.resident_id = r.id
+                WHERE tr.id = OLD.tree_request_id;
+            END IF;
+        END IF;
+    ELSIF TG_ARGV[0] = 'planting_events' THEN
+        -- Attendance can only be added after (or with) the outcome, and refreshes its own
+        -- volunteers, so an insert leaves them out
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM refresh_planting_yearly_rollups(OLD.scheduled_planting_id, TRUE);
+        END IF;
+        IF TG_OP = 'INSERT' OR NEW.scheduled_planting_id IS DISTINCT FROM OLD.scheduled_planting_id THEN
+            PERFORM refresh_planting_yearly_rollups(NEW.scheduled_planting_id, TG_OP <> 'INSERT');
+        END IF;
+    ELSIF TG_ARGV[0] = 'planting_events_have_volunteers' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM refresh_volunteer_yearly_plantings(OLD.volunteer_id);
+        END IF;
+        IF TG_OP = 'INSERT' OR NEW.volunteer_id IS DISTINCT FROM OLD.volunteer_id THEN
+            PERFORM refresh_volunteer_yearly_plantings(NEW.volunteer_id);
+        END IF;
+    ELSE
+        -- organization_members_lead_scheduled_plantings and scheduled_visits
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM refresh_org_member_yearly_activity(OLD.organization_member_id);
+        END IF;
+        IF TG_OP = 'INSERT' OR NEW.organization_member_id IS DISTINCT FROM OLD.organization_member_id THEN
+            PERFORM refresh_org_member_yearly_activity(NEW.organization_member_id);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER residents_yearly_rollups
+    AFTER UPDATE OF neighborhood
+    ON residents
+    FOR EACH ROW
+EXECUTE FUNCTION yearly_rollup_trigger('residents');
+
+CREATE TRIGGER tree_requests_yearly_rollups
+    AFTER UPDATE OF tree_id, resident_id OR DELETE
+    ON tree_requests
+    FOR EACH ROW
+EXECUTE FUNCTION yearly_rollup_trigger('tree_requests');
+
+CREATE TRIGGER scheduled_plantings_yearly_rollups
+    AFTER UPDATE OF tree_request_id, event_timestamp, cancelled OR DELETE
+    ON scheduled_plantings
+    FOR EACH ROW
+EXECUTE FUNCTION yearly_rollup_trigger('scheduled_plantings');
+
+CREATE TRIGGER planting_events_yearly_rollups
+    AFTER INSERT OR UPDATE OF scheduled_planting_id, successful OR DELETE
+    ON planting_events
+    FOR EACH ROW
+EXECUTE FUNCTION yearly_rollup_trigger('planting_events');
+
+CREATE TRIGGER planting_events_volunteers_yearly_rollups
+    AFTER INSERT OR UPDATE OR DELETE
+    ON planting_events_have_volunteers
+    FOR EACH ROW
+EXECUTE FUNCTION yearly_rollup_trigger('planting_events_have_volunteers');
+
+CREATE TRIGGER org_members_lead_plantings_yearly_rollups
+    AFTER INSERT OR UPDATE OR DELETE
+    ON organization_members_lead_scheduled_plantings
+    FOR EACH ROW
+EXECUTE FUNCTION yearly_rollup_trigger('organization_members_lead_scheduled_plantings');
+
+CREATE TRIGGER scheduled_visits_yearly_rollups
+    AFTER INSERT OR UPDATE OF organization_member_id, event_timestamp, cancelled OR DELETE
+    ON scheduled_visits
+    FOR EACH ROW
+EXECUTE FUNCTION yearly_rollup_trigger('scheduled_visits');
+
+-- Throws the four tables away and refills them from their views
+CREATE OR REPLACE FUNCTION rebuild_yearly_planting_rollups()
+    RETURNS VOID
+AS
+$$
+BEGIN
+    LOCK TABLE species_yearly_plantings, neighborhood_species_yearly_plantings, volunteer_yearly_plantings,
+        org_member_yearly_activity IN EXCLUSIVE MODE;
+    DELETE FROM species_yearly_plantings;
+    INSERT INTO species_yearly_plantings SELECT * FROM species_yearly_plantings_computed;
+    DELETE FROM neighborhood_species_yearly_plantings;
+    INSERT INTO neighborhood_species_yearly_plantings SELECT * FROM neighborhood_species_yearly_plantings_computed;
+    DELETE FROM volunteer_yearly_plantings;
+    INSERT INTO volunteer_yearly_plantings SELECT * FROM volunteer_yearly_plantings_computed;
+    DELETE FROM org_member_yearly_activity;
+    INSERT INTO org_member_yearly_activity SELECT * FROM org_member_yearly_activity_computed;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Lists rows of the four tables that differ from their views: 'stored' rows that shouldn't
+-- be there (or are out of date) and 'computed' rows that are missing
+CREATE OR REPLACE FUNCTION check_yearly_planting_rollups()
+    RETURNS TABLE
+            (
+                rollup    TEXT,
+                source    TEXT,
+                row_value TEXT
+            )
+AS
+$$
+BEGIN
+    RETURN QUERY
+        SELECT 'species_yearly_plantings', 'stored', s::TEXT
+        FROM (SELECT * FROM species_yearly_plantings EXCEPT SELECT * FROM species_yearly_plantings_computed) s
+        UNION ALL
+        SELECT 'species_yearly_plantings', 'computed', c::TEXT
+        FROM (SELECT * FROM species_yearly_plantings_computed EXCEPT SELECT * FROM species_yearly_plantings) c
+        UNION ALL
+        SELECT 'neighborhood_species_yearly_plantings', 'stored', s::TEXT
+        FROM (SELECT * FROM neighborhood_species_yearly_plantings
+              EXCEPT
+              SELECT * FROM neighborhood_species_yearly_plantings_computed) s
+        UNION ALL
+        SELECT 'neighborhood_species_yearly_plantings', 'computed', c::TEXT
+        FROM (SELECT * FROM neighborhood_species_yearly_plantings_computed
+              EXCEPT
+              SELECT * FROM neighborhood_species_yearly_plantings) c
+        UNION ALL
+        SELECT 'volunteer_yearly_plantings', 'stored', s::TEXT
+        FROM (SELECT * FROM volunteer_yearly_plantings EXCEPT SELECT * FROM volunteer_yearly_plantings_computed) s
+        UNION ALL
+        SELECT 'volunteer_yearly_plantings', 'computed', c::TEXT
+        FROM (SELECT * FROM volunteer_yearly_plantings_computed EXCEPT SELECT * FROM volunteer_yearly_plantings) c
+        UNION ALL
+        SELECT 'org_member_yearly_activity', 'stored', s::TEXT
+        FROM (SELECT * FROM org_member_yearly_activity EXCEPT SELECT * FROM org_member_yearly_activity_computed) s
+        UNION ALL
+        SELECT 'org_member_yearly_activity', 'computed', c::TEXT
+        FROM (SELECT * FROM org_member_yearly_activity_computed EXCEPT SELECT * FROM org_member_yearly_activity) c
+        ORDER BY 1, 3, 2;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_yearly_planting_rollups();
+ANALYZE species_yearly_plantings, neighborhood_species_yearly_plantings, volunteer_yearly_plantings,
+    org_member_yearly_activity;
@@ -0,0 +1,27 @@
+-- Report jobs submitted to /api/report-jobs, and their results.
+--
+-- A job runs one report with the query string it was submitted with, on a background
+-- thread of the API worker that accepted it (jobs.py). The response body is stored in
+-- `result` until `expires`, and submitting the same report with the same parameters
+-- (the same `key`) until then returns the stored job instead of running it again.
+-- Expired jobs are deleted as new ones are submitted.
+
+CREATE TABLE report_jobs
+(
+    id        SERIAL PRIMARY KEY NOT NULL,
+    key       CHAR(40)    NOT NULL,
+    report    VARCHAR(50) NOT NULL,
+    params    JSONB       NOT NULL,
+    status    VARCHAR(10) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    error     TEXT,
+    row_count INTEGER,
+    result    BYTEA,
+    created   TIMESTAMP   NOT NULL DEFAULT now(),
+    started   TIMESTAMP,
+    finished  TIMESTAMP,
+    expires   TIMESTAMP
+);
+
+-- The latest job for a report and parameters
+CREATE INDEX report_jobs_key_idx ON report_jobs (key, created DESC);
+CREATE INDEX report_jobs_expires_idx ON report_jobs (expires);
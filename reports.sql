@@ -208,8 +208,8 @@ WITH valid_trees AS (SELECT
                     WHERE
                             LOWER(t.height_range) >= :p_min_height
                         AND UPPER(t.height_range) <= :p_max_height
-                        AND LOWER(t.height_range) >= :p_min_width
-                        AND UPPER(t.height_range) <= :p_max_width
+                        AND LOWER(t.width_range) >= :p_min_width
+                        AND UPPER(t.width_range) <= :p_max_width
                     GROUP BY t.id, t.common_name, t.inventory
                     HAVING t.inventory - COUNT(tr) > 0)
 SELECT t.common_name, COUNT(pe) AS num_planted